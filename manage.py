@@ -173,6 +173,14 @@ def create_data():
     print("Created sample data.")
 
 
+@cli.command()
+def rebuild_bestsellers():
+    """ Recount the bestseller ranking and the popularity from the completed orders """
+    from project.server.models.queries import rebuild_bestsellers as rebuild
+    rebuild()
+    print("Rebuilt the bestsellers.")
+
+
 @cli.command()
 def load_svg():
     """ Load all SVG's from a default path """
@@ -194,6 +202,21 @@ def start_worker(loglevel):
     subprocess.run(["celery", "worker", "-A", "project.server.celery_app:app", f"--loglevel={loglevel}"])
 
 
+@cli.command()
+@click.argument("loglevel",
+                default="info",
+                required=True,
+                type=click.Choice(['error', 'warning', 'info', 'debug'],
+                                  case_sensitive=False))
+def start_beat(loglevel):
+    """
+    Starts the celery beat scheduler of the periodic tasks (e.g. the Tricoma sync).
+    Run exactly one of it, next to any number of workers.
+    """
+    import subprocess
+    subprocess.run(["celery", "beat", "-A", "project.server.celery_app:app", f"--loglevel={loglevel}"])
+
+
 @cli.command()
 def test():
     """Runs the unit tests without test coverage."""
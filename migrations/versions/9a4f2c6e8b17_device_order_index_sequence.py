@@ -0,0 +1,26 @@
+"""device order index sequence
+
+Revision ID: 9a4f2c6e8b17
+Revises: 5c1e7a9b3d42
+Create Date: 2026-10-17 14:02:47.310955
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4f2c6e8b17'
+down_revision = '5c1e7a9b3d42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('device_order_index_seq', start=0, minvalue=0)))
+    # continue after the highest index in use
+    op.execute("SELECT setval('device_order_index_seq', (SELECT COALESCE(MAX(order_index) + 1, 0) FROM device), false)")
+
+
+def downgrade():
+    op.execute(sa.schema.DropSequence(sa.Sequence('device_order_index_seq')))
@@ -2,7 +2,7 @@ from flask_login import current_user
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileRequired, FileAllowed
 from wtforms import validators
-from wtforms.fields import StringField, PasswordField, FileField
+from wtforms.fields import StringField, PasswordField, FileField, BooleanField
 
 from project.server import db
 from project.server.models import User
@@ -54,3 +54,9 @@ class ImportRepairForm(FlaskForm):
             FileAllowed(['csv'], 'CSV only!')
         ]
     )
+    preview = BooleanField("Nur Vorschau anzeigen, ohne etwas zu ändern", default=True)
+
+
+class ConfirmImportForm(FlaskForm):
+    """ Only protects the confirmation of a preview against CSRF """
+    pass
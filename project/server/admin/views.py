@@ -4,22 +4,26 @@ This is place for all admin views.
 Views should ALWAYS extend ProtectedModelView !
 
 """
-from flask import redirect, url_for, request, flash, abort, send_from_directory, current_app
+from flask import redirect, url_for, request, flash, abort, send_from_directory, current_app, jsonify
 from flask_admin import expose, helpers, AdminIndexView, BaseView
 from flask_admin.actions import action
 from flask_admin.contrib.rediscli import RedisCli
 from flask_admin.contrib.sqla import ModelView as _ModelView
 from flask_admin.form import SecureForm
 from flask_login import current_user, login_user, logout_user
+from kombu.exceptions import OperationalError
+from redis.exceptions import RedisError
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import FlushError
 
 from project.server import flask_admin as admin, db
 from project.server.models import Customer, MailLog, Shop, Order, Device, Manufacturer, Repair, Image, DeviceSeries
+from project.server.common.import_repair import ImportFileError
+from project.server.common.search_cache import normalize_query
+from project.tasks.imports import start_import, import_status, import_result, recent_imports, confirm_preview
 # Create customized model view class
 from .column_formatters import customer_formatter, link_to_device_formatter
-from .forms import LoginForm, ChangePasswordForm, ImportRepairForm
-from ..common.import_repair import import_repairs
+from .forms import LoginForm, ChangePasswordForm, ImportRepairForm, ConfirmImportForm
 from ..extensions import redis_client
 from ..models.device import Color
 from ..models.misc import MiscInquiry
@@ -159,7 +163,7 @@ class SubmittedOrderView(OrderView):
     can_delete = False
 
     column_list = (
-        'timestamp', 'kva', 'shop', 'color', 'customer', 'repairs', 'problem_description',
+        'timestamp', 'kva', 'shop', 'color', 'customer', 'repairs', 'price_total', 'problem_description',
         'customer_wishes_shipping_label')
     column_labels = {
         'timestamp': 'Zeitstempel',
@@ -168,6 +172,7 @@ class SubmittedOrderView(OrderView):
         'color': 'Farbe',
         'customer': 'Kunde',
         'repairs': 'Reparatur(en)',
+        'price_total': 'Preis',
         'problem_description': 'Problembeschreibung',
         'customer_wishes_shipping_label': 'Versandlabel erwünscht',
     }
@@ -226,18 +231,34 @@ class DeviceView(AdminExportableModelView):
             f"Die Geräte wurden erfolgreich zu {merger.name} zusammengeführt. Bitte passe den Namen an und prüfe die Bilder.")
         return redirect(url_for('device.edit_view', id=merger.id))
 
+    @action(
+        "merge_by_name",
+        "Nach Namen zusammenführen",
+        "Sollen die gewählten Geräte mit gleichem Namen (ohne Groß- und Kleinschreibung und Leerzeichen) zusammengeführt werden?"
+    )
+    def action_merge_by_name(self, ids):
+        groups = {}
+        for device_id, name in self.session.query(Device.id, Device.name).filter(Device.id.in_(ids)).order_by(Device.id):
+            groups.setdefault(normalize_query(name).replace(" ", ""), []).append(device_id)
+        groups = [group for group in groups.values() if len(group) > 1]
+        if not groups:
+            flash("Unter den gewählten Geräten gibt es keine mit gleichem Namen.")
+            return
+        try:
+            mergers = Device.merge_groups(groups)
+        except (IntegrityError, FlushError) as e:
+            flash("Zusammenführen fehlgeschlagen", "danger")
+            current_app.logger.error(e)
+            return
+        flash(f"{len(mergers)} Gruppen wurden zusammengeführt: {', '.join(merger.name for merger in mergers)}. Bitte prüfe die Bilder.")
+
     @action(
         "normalize",
         "Normalisieren",
         "Sollen die ausgewählten Elemente normalisiert werden?",
     )
     def action_normalize(self, ids):
-        selected = self.model.query.filter(self.model.id.in_(ids)).order_by(
-            self.model.order_index
-        )
-        for i, model in enumerate(selected):
-            model.order_index = i
-            model.save()
+        self.model.normalize(ids)
         return redirect(url_for(".index_view"))
 
     @action(
@@ -246,14 +267,16 @@ class DeviceView(AdminExportableModelView):
         "Sollen die ausgewählten Elemente nach ihrem Namen normalisiert werden?",
     )
     def action_normalize_by_name(self, ids):
-        selected = self.model.query.filter(self.model.id.in_(ids)).order_by(
-            self.model.name.desc()
-        )
-
-        for i, model in enumerate(selected):
-            model.order_index = i
-            model.save()
+        self.model.normalize(ids, order_by=self.model.name.desc())
+        return redirect(url_for(".index_view"))
 
+    @action(
+        "normalize_by_series",
+        "Normalisieren je Serie",
+        "Sollen die ausgewählten Elemente innerhalb ihrer Serie normalisiert werden?",
+    )
+    def action_normalize_by_series(self, ids):
+        self.model.normalize(ids, per=self.model.series_id)
         return redirect(url_for(".index_view"))
 
     @action(
@@ -262,11 +285,7 @@ class DeviceView(AdminExportableModelView):
         "Sollen die ausgewählten Elemente nach oben verschoben werden?",
     )
     def action_move_up(self, ids):
-        selected = self.model.query.filter(self.model.id.in_(ids)).order_by(
-            self.model.order_index
-        )
-        for item in selected:
-            item.move_up()
+        self.model.move_many(ids, up=True)
         return redirect(url_for(".index_view"))
 
     @action(
@@ -275,11 +294,7 @@ class DeviceView(AdminExportableModelView):
         "Sollen die ausgewählten Elemente nach unten verschoben werden?",
     )
     def action_move_down(self, ids):
-        selected = self.model.query.filter(self.model.id.in_(ids)).order_by(
-            self.model.order_index.desc()
-        )
-        for item in selected:
-            item.move_down()
+        self.model.move_many(ids, up=False)
         return redirect(url_for(".index_view"))
 
 
@@ -347,17 +362,49 @@ class ImportView(ProtectedBaseView):
         form = ImportRepairForm()
         if form.validate_on_submit():
             f = request.files[form.repair_file.name]
-            # store the file contents as a string
-            fstring = f.read().decode('iso-8859-1')
-            count, err_msg = import_repairs(fstring)
-            if not count:
-                flash(err_msg, "danger")
+            # the file is streamed, encoding and delimiter are detected by the importer
+            try:
+                job_id = start_import(f.stream, filename=f.filename, preview=form.preview.data)
+            except ImportFileError as e:
+                flash(str(e), "danger")
+            except (OperationalError, RedisError) as e:
+                current_app.logger.error(e)
+                flash("Der Import konnte nicht gestartet werden. Bitte versuche es später erneut.", "danger")
             else:
-                flash(f"Import erfolgreich. Es wurden {count} Reparatruren erstellt oder aktualisiert!")
+                return redirect(url_for('.job', job_id=job_id))
 
+        try:
+            self._template_args['jobs'] = recent_imports()
+        except RedisError:
+            self._template_args['jobs'] = []
         self._template_args['form'] = form
         return self.render('admin/import/import.html')
 
+    @expose('/job/<string:job_id>/confirm', methods=['POST'])
+    def confirm(self, job_id):
+        """ Import the file of a preview. Nothing is written, if the data changed since the preview. """
+        form = ConfirmImportForm()
+        if form.validate_on_submit():
+            confirmed_id = confirm_preview(job_id)
+            if confirmed_id is not None:
+                return redirect(url_for('.job', job_id=confirmed_id))
+        flash("Die Vorschau ist abgelaufen. Bitte lade die Datei erneut hoch.", "warning")
+        return redirect(url_for('.index'))
+
+    @expose('/job/<string:job_id>', methods=['GET'])
+    def job(self, job_id):
+        """ Progress of a running import and the report of a finished one """
+        self._template_args['job_id'] = job_id
+        self._template_args['status'] = import_status(job_id)
+        self._template_args['result'] = import_result(job_id)
+        self._template_args['form'] = ConfirmImportForm()
+        return self.render('admin/import/job.html')
+
+    @expose('/status/<string:job_id>', methods=['GET'])
+    def status(self, job_id):
+        """ Polled by the job page """
+        return jsonify(import_status(job_id))
+
     @expose('/sample', methods=['GET'])
     def sample_csv(self):
         return send_from_directory('../data/', 'sample_csv.csv')
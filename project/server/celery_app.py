@@ -2,3 +2,8 @@ from project.server.extensions import init_celery
 
 app = init_celery()
 app.conf.imports = app.conf.imports + ("project.tasks",)
+
+if app.conf.get("TRICOMA_API_URL") and app.conf.get("TRICOMA_SYNC_INTERVAL"):
+    app.conf.beat_schedule = {
+        'sync-tricoma-customers': {'task': 'sync_tricoma_customers', 'schedule': app.conf["TRICOMA_SYNC_INTERVAL"]},
+    }
@@ -0,0 +1,84 @@
+"""
+Materialized ranking of the most ordered devices.
+
+Every completed order increments the score of its devices in a sorted set of the current day.
+The ranking of a window (e.g. the last 30 days) is the union of the daily sets. It is materialized under
+a key of its own and read with a single ZREVRANGE. Completing an order deletes the materialized rankings
+of the day, so the next read rebuilds them from the daily sets. No query touches the orders at request time.
+"""
+import datetime
+import typing
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+BESTSELLER_PREFIX = "bestseller"
+WINDOWS = (30, 90, 365)
+
+
+class Bestsellers(object):
+    """ Ranks the ids of devices by the number of repairs ordered for them """
+
+    def __init__(self, redis_client=None):
+        self.redis_client = redis_client
+        self.window = WINDOWS[0]
+
+    def init_app(self, app):
+        self.window = app.config.get('BESTSELLER_WINDOW', self.window)
+
+    @staticmethod
+    def day_key(day: datetime.date) -> str:
+        return f"{BESTSELLER_PREFIX}:day:{day.isoformat()}"
+
+    @staticmethod
+    def window_key(days: int, today: datetime.date) -> str:
+        return f"{BESTSELLER_PREFIX}:window:{days}:{today.isoformat()}"
+
+    def add(self, counts: typing.Mapping[int, int], day: datetime.date = None) -> None:
+        """ Count the repairs of a completed order per device. Errors are logged, because the order is complete anyway. """
+        if not counts:
+            return
+        day = day or datetime.date.today()
+        key = self.day_key(day)
+        try:
+            pipe = self.redis_client.redis.pipeline()
+            for device_id, quantity in counts.items():
+                pipe.zincrby(key, quantity, device_id)
+            # one extra day, so that the daily set outlives the largest window
+            pipe.expire(key, (max(WINDOWS) + 1) * 24 * 60 * 60)
+            pipe.delete(*(self.window_key(days, datetime.date.today()) for days in WINDOWS))
+            pipe.execute()
+        except RedisError as e:
+            current_app.logger.warning(f"Could not count the bestsellers: {e}")
+
+    def replace(self, counts_per_day: typing.Mapping[datetime.date, typing.Mapping[int, int]]) -> None:
+        """ Replace the daily sets of the largest window, e.g. with counts aggregated from the orders """
+        today = datetime.date.today()
+        days = [today - datetime.timedelta(days=offset) for offset in range(max(WINDOWS))]
+        pipe = self.redis_client.redis.pipeline()
+        pipe.delete(*(self.day_key(day) for day in days), *(self.window_key(window, today) for window in WINDOWS))
+        for day, counts in counts_per_day.items():
+            if not 0 <= (today - day).days < max(WINDOWS):
+                continue
+            for device_id, quantity in counts.items():
+                pipe.zincrby(self.day_key(day), quantity, device_id)
+            pipe.expire(self.day_key(day), (max(WINDOWS) + 1 - (today - day).days) * 24 * 60 * 60)
+        pipe.execute()
+
+    def top(self, limit: int = 5, days: int = None) -> typing.List[int]:
+        """ The ids of the most ordered devices of the last days. Empty if Redis is not reachable. """
+        days = days or self.window
+        today = datetime.date.today()
+        key = self.window_key(days, today)
+        try:
+            redis = self.redis_client.redis
+            ids = redis.zrevrange(key, 0, limit - 1)
+            if not ids:
+                pipe = redis.pipeline()
+                pipe.zunionstore(key, [self.day_key(today - datetime.timedelta(days=offset)) for offset in range(days)])
+                pipe.expire(key, 24 * 60 * 60)
+                pipe.zrevrange(key, 0, limit - 1)
+                ids = pipe.execute()[-1]
+        except RedisError:
+            return []
+        return [int(device_id) for device_id in ids]
@@ -0,0 +1,331 @@
+"""
+Read-only snapshot of the shop catalog.
+
+The storefront only ever reads manufacturers, series, devices, repairs and colors.
+Instead of querying Postgres on every page view, every worker keeps an immutable tree of the catalog in memory.
+The tree is rebuilt as soon as the catalog version in Redis changes.
+The version is bumped automatically whenever a catalog model is committed.
+
+Next to the snapshot every worker keeps a search index for the type-ahead.
+Device changes committed by the worker itself are applied to the index incrementally,
+changes made by other workers cause a rebuild from the snapshot.
+"""
+import calendar
+import functools
+import typing
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from types import MappingProxyType
+
+from redis.exceptions import RedisError
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+
+from project.server.common.search_index import SearchIndex, SearchDocument
+
+CATALOG_VERSION_KEY = "catalog:version"
+CATALOG_MODIFIED_KEY = "catalog:modified"
+
+# Flag that is stored inside session.info as long as a transaction touched the catalog
+_DIRTY_FLAG = "catalog_dirty"
+# Search documents of the devices changed by the current transaction (None means deleted)
+_SEARCH_CHANGES = "catalog_search_changes"
+# Flag for changes that can not be applied to the search index incrementally
+_SEARCH_REBUILD = "catalog_search_rebuild"
+
+
+@dataclass(frozen=True)
+class CatalogColor:
+    id: int
+    name: str
+    color_code: str
+
+    def __str__(self):
+        return self.name
+
+
+@dataclass(frozen=True)
+class CatalogRepair:
+    id: int
+    name: str
+    price: Decimal
+    device_name: str
+    image_path: typing.Optional[str] = None
+
+    def __str__(self):
+        return f"{self.device_name} {self.name}"
+
+
+@dataclass(frozen=True)
+class CatalogDevice:
+    id: int
+    name: str
+    is_tablet: bool
+    series_name: str
+    manufacturer_name: str
+    colors: typing.Tuple[CatalogColor, ...] = ()
+    repairs: typing.Tuple[CatalogRepair, ...] = ()
+    image_path: typing.Optional[str] = None
+
+    def __str__(self):
+        return self.name
+
+
+@dataclass(frozen=True)
+class CatalogSeries:
+    id: int
+    name: str
+    manufacturer_name: str
+    # ordered by order_index with name as a fallback
+    devices: typing.Tuple[CatalogDevice, ...] = ()
+
+    @property
+    def devices_with_repairs(self) -> typing.Tuple[CatalogDevice, ...]:
+        return tuple(device for device in self.devices if device.repairs)
+
+    def __str__(self):
+        return self.name
+
+
+@dataclass(frozen=True)
+class CatalogManufacturer:
+    id: int
+    name: str
+    activated: bool
+    series: typing.Tuple[CatalogSeries, ...] = ()
+    image_path: typing.Optional[str] = None
+
+    def __str__(self):
+        return self.name
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    """ Immutable tree of the catalog. All lookups are keyed by name. """
+    version: int
+    manufacturers: typing.Mapping[str, CatalogManufacturer]
+    series: typing.Mapping[str, CatalogSeries]
+    devices: typing.Mapping[str, CatalogDevice]
+    devices_by_id: typing.Mapping[int, CatalogDevice]
+
+
+@functools.lru_cache(maxsize=None)
+def _catalog_models() -> tuple:
+    from project.server.models import Manufacturer, DeviceSeries, Device, Repair, Color, Image
+    return Manufacturer, DeviceSeries, Device, Repair, Color, Image
+
+
+def _path(image) -> typing.Optional[str]:
+    return image.get_path() if image else None
+
+
+def build_snapshot(version: int) -> CatalogSnapshot:
+    """
+    Build a new snapshot of the whole catalog.
+    This costs a constant number of queries, regardless of the size of the catalog.
+    """
+    from project.server.models import Manufacturer, DeviceSeries, Device
+
+    manufacturers = Manufacturer.query.options(joinedload(Manufacturer.image)).order_by(Manufacturer.id).all()
+    all_series = DeviceSeries.query.order_by(DeviceSeries.id).all()
+    devices = Device.query_profile('detail').order_by(Device.order_index.asc(), Device.name.desc())
+
+    devices_by_series = {}
+    for device in devices:
+        devices_by_series.setdefault(device.series_id, []).append(CatalogDevice(
+            id=device.id,
+            name=device.name,
+            is_tablet=bool(device.is_tablet),
+            series_name=device.series.name,
+            manufacturer_name=device.manufacturer.name,
+            colors=tuple(
+                CatalogColor(id=color.id, name=color.name, color_code=color.color_code) for color in device.colors
+            ),
+            repairs=tuple(
+                CatalogRepair(
+                    id=repair.id,
+                    name=repair.name,
+                    price=repair.price,
+                    device_name=device.name,
+                    image_path=_path(repair.get_image())
+                ) for repair in sorted(device.repairs, key=lambda r: r.id)
+            ),
+            image_path=_path(device.get_image())
+        ))
+
+    series_by_manufacturer = {}
+    for series in all_series:
+        series_by_manufacturer.setdefault(series.manufacturer_id, []).append(CatalogSeries(
+            id=series.id,
+            name=series.name,
+            manufacturer_name=series.manufacturer.name,
+            devices=tuple(devices_by_series.get(series.id, ()))
+        ))
+
+    catalog_manufacturers = [
+        CatalogManufacturer(
+            id=manufacturer.id,
+            name=manufacturer.name,
+            activated=bool(manufacturer.activated),
+            series=tuple(series_by_manufacturer.get(manufacturer.id, ())),
+            image_path=_path(manufacturer.get_image())
+        ) for manufacturer in manufacturers
+    ]
+
+    return CatalogSnapshot(
+        version=version,
+        manufacturers=MappingProxyType({m.name: m for m in catalog_manufacturers}),
+        series=MappingProxyType({s.name: s for m in catalog_manufacturers for s in m.series}),
+        devices=MappingProxyType({d.name: d for m in catalog_manufacturers for s in m.series for d in s.devices}),
+        devices_by_id=MappingProxyType({d.id: d for m in catalog_manufacturers for s in m.series for d in s.devices}),
+    )
+
+
+class Catalog(object):
+    """
+    Holds the catalog snapshot of the current worker.
+
+    The version counter lives in Redis so that all workers notice changes made by other processes.
+    If Redis is not reachable, a process local counter is used instead.
+    """
+
+    def __init__(self, redis_client=None):
+        self.redis_client = redis_client
+        self._snapshot: typing.Optional[CatalogSnapshot] = None
+        self._search_index: typing.Optional[SearchIndex] = None
+        self._local_version = 0
+        self._local_modified = _now()
+
+    def init_app(self, app):
+        self._snapshot = None
+        self._search_index = None
+        if not event.contains(Session, 'after_flush', self._after_flush):
+            event.listen(Session, 'after_flush', self._after_flush)
+            event.listen(Session, 'after_bulk_update', self._after_bulk_operation)
+            event.listen(Session, 'after_bulk_delete', self._after_bulk_operation)
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_rollback', self._after_rollback)
+
+    @property
+    def version(self) -> int:
+        """ The current catalog version """
+        try:
+            remote = self.redis_client.redis.get(CATALOG_VERSION_KEY)
+        except RedisError:
+            return self._local_version
+        return int(remote or 0)
+
+    def stamp(self) -> typing.Tuple[int, datetime]:
+        """ The current catalog version and the time it was bumped """
+        try:
+            version, modified = self.redis_client.redis.mget(CATALOG_VERSION_KEY, CATALOG_MODIFIED_KEY)
+        except RedisError:
+            return self._local_version, self._local_modified
+        if modified is None:
+            return int(version or 0), self._local_modified
+        return int(version or 0), datetime.utcfromtimestamp(int(modified))
+
+    def bump(self) -> int:
+        """ Increment the catalog version which invalidates all snapshots """
+        self._local_version += 1
+        self._local_modified = _now()
+        self._snapshot = None
+        try:
+            pipe = self.redis_client.redis.pipeline()
+            pipe.incr(CATALOG_VERSION_KEY)
+            pipe.set(CATALOG_MODIFIED_KEY, calendar.timegm(self._local_modified.timetuple()))
+            version, _ = pipe.execute()
+            return version
+        except RedisError:
+            return self._local_version
+
+    def get(self) -> CatalogSnapshot:
+        """ Get the snapshot of the catalog. Rebuild it, if the catalog changed in the meantime. """
+        version = self.version
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != version:
+            snapshot = build_snapshot(version)
+            self._snapshot = snapshot
+        return snapshot
+
+    def search_index(self) -> SearchIndex:
+        """ Get the search index of this worker. Build it from the snapshot, if another worker changed the catalog. """
+        version = self.version
+        index = self._search_index
+        if index is None or index.version != version:
+            index = SearchIndex.from_snapshot(self.get())
+            self._search_index = index
+        return index
+
+    @staticmethod
+    def mark_dirty(session) -> None:
+        """ Mark the current transaction as a catalog change. Use this for raw SQL statements. """
+        session.info[_DIRTY_FLAG] = True
+        session.info[_SEARCH_REBUILD] = True
+
+    def _after_flush(self, session, flush_context):
+        models = _catalog_models()
+        manufacturer, series, device = models[:3]
+        changes = session.info.setdefault(_SEARCH_CHANGES, {})
+        dirty = False
+        for objects in (session.new, session.dirty):
+            for obj in objects:
+                if isinstance(obj, device):
+                    changes[obj.id] = _search_document(obj)
+                elif isinstance(obj, (manufacturer, series)):
+                    session.info[_SEARCH_REBUILD] = True
+                dirty = dirty or isinstance(obj, models)
+        for obj in session.deleted:
+            if isinstance(obj, device):
+                changes[obj.id] = None
+            dirty = dirty or isinstance(obj, models)
+        if dirty:
+            session.info[_DIRTY_FLAG] = True
+
+    def _after_bulk_operation(self, context):
+        if issubclass(context.mapper.class_, _catalog_models()):
+            self.mark_dirty(context.session)
+
+    def _after_commit(self, session):
+        changes = session.info.pop(_SEARCH_CHANGES, None)
+        rebuild = session.info.pop(_SEARCH_REBUILD, False)
+        if session.info.pop(_DIRTY_FLAG, False):
+            version = self.bump()
+            self._update_search_index(version, changes, rebuild)
+
+    def _update_search_index(self, version: int, changes: typing.Optional[dict], rebuild: bool) -> None:
+        """ Apply the changes of the last commit, as long as no other worker changed the catalog in the meantime """
+        index = self._search_index
+        if index is None:
+            return
+        if rebuild or index.version != version - 1:
+            self._search_index = None
+            return
+        for device_id, document in (changes or {}).items():
+            if document is None:
+                index.remove(device_id)
+            else:
+                index.add(document)
+        index.version = version
+
+    @staticmethod
+    def _after_rollback(session):
+        session.info.pop(_DIRTY_FLAG, None)
+        session.info.pop(_SEARCH_CHANGES, None)
+        session.info.pop(_SEARCH_REBUILD, None)
+
+
+def _now() -> datetime:
+    # naive UTC like the HTTP dates parsed by werkzeug, which have a resolution of seconds
+    return datetime.utcnow().replace(microsecond=0)
+
+
+def _search_document(device) -> SearchDocument:
+    series = device.series
+    return SearchDocument(
+        id=device.id,
+        name=device.name,
+        series_name=series.name if series else None,
+        manufacturer_name=series.manufacturer.name if series and series.manufacturer else None,
+    )
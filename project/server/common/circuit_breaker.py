@@ -0,0 +1,81 @@
+"""
+Circuit breaker for calls to external services.
+
+After a number of consecutive failures the circuit opens and all calls fail immediately, instead of
+waiting for a timeout of a service that is down anyway. After some time a single trial call is let through
+(half open). The circuit closes again if it succeeds and opens for another period if it fails.
+The state is kept per process.
+"""
+import threading
+import time
+import typing
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(ConnectionError):
+    """ Raised instead of calling a service that is considered to be down """
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 60.0, clock: typing.Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: typing.Optional[float] = None
+        self.trial = False
+        self.total_failures = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        return HALF_OPEN if self.clock() - self.opened_at >= self.reset_timeout else OPEN
+
+    def before_call(self) -> bool:
+        """
+        Raise CircuitOpenError if the call must not be made. Only a single trial call is allowed while half open.
+        Returns True for the trial call. Its caller must call end_trial() when it is done, whatever happened.
+        """
+        with self._lock:
+            state = self.state
+            if state == CLOSED:
+                return False
+            if state == HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            self.rejected += 1
+        raise CircuitOpenError(f"{self.name} is unavailable, retrying in at most {self.reset_timeout:.0f} seconds")
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.failures, self.opened_at, self.trial = 0, None, False
+
+    def end_trial(self) -> None:
+        """ Let the next call be a trial, if the trial call neither succeeded nor failed (e.g. because of a bug) """
+        with self._lock:
+            self.trial = False
+
+    def failed(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.total_failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at, self.trial = self.clock(), False
+
+    def metrics(self) -> dict:
+        retry_in = 0.0 if self.opened_at is None else max(0.0, self.opened_at + self.reset_timeout - self.clock())
+        return {
+            'state': self.state,
+            'retry_in': retry_in,
+            'failures': self.failures,
+            'total_failures': self.total_failures,
+            'rejected': self.rejected,
+        }
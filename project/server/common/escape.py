@@ -1,11 +1,14 @@
 """
 Escape special characters like it's 1990.
 This is needed, because our old ERP system can handle Unicode -.-
-"""
 
-# These are only common names. More complex names or even different languages WILL cause problems.
+All replacements are compiled into a single translation table when the module is imported.
+Pure ASCII strings, by far the most common case, are returned as they are.
+"""
+import unicodedata
 from typing import Dict
 
+# These are only common names. More complex names or even different languages WILL cause problems.
 SPECIAL_CHARS = {
     'ä': 'ae',
     'ü': 'ue',
@@ -13,25 +16,92 @@ SPECIAL_CHARS = {
     'ß': 'ss'
 }
 
+# Lower case letters without a decomposition into ASCII. Upper case letters are derived.
+TRANSLITERATIONS = {
+    # Latin
+    'æ': 'ae', 'œ': 'oe', 'ø': 'o', 'đ': 'd', 'ð': 'd', 'þ': 'th', 'ł': 'l', 'ı': 'i', 'ħ': 'h', 'ŧ': 't', 'ŋ': 'ng', 'ĸ': 'k',
+    # Greek
+    'α': 'a', 'β': 'v', 'γ': 'g', 'δ': 'd', 'ε': 'e', 'ζ': 'z', 'η': 'i', 'θ': 'th', 'ι': 'i', 'κ': 'k', 'λ': 'l', 'μ': 'm',
+    'ν': 'n', 'ξ': 'x', 'ο': 'o', 'π': 'p', 'ρ': 'r', 'σ': 's', 'ς': 's', 'τ': 't', 'υ': 'y', 'φ': 'f', 'χ': 'ch', 'ψ': 'ps',
+    'ω': 'o',
+    # Cyrillic (Russian and Ukrainian)
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l',
+    'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch',
+    'ш': 'sh', 'щ': 'shch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya', 'і': 'i', 'ї': 'yi', 'є': 'ye', 'ґ': 'g',
+}
+
+PUNCTUATION = {
+    '‘': "'", '’': "'", '‚': "'", '‹': "'", '›': "'", '“': '"', '”': '"', '„': '"', '«': '"', '»': '"',
+    '‐': '-', '‑': '-', '‒': '-', '–': '-', '—': '-', '−': '-', '€': 'EUR',
+}
+
+# blocks whose characters are decomposed into ASCII letters and marks (e.g. é = e + ´) if possible
+DECOMPOSED_BLOCKS = (
+    (0x00A0, 0x024F),  # Latin-1 Supplement, Latin Extended-A and B
+    (0x0370, 0x04FF),  # Greek and Cyrillic
+    (0x1E00, 0x1FFF),  # Latin Extended Additional, Greek Extended
+    (0x2000, 0x206F),  # General Punctuation
+    (0xFB00, 0xFB06),  # Latin ligatures
+)
+
+
+def _decompose(char: str, table: Dict[int, str]):
+    """ The replacement of a character that decomposes into ASCII or into characters of the table, otherwise None """
+    parts = []
+    for part in unicodedata.normalize('NFKD', char):
+        if unicodedata.combining(part):
+            continue
+        if part.isascii():
+            parts.append(part)
+        elif ord(part) in table:
+            parts.append(table[ord(part)])
+        else:
+            return None
+    replacement = "".join(parts)
+    return replacement if replacement != char else None
+
+
+def _build_table() -> Dict[int, str]:
+    table = {}
+    for lower, replacement in TRANSLITERATIONS.items():
+        table[ord(lower)] = replacement
+        upper = lower.upper()
+        if len(upper) == 1 and upper != lower:
+            table[ord(upper)] = replacement.title()
+    table.update((ord(char), replacement) for char, replacement in PUNCTUATION.items())
+
+    for first, last in DECOMPOSED_BLOCKS:
+        for codepoint in range(first, last + 1):
+            if codepoint not in table:
+                replacement = _decompose(chr(codepoint), table)
+                if replacement is not None:
+                    table[codepoint] = replacement
+
+    # the special chars win, upper case letters (even ẞ) are replaced like before
+    for lower, replacement in SPECIAL_CHARS.items():
+        for char in {lower, lower.upper(), 'ẞ' if lower == 'ß' else lower}:
+            if len(char) == 1 and char.lower() == lower:
+                table[ord(char)] = replacement.title() if char.isupper() else replacement
+    return table
+
+
+TRANSLATION_TABLE = _build_table()
+
 
 def replace(old: str) -> str:
     """ Check if the char is a special char and return it's replacement"""
     if not len(old) == 1:
         raise ValueError("Expected single character and not a sequence")
-    upper = old.isupper()
-    replacement = SPECIAL_CHARS.get(old.lower(), None)
-    if replacement:
-        return replacement.title() if upper else replacement
-    return old
+    return TRANSLATION_TABLE.get(ord(old), old)
 
 
-def cleanify(string: str):
-    return "".join([replace(char) for char in string])
+def cleanify(string: str) -> str:
+    if string.isascii():
+        return string
+    return string.translate(TRANSLATION_TABLE)
 
 
 def cleanify_dict(params: Dict):
     for k, v in params.items():
-        try:
+        if isinstance(v, str):
             params[k] = cleanify(v)
-        except TypeError:
-            continue
@@ -1,100 +1,499 @@
+"""
+Set based import of repairs from a CSV price list.
+
+The file is read as a stream of bytes and decoded incrementally. Encoding (UTF-8 or Windows-1252) and
+delimiter are detected automatically. All existing manufacturers, series, devices, colors and repairs are
+preloaded into dictionaries with a constant number of queries. The rows are then diffed and written in chunks
+with a handful of bulk statements per chunk inside a single transaction.
+
+A price list can also be previewed: the diff is computed chunk by chunk like an import, but nothing is written.
+The preview ends with a digest of all changes. Importing the same file with that digest writes exactly the
+previewed changes, or rolls back if the database changed in the meantime and the digest does not match.
+"""
+import codecs
 import csv
 import decimal
+import hashlib
+import itertools
+import json
 import logging
+import re
 import typing
-from io import StringIO
+from dataclasses import dataclass, field
 
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm.exc import FlushError
-from flask import flash
+from sqlalchemy import case
+from sqlalchemy.dialects.postgresql import insert
 
 from project.server import db
+from project.server.extensions import catalog
 from project.server.models import Manufacturer, DeviceSeries, Device, Color, Repair
+from project.server.models.device import color_device_table
 
 logger = logging.getLogger(__name__)
 
+HEADER = "Hersteller,Serie,Gerät,Farbe,Reparatur,Preis (in €)"
+DELIMITERS = ",;\t|"
+# Excel on Windows exports CSV files in this encoding. It is a superset of the printable part of ISO-8859-1.
+FALLBACK_ENCODING = "cp1252"
+# the cents of a price and the separators of its thousands
+DECIMALS = re.compile(r'([.,])(\d{1,2})$')
+THOUSANDS = re.compile(r'[.,]')
 
-def import_repairs(repair_file_content: str) -> typing.Tuple[int, str]:
-    string = StringIO(repair_file_content)
-    csv_reader = csv.reader(string, delimiter=',')
-    headers = next(csv_reader)
+# rows of every kind that are kept in the report of an import, the others are only counted
+SAMPLE_SIZE = 200
+CHANGE_KINDS = ('created', 'updated', 'unchanged', 'rejected')
 
-    if not len(headers) == 6:
-        return False, "Es werden genau 6 Spalten benötigt. Herstelle,Serie,Gerät,Farbe,Reparatur,Preis (in €)"
+# A price list is either already decoded or a stream of raw bytes, e.g. the blocks of an upload
+PriceList = typing.Union[str, typing.Iterable[bytes]]
+
+
+class ImportFileError(ValueError):
+    """ The file as a whole can not be imported """
+    pass
+
+
+class StalePreviewError(ImportFileError):
+    """ The database changed since the preview was computed """
+    pass
+
+
+@dataclass(frozen=True)
+class ImportRow:
+    """ A single valid row of the price list """
+    line: int
+    manufacturer: str
+    series: str
+    device: str
+    colors: typing.Tuple[str, ...]
+    repair: str
+    price: decimal.Decimal
+
+    @property
+    def values(self) -> typing.Tuple[str, ...]:
+        return self.manufacturer, self.series, self.device, ",".join(self.colors), self.repair, str(self.price)
+
+    def __str__(self):
+        return f"{self.device} {self.repair}"
+
+
+@dataclass(frozen=True)
+class RejectedRow:
+    line: int
+    values: typing.Tuple[str, ...]
+    reason: str
+
+
+@dataclass(frozen=True)
+class RepairChange:
+    row: ImportRow
+    old_price: typing.Optional[decimal.Decimal] = None
 
-    counter = 0
-    for manufacturer, series, device, repair, color_string, price_str in csv_reader:
-        try:
-            manufacturer = manufacturer_create_or_get(manufacturer)
-            series = series_create_or_get(manufacturer, series)
-            device = device_create_or_get(series, device)
-            colors = get_colors(color_string)
-            price = str_to_dec(price_str)
-
-            if not colors and color_string:
-                return False, f"Farbe {color_string} existiert nicht im System. Bitte wähle eine existierende! Achte darauf, dass der *internal_name* als Name erwartet wird."
-
-            if price is None:
-                return False, f"Der Preis '{price_str}' scheint kein valider Preis zu sein."
-
-            repair = create_new_or_skip_existing(repair, device, price)
-            repair.device.colors = colors
-            repair.save()
-            if repair:
-                counter += 1
-        except (IntegrityError, FlushError,) as e:
-            logger.error(e)
-            print(e)
-            db.session.rollback()
-            continue
-    if counter == 0:
-        return 0, "Keine neuen Reparturen gefunden"
-    return counter, ""
+
+@dataclass
+class ImportReport:
+    """ Diff between the price list and the database """
+    created: typing.List[RepairChange] = field(default_factory=list)
+    updated: typing.List[RepairChange] = field(default_factory=list)
+    unchanged: typing.List[RepairChange] = field(default_factory=list)
+    rejected: typing.List[RejectedRow] = field(default_factory=list)
+    new_manufacturers: typing.List[str] = field(default_factory=list)
+    new_series: typing.List[str] = field(default_factory=list)
+    new_devices: typing.List[str] = field(default_factory=list)
+    unknown_colors: typing.List[str] = field(default_factory=list)
+    # number of rows per kind that are not kept in the lists above
+    omitted: typing.Dict[str, int] = field(default_factory=dict)
+    # of all changes, see RepairImporter.digest
+    digest: typing.Optional[str] = None
+
+    @property
+    def count(self) -> int:
+        """ Number of repairs that were (or will be) created or updated """
+        summary = self.summary()
+        return summary['created'] + summary['updated']
+
+    @property
+    def rows(self) -> typing.List[ImportRow]:
+        return [change.row for change in self.created + self.updated + self.unchanged]
+
+    def extend(self, other: 'ImportReport', sample_size: int = None) -> None:
+        """
+        Add the report of another chunk.
+        With a sample size only the first rows of every kind are kept (and no unchanged ones). The others are counted.
+        """
+        for kind in CHANGE_KINDS:
+            rows = getattr(self, kind) + getattr(other, kind)
+            if kind == 'rejected':
+                rows.sort(key=lambda rejected_row: rejected_row.line)
+            keep = len(rows) if sample_size is None else 0 if kind == 'unchanged' else sample_size
+            setattr(self, kind, rows[:keep])
+            self.omitted[kind] = self.omitted.get(kind, 0) + other.omitted.get(kind, 0) + len(rows[keep:])
+        self.new_manufacturers += other.new_manufacturers
+        self.new_series += other.new_series
+        self.new_devices += other.new_devices
+        self.unknown_colors += [color for color in other.unknown_colors if color not in self.unknown_colors]
+
+    def summary(self) -> typing.Dict[str, int]:
+        return {kind: len(getattr(self, kind)) + self.omitted.get(kind, 0) for kind in CHANGE_KINDS}
+
+    def to_dict(self) -> dict:
+        """ JSON serializable version of the report. Unchanged rows are only counted. """
+        return {
+            **self.summary(),
+            'created_rows': [{'line': c.row.line, 'repair': str(c.row), 'price': str(c.row.price)} for c in self.created],
+            'updated_rows': [
+                {'line': c.row.line, 'repair': str(c.row), 'old_price': str(c.old_price), 'price': str(c.row.price), 'delta': f"{c.row.price - c.old_price:+}"}
+                for c in self.updated
+            ],
+            'rejected_rows': [{'line': r.line, 'values': list(r.values), 'reason': r.reason} for r in self.rejected],
+            'new_manufacturers': self.new_manufacturers,
+            'new_series': self.new_series,
+            'new_devices': self.new_devices,
+            'unknown_colors': self.unknown_colors,
+            'digest': self.digest,
+        }
 
 
 def str_to_dec(price: str) -> typing.Optional[decimal.Decimal]:
+    """
+    Parse a price. The decimal separator is taken from the price itself and not from the delimiter of the file:
+    a '.' or ',' followed by one or two digits at the end, e.g. 69.90, 69,9 or 1.299,90.
+    Other separators must group thousands, like in 1,299.90. A single group without cents (1.299) could be
+    both, so it is rejected instead of guessing a price that is off by a factor of 1000.
+    """
+    price = price.strip(' "')
+    match = DECIMALS.search(price)
+    integer, separator, cents = (price[:match.start()], match.group(1), match.group(2)) if match else (price, '', '')
+    separators = set(THOUSANDS.findall(integer))
+    if separators:
+        groups = THOUSANDS.split(integer)
+        if len(separators) > 1 or separator in separators or not 1 <= len(groups[0].lstrip('-')) <= 3:
+            return None
+        if any(len(group) != 3 for group in groups[1:]) or (not cents and len(groups) == 2):
+            return None
+        integer = "".join(groups)
     try:
-        return decimal.Decimal(price.strip(' "'))
+        return decimal.Decimal(f"{integer}.{cents}" if cents else integer)
     except Exception:
         return None
 
 
-def create_new_or_skip_existing(rep_name: str, device: Device, price: decimal.Decimal) -> typing.Optional[Repair]:
-    repairs: typing.List[Repair] = list(filter(lambda rep: rep.name == rep_name, device.repairs))
-    if not repairs:
-        return Repair.create(name=rep_name, device=device, price=price)
+def decode(blocks: typing.Iterable[bytes]) -> typing.Iterator[str]:
+    """
+    Incrementally decode blocks of bytes. UTF-8 (with or without BOM) is tried first.
+    If the file turns out not to be UTF-8 before any non ASCII character was seen, the rest is decoded as Windows-1252.
+    Both encodings agree on ASCII, so nothing that was already decoded has to be decoded again.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    ascii_only, fallback, first = True, False, True
+    for block in itertools.chain(blocks, [None]):
+        final = block is None
+        pending = decoder.getstate()[0]
+        try:
+            text = decoder.decode(block or b'', final=final)
+        except UnicodeDecodeError:
+            if fallback or not ascii_only:
+                raise ImportFileError("Die Datei ist weder UTF-8 noch Windows-1252 kodiert.")
+            decoder, fallback = codecs.getincrementaldecoder(FALLBACK_ENCODING)(), True
+            try:
+                text = decoder.decode(pending + (block or b''), final=final)
+            except UnicodeDecodeError:
+                raise ImportFileError("Die Datei ist weder UTF-8 noch Windows-1252 kodiert.")
+        if first and text:
+            text, first = text[1:] if text[0] == '\ufeff' else text, False
+        ascii_only = ascii_only and text.isascii()
+        if text:
+            yield text
+
+
+def iter_lines(chunks: typing.Iterable[str]) -> typing.Iterator[str]:
+    """ Split decoded chunks into lines. Line endings are kept, so that the csv module can handle quoted line breaks. """
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
+def sniff_delimiter(header: str) -> str:
+    """ The most frequent delimiter of the header line. Commas win a tie. """
+    return max(DELIMITERS, key=header.count)
+
+
+def iter_rows(lines: typing.Iterable[typing.Sequence[str]], rejected: typing.List[RejectedRow], first_line: int = 2) -> typing.Iterator[ImportRow]:
+    """ Lazily turn raw CSV rows (without the header) into import rows. Rows that can not be parsed are appended to rejected. """
+    for line, values in enumerate(lines, start=first_line):
+        values = tuple(value.strip() for value in values)
+        if not any(values):
+            continue
+        if len(values) != 6:
+            rejected.append(RejectedRow(line, values, "Die Zeile hat nicht genau 6 Spalten."))
+            continue
 
-    # Repair does already exist:
-    rep = repairs[0]
-    if rep.price != price:
-        flash(f"Updating {rep}: Setting price from {rep.price} to {price}")
+        manufacturer, series, device, color_string, repair, price_str = values
+        if not all((manufacturer, series, device, repair)):
+            rejected.append(RejectedRow(line, values, "Hersteller, Serie, Gerät und Reparatur dürfen nicht leer sein."))
+            continue
+
+        price = str_to_dec(price_str)
+        if price is None or not price.is_finite() or price < 0:
+            rejected.append(RejectedRow(line, values, f"Der Preis '{price_str}' scheint kein valider Preis zu sein."))
+            continue
+
+        colors = tuple(color.strip() for color in color_string.split(",") if color.strip())
+        yield ImportRow(line, manufacturer, series, device, colors, repair, price)
+
+
+def parse_rows(lines: typing.Iterable[typing.Sequence[str]], first_line: int = 2) -> typing.Tuple[typing.List[ImportRow], typing.List[RejectedRow]]:
+    """ Turn raw CSV rows (without the header) into import rows. Rows that can not be parsed are rejected. """
+    rejected = []
+    rows = list(iter_rows(lines, rejected, first_line))
+    return rows, rejected
+
+
+def read_csv(price_list: PriceList) -> typing.Tuple[typing.Iterator[ImportRow], typing.List[RejectedRow]]:
+    """
+    Open a price list. Columns: Hersteller,Serie,Gerät,Farbe,Reparatur,Preis
+    The header is checked immediately. The rows are parsed while they are consumed
+    and rows that can not be parsed are appended to the returned list at the same time.
+    """
+    if isinstance(price_list, str):
+        lines = iter_lines([price_list])
     else:
-        logger.info(f"Skipping {rep} because it exists.")
-    return rep
+        lines = iter_lines(decode(price_list))
+    header = next(lines, '')
+    delimiter = sniff_delimiter(header)
+    headers = next(csv.reader([header], delimiter=delimiter), None)
+    if not headers or len(headers) != 6:
+        raise ImportFileError(f"Es werden genau 6 Spalten benötigt. {HEADER}")
+    rejected = []
+    rows = iter_rows(csv.reader(lines, delimiter=delimiter), rejected)
+    return rows, rejected
+
+
+def parse_csv(price_list: PriceList) -> typing.Tuple[typing.List[ImportRow], typing.List[RejectedRow]]:
+    """ Parse a whole price list at once """
+    rows, rejected = read_csv(price_list)
+    return list(rows), rejected
+
+
+class RepairImporter(object):
+    """ Compares import rows with the database and writes the differences """
+
+    def __init__(self, session=None, sample_size: int = SAMPLE_SIZE):
+        self.session = session or db.session
+        self.sample_size = sample_size
+        self.manufacturers: typing.Dict[str, int] = {}
+        self.series: typing.Dict[str, int] = {}
+        self.devices: typing.Dict[str, int] = {}
+        self.colors: typing.Dict[str, int] = {}
+        # (device id, name) -> (id, price, written by this import). The ids of created repairs are not needed.
+        self.repairs: typing.Dict[typing.Tuple[int, str], typing.Tuple[typing.Optional[int], decimal.Decimal, bool]] = {}
+        self.device_colors: typing.Set[typing.Tuple[int, int]] = set()
+        # ids of the manufacturers, series and devices that a preview only pretends to create
+        self._placeholders = itertools.count(-1, -1)
+        self._digests = {name: hashlib.sha256() for name in ('rows', 'new_manufacturers', 'new_series', 'new_devices')}
+
+    def preload(self) -> None:
+        """ Load everything that is needed to compute the diff. One query per table. """
+        query = self.session.query
+        self.manufacturers = dict(query(Manufacturer.name, Manufacturer.id))
+        self.series = dict(query(DeviceSeries.name, DeviceSeries.id))
+        self.devices = dict(query(Device.name, Device.id))
+        self.colors = dict(query(Color.internal_name, Color.id))
+        self.repairs = {
+            (device_id, name): (repair_id, price, False) for repair_id, device_id, name, price in query(Repair.id, Repair.device_id, Repair.name, Repair.price)
+        }
+        self.device_colors = {
+            (device_id, color_id) for device_id, color_id in self.session.query(color_device_table.c.device_id, color_device_table.c.color_id)
+        }
+
+    def diff(self, rows: typing.Iterable[ImportRow], rejected: typing.Iterable[RejectedRow] = ()) -> ImportReport:
+        """ Compute the report without writing anything """
+        report = ImportReport(rejected=list(rejected))
+        # (device, repair) of the rows of this diff. Rows of earlier chunks are marked in self.repairs.
+        seen = set()
+        # dictionaries are ordered sets
+        new_manufacturers, new_series, new_devices, unknown_colors = {}, {}, {}, {}
+        for row in rows:
+            unknown = [color for color in row.colors if color not in self.colors]
+            if unknown:
+                unknown_colors.update(dict.fromkeys(unknown))
+                report.rejected.append(RejectedRow(row.line, row.values, f"Farbe {', '.join(unknown)} existiert nicht im System. Bitte wähle eine existierende! Achte darauf, dass der *internal_name* als Name erwartet wird."))
+                continue
+            existing = self.repairs.get((self.devices.get(row.device), row.repair))
+            if (row.device, row.repair) in seen or (existing is not None and existing[2]):
+                report.rejected.append(RejectedRow(row.line, row.values, f"{row} kommt mehrfach vor."))
+                continue
+            seen.add((row.device, row.repair))
 
+            if row.manufacturer not in self.manufacturers:
+                new_manufacturers[row.manufacturer] = None
+            if row.series not in self.series:
+                new_series[row.series] = None
+            if row.device not in self.devices:
+                new_devices[row.device] = None
 
-def manufacturer_create_or_get(manufacturer: str) -> Manufacturer:
-    manu = Manufacturer.query.filter(Manufacturer.name == manufacturer).first()
-    if not manu:
-        manu = Manufacturer.create(name=manufacturer, activated=True)
+            if existing is None:
+                report.created.append(RepairChange(row))
+            elif existing[1] != row.price:
+                report.updated.append(RepairChange(row, old_price=existing[1]))
+            else:
+                report.unchanged.append(RepairChange(row, old_price=existing[1]))
+        report.new_manufacturers, report.new_series, report.new_devices = list(new_manufacturers), list(new_series), list(new_devices)
+        report.unknown_colors = list(unknown_colors)
+        report.rejected.sort(key=lambda rejected_row: rejected_row.line)
+        return report
 
-    return manu
+    def write(self, report: ImportReport) -> None:
+        """ Write the report with a few bulk statements. The caller is responsible for the commit. """
+        rows = report.rows
+        # a series and a device may share a name, e.g. iPhone SE
+        series_first, device_first = {}, {}
+        for row in rows:
+            series_first.setdefault(row.series, row)
+            device_first.setdefault(row.device, row)
 
+        self._insert_missing(Manufacturer, self.manufacturers, [
+            {'name': name, 'activated': True} for name in report.new_manufacturers
+        ])
+        self._insert_missing(DeviceSeries, self.series, [
+            {'name': name, 'manufacturer_id': self.manufacturers[series_first[name].manufacturer]} for name in report.new_series
+        ])
+        if report.new_devices:
+            # render nextval() inline, otherwise SQLAlchemy fetches every value of the sequence in a query of its own
+            order_index = Device.order_index.default.next_value()
+            self._insert_missing(Device, self.devices, [
+                {'name': name, 'series_id': self.series[device_first[name].series], 'is_tablet': False, 'order_index': order_index}
+                for name in report.new_devices
+            ])
 
-def series_create_or_get(manufacturer: Manufacturer, series_name: str) -> DeviceSeries:
-    series = DeviceSeries.query.filter(DeviceSeries.name == series_name).first()
-    if not series:
-        series = DeviceSeries.create(manufacturer=manufacturer, name=series_name)
-    return series
+        if report.created:
+            self.session.execute(Repair.__table__.insert().values([
+                {'name': change.row.repair, 'price': change.row.price, 'device_id': self.devices[change.row.device]}
+                for change in report.created
+            ]))
+        if report.updated:
+            prices = {self.repairs[(self.devices[change.row.device], change.row.repair)][0]: change.row.price for change in report.updated}
+            self.session.execute(
+                Repair.__table__.update().where(Repair.id.in_(prices)).values(price=case(prices, value=Repair.id))
+            )
 
+        links = {(self.devices[row.device], self.colors[color]) for row in rows for color in row.colors} - self.device_colors
+        if links:
+            self.session.execute(color_device_table.insert().values([
+                {'device_id': device_id, 'color_id': color_id} for device_id, color_id in sorted(links)
+            ]))
+            self.device_colors |= links
 
-def device_create_or_get(series: DeviceSeries, device_name: str) -> Device:
-    device = Device.query.filter(Device.name == device_name).first()
-    if not device:
-        device = Device.create(series=series, name=device_name)
-    return device
+        self._remember(report)
+        # Core statements do not trigger the ORM events
+        catalog.mark_dirty(self.session)
 
+    def pretend(self, report: ImportReport) -> None:
+        """ Remember a chunk like write() does, but without writing anything. New names get placeholder ids. """
+        for known, names in ((self.manufacturers, report.new_manufacturers), (self.series, report.new_series), (self.devices, report.new_devices)):
+            for name in names:
+                known.setdefault(name, next(self._placeholders))
+        self._remember(report)
 
-def get_colors(color: str) -> typing.List[Color]:
-    colors = color.split(",")
-    return Color.query.filter(Color.name.in_(color.strip() for color in colors)).all()
+    def _remember(self, report: ImportReport) -> None:
+        """ Mark the rows of a chunk, so that later chunks reject them as duplicates """
+        for change in report.created + report.updated + report.unchanged:
+            key = (self.devices[change.row.device], change.row.repair)
+            self.repairs[key] = (self.repairs[key][0] if key in self.repairs else None, change.row.price, True)
+
+    @property
+    def digest(self) -> str:
+        """
+        Digest of all changes so far: every created, updated and unchanged row with its old price and all new names.
+        A preview and an import of the same file have the same digest, if and only if they lead to the same changes.
+        """
+        return hashlib.sha256("".join(digest.hexdigest() for digest in self._digests.values()).encode('utf-8')).hexdigest()
+
+    def _digest(self, report: ImportReport) -> None:
+        for change in sorted(report.created + report.updated + report.unchanged, key=lambda c: c.row.line):
+            self._digests['rows'].update(json.dumps([change.row.line, *change.row.values, str(change.old_price)]).encode('utf-8'))
+        for name in ('new_manufacturers', 'new_series', 'new_devices'):
+            for value in getattr(report, name):
+                self._digests[name].update(json.dumps(value).encode('utf-8'))
+
+    def _insert_missing(self, model, known: typing.Dict[str, int], values: typing.List[dict]) -> None:
+        """ INSERT ... ON CONFLICT (name) DO NOTHING and remember the ids of all names """
+        if not values:
+            return
+        table = model.__table__
+        statement = insert(table).values(values).on_conflict_do_nothing(index_elements=['name']).returning(table.c.id, table.c.name)
+        known.update({name: id_ for id_, name in self.session.execute(statement)})
+        # rows that were inserted concurrently by someone else
+        missing = [value['name'] for value in values if value['name'] not in known]
+        if missing:
+            known.update(self.session.query(model.name, model.id).filter(model.name.in_(missing)))
+
+    def run(self, rows: typing.Iterable[ImportRow], rejected: typing.Iterable[RejectedRow] = (), chunk_size: int = 500,
+            progress: typing.Callable[[int, typing.Optional[int], ImportReport], None] = None, dry_run: bool = False) -> ImportReport:
+        """
+        Preload, diff and write the rows in chunks. The caller is responsible for the commit.
+        rows may be a lazy iterator. Only a single chunk of it is held in memory at a time.
+        rejected may be a list that is filled while the rows are parsed. It is emptied after every chunk.
+        The report only keeps a sample of the rows and counts the others, so memory stays flat whatever the file size.
+        progress is called with the number of processed rows, the total (None, if unknown) and the report so far after every chunk.
+        A dry run computes the same report and digest without writing anything.
+        """
+        self.preload()
+        rejected = rejected if isinstance(rejected, list) else list(rejected)
+        total = len(rows) if isinstance(rows, typing.Sized) else None
+        rows, processed, report = iter(rows), 0, ImportReport()
+        while True:
+            chunk_rows = list(itertools.islice(rows, chunk_size))
+            chunk = self.diff(chunk_rows, rejected)
+            rejected.clear()
+            if chunk_rows:
+                self.pretend(chunk) if dry_run else self.write(chunk)
+            self._digest(chunk)
+            report.extend(chunk, self.sample_size)
+            if not chunk_rows:
+                report.digest = self.digest
+                return report
+            processed += len(chunk_rows)
+            if progress:
+                progress(processed, total, report)
+
+
+def preview_repairs(price_list: PriceList, chunk_size: int = 500, progress=None) -> ImportReport:
+    """ Compute the changes of a price list chunk by chunk without writing anything """
+    rows, rejected = read_csv(price_list)
+    try:
+        return RepairImporter().run(rows, rejected, chunk_size=chunk_size, progress=progress, dry_run=True)
+    finally:
+        db.session.rollback()
+
+
+def import_repairs(price_list: PriceList, chunk_size: int = 500, progress=None, digest: str = None) -> ImportReport:
+    """
+    Import a price list in a single transaction. Only a single chunk of rows is held in memory at a time.
+    With the digest of a preview, the import is rolled back unless it made exactly the previewed changes.
+    """
+    rows, rejected = read_csv(price_list)
+
+    def write(importer: RepairImporter) -> ImportReport:
+        report = importer.run(rows, rejected, chunk_size=chunk_size, progress=progress)
+        if digest is not None and report.digest != digest:
+            raise StalePreviewError("Die Daten haben sich seit der Vorschau geändert. Bitte lade die Datei erneut hoch.")
+        return report
+
+    return _commit(write)
+
+
+def _commit(write: typing.Callable[[RepairImporter], ImportReport]) -> ImportReport:
+    try:
+        report = write(RepairImporter())
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    summary = report.summary()
+    logger.info(f"Imported repairs: {summary['created']} created, {summary['updated']} updated, {summary['rejected']} rejected")
+    return report
@@ -0,0 +1,129 @@
+"""
+Time decayed popularity of devices and repairs.
+
+Scores decay exponentially, so old bestsellers fade out after a few half-lives. Stored scores are never decayed.
+Every event is weighted with 2 ** ((t - start) / half-life) instead ("forward decay"). The decay of all scores
+at any later time is the same factor, so the order of a sorted set is always the order of the decayed scores.
+The top K are read with a single ZREVRANGE. Divide a stored score by the weight of now to get its decayed value.
+The weights would grow without limit, so time is split into periods of PERIOD half-lives with a sorted set each.
+The scores of the last period are carried over once, scaled down to the start of the new period.
+No weight ever exceeds 2 ** PERIOD, whatever the half-life.
+"""
+import datetime
+import typing
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+POPULARITY_PREFIX = "popularity"
+DEVICE = "device"
+REPAIR = "repair"
+EPOCH = datetime.datetime(2020, 1, 1)
+# length of a period in half-lives
+PERIOD = 32
+# a completed order counts much more than a page view
+ORDER_WEIGHT = 1.0
+VIEW_WEIGHT = 0.05
+
+
+class Popularity(object):
+    """ Exponentially decayed scores per device and per repair, fed by completed orders and page views """
+
+    def __init__(self, redis_client=None):
+        self.redis_client = redis_client
+        self.half_life = datetime.timedelta(days=30)
+        self.count_views = False
+        # the periods this process already started, per kind
+        self._started = {}
+
+    def init_app(self, app):
+        days = app.config.get('POPULARITY_HALF_LIFE_DAYS', self.half_life.days)
+        if not isinstance(days, int) or days < 1:
+            raise ValueError(f"POPULARITY_HALF_LIFE_DAYS must be a whole number of days and at least 1, not {days!r}")
+        self.half_life = datetime.timedelta(days=days)
+        self.count_views = app.config.get('POPULARITY_VIEWS', self.count_views)
+
+    def period(self) -> int:
+        """ The current period """
+        return (datetime.datetime.now() - EPOCH) // (self.half_life * PERIOD)
+
+    def key(self, kind: str, period: int) -> str:
+        # a different half-life weights differently, so its scores are never mixed with the old ones
+        return f"{POPULARITY_PREFIX}:{kind}:{self.half_life.days}:{period}"
+
+    def weight(self, now: datetime.datetime = None, period: int = None) -> float:
+        """ Weight of an event that happens now, relative to the start of the (current) period """
+        now = now or datetime.datetime.now()
+        period = self.period() if period is None else period
+        return 2 ** ((now - EPOCH - period * PERIOD * self.half_life) / self.half_life)
+
+    def _start(self, kind: str, period: int) -> str:
+        """
+        The key of the (current) period.
+        The first process that needs it merges the scores of the last period into it.
+        """
+        key = self.key(kind, period)
+        if self._started.get(kind) == period:
+            return key
+        redis = self.redis_client.redis
+        if redis.set(f"{key}:started", 1, nx=True, ex=2 * PERIOD * int(self.half_life.total_seconds())):
+            previous = self.key(kind, period - 1)
+            pipe = redis.pipeline()
+            # merge instead of copy, so that scores added meanwhile by other processes are kept
+            pipe.zunionstore(key, {key: 1, previous: 2.0 ** -PERIOD})
+            pipe.delete(previous)
+            pipe.execute()
+        self._started[kind] = period
+        return key
+
+    def add(self, counts: typing.Mapping[str, typing.Mapping[int, float]], now: datetime.datetime = None) -> None:
+        """ Add the counts per kind and id. Errors are logged, because popularity is never worth a failed request. """
+        try:
+            period = self.period()
+            keys = {kind: self._start(kind, period) for kind in counts}
+            weight = self.weight(now, period)
+            pipe = self.redis_client.redis.pipeline()
+            for kind, scores in counts.items():
+                for member, score in scores.items():
+                    pipe.zincrby(keys[kind], score * weight, member)
+            pipe.execute()
+        except RedisError as e:
+            current_app.logger.warning(f"Could not update the popularity: {e}")
+
+    def add_order(self, repairs: typing.Iterable[typing.Tuple[int, int]], now: datetime.datetime = None) -> None:
+        """ Count the ordered repairs, given as (device id, repair id), for their devices and themselves """
+        counts = {DEVICE: {}, REPAIR: {}}
+        for device_id, repair_id in repairs:
+            counts[DEVICE][device_id] = counts[DEVICE].get(device_id, 0) + ORDER_WEIGHT
+            counts[REPAIR][repair_id] = counts[REPAIR].get(repair_id, 0) + ORDER_WEIGHT
+        self.add(counts, now)
+
+    def add_view(self, device_id: int) -> None:
+        """ Count a view of the page of a device, if views are enabled """
+        if self.count_views:
+            self.add({DEVICE: {device_id: VIEW_WEIGHT}})
+
+    def replace(self, kind: str, events: typing.Iterable[typing.Tuple[datetime.datetime, int, float]]) -> None:
+        """ Replace all scores of a kind with the given events (time, id, count), e.g. recounted from the orders """
+        period = self.period()
+        key = self.key(kind, period)
+        scores = {}
+        for time, member, count in events:
+            scores[member] = scores.get(member, 0) + count * self.weight(time, period)
+        pipe = self.redis_client.redis.pipeline()
+        pipe.delete(key, self.key(kind, period - 1))
+        if scores:
+            pipe.zadd(key, scores)
+        pipe.set(f"{key}:started", 1, ex=2 * PERIOD * int(self.half_life.total_seconds()))
+        pipe.execute()
+        self._started[kind] = period
+
+    def top(self, kind: str, limit: int = 5, now: datetime.datetime = None) -> typing.List[typing.Tuple[int, float]]:
+        """ The ids of the most popular devices or repairs with their decayed scores. Empty if Redis is not reachable. """
+        period = self.period()
+        try:
+            members = self.redis_client.redis.zrevrange(self._start(kind, period), 0, limit - 1, withscores=True)
+        except RedisError:
+            return []
+        weight = self.weight(now, period)
+        return [(int(member), score / weight) for member, score in members]
@@ -0,0 +1,46 @@
+"""
+Pricing of orders.
+
+All amounts are Decimals rounded to cents (half up, like Postgres' round()).
+Prices include taxes. The discount is 20 percent of the cheapest repair, if more than one repair is ordered.
+"""
+import decimal
+import typing
+from dataclasses import dataclass
+
+CENT = decimal.Decimal('0.01')
+ZERO = decimal.Decimal('0.00')
+DISCOUNT_RATE = decimal.Decimal('0.20')
+TAX_RATE = decimal.Decimal('0.19')
+
+
+def to_cents(amount: decimal.Decimal) -> decimal.Decimal:
+    return decimal.Decimal(amount).quantize(CENT, rounding=decimal.ROUND_HALF_UP)
+
+
+@dataclass(frozen=True)
+class PriceBreakdown:
+    """ Immutable price of an order """
+    subtotal: decimal.Decimal = ZERO
+    discount: decimal.Decimal = ZERO
+    total: decimal.Decimal = ZERO
+    tax: decimal.Decimal = ZERO
+
+    @classmethod
+    def from_prices(cls, prices: typing.Iterable[decimal.Decimal]) -> 'PriceBreakdown':
+        """ Compute the breakdown in a single pass over the prices of the repairs """
+        count, subtotal, cheapest = 0, ZERO, None
+        for price in prices:
+            price = decimal.Decimal(price or 0)
+            count += 1
+            subtotal += price
+            cheapest = price if cheapest is None else min(cheapest, price)
+        return cls.from_aggregates(count, subtotal, cheapest)
+
+    @classmethod
+    def from_aggregates(cls, count: int, subtotal: decimal.Decimal, cheapest: typing.Optional[decimal.Decimal]) -> 'PriceBreakdown':
+        """ Compute the breakdown from the number of repairs and the sum and minimum of their prices """
+        subtotal = to_cents(subtotal or 0)
+        discount = to_cents(cheapest * DISCOUNT_RATE) if count > 1 else ZERO
+        total = subtotal - discount
+        return cls(subtotal=subtotal, discount=discount, total=total, tax=to_cents(total * TAX_RATE))
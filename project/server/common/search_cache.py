@@ -0,0 +1,54 @@
+"""
+Redis cache for device search results.
+
+Customers search for the same devices over and over again ("iphone 11", "iPhone 11 ", "IPHONE 11").
+Queries are normalized before they are used as a key, so all of them share a single entry.
+Every key contains the catalog version. Creating, renaming, merging or importing devices bumps the version,
+which makes all stale entries unreachable. They simply expire afterwards.
+"""
+import json
+import re
+import typing
+
+from redis.exceptions import RedisError
+
+from project.server.common.escape import cleanify
+
+SEARCH_CACHE_PREFIX = "search"
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(q: str) -> str:
+    """ Case fold, collapse whitespace and map umlauts: ' IPHONE  Größe' -> 'iphone groesse' """
+    return cleanify(_WHITESPACE.sub(" ", q).strip().casefold())
+
+
+class SearchCache(object):
+    """ Caches the ids of matching devices (and the total number of hits) per normalized query """
+
+    def __init__(self, redis_client=None, catalog=None):
+        self.redis_client = redis_client
+        self.catalog = catalog
+        self.timeout = 60 * 60
+
+    def init_app(self, app):
+        self.timeout = app.config.get('SEARCH_CACHE_TIMEOUT', self.timeout)
+
+    def key(self, kind: str, q: str, *params) -> str:
+        parts = (SEARCH_CACHE_PREFIX, str(self.catalog.version), kind, *map(str, params), normalize_query(q))
+        return ":".join(parts)
+
+    def get(self, key: str) -> typing.Optional[dict]:
+        """ Get a cached entry. Returns None if there is none or if Redis is not reachable. """
+        try:
+            raw = self.redis_client.redis.get(key)
+        except RedisError:
+            return None
+        return json.loads(raw) if raw else None
+
+    def set(self, key: str, value: dict) -> None:
+        try:
+            self.redis_client.redis.setex(key, self.timeout, json.dumps(value))
+        except RedisError:
+            pass
@@ -0,0 +1,164 @@
+"""
+In-process search index for the device type-ahead.
+
+The trigrams are built like pg_trgm builds them, so the similarity of a device name
+is the same as SIMILARITY(name, 'X') in Postgres. This makes it possible to answer
+type-ahead requests without a round trip to the database while keeping the ranking
+of Device.search_order_by_similarity.
+"""
+import bisect
+import typing
+from collections import namedtuple
+
+# Default of pg_trgm.similarity_threshold which is used by the % operator
+SIMILARITY_THRESHOLD = 0.3
+
+SearchDocument = namedtuple('SearchDocument', ['id', 'name', 'series_name', 'manufacturer_name'])
+
+
+def words(text: str) -> typing.List[str]:
+    """ Split a text into lower case words. Every non alphanumeric character is a separator. """
+    result, current = [], []
+    for char in text.lower():
+        if char.isalnum():
+            current.append(char)
+        elif current:
+            result.append("".join(current))
+            current = []
+    if current:
+        result.append("".join(current))
+    return result
+
+
+def trigrams(text: str) -> typing.FrozenSet[str]:
+    """ Same as SHOW_TRGM(text): every word is padded with two spaces in front and one at the end """
+    grams = set()
+    for word in words(text):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def similarity(a: typing.FrozenSet[str], b: typing.FrozenSet[str]) -> float:
+    """ Same as SIMILARITY(a, b) but for precomputed trigram sets """
+    if not a or not b:
+        return 0.0
+    common = len(a & b)
+    return common / (len(a) + len(b) - common)
+
+
+class SearchIndex(object):
+    """
+    Inverted trigram index over device names plus a prefix index over the words
+    of the device, series and manufacturer names.
+    """
+
+    def __init__(self, documents: typing.Iterable[SearchDocument] = (), version=None):
+        self.version = version
+        self._documents: typing.Dict[int, SearchDocument] = {}
+        self._trigrams: typing.Dict[int, typing.FrozenSet[str]] = {}
+        self._postings: typing.Dict[str, typing.Set[int]] = {}
+        self._words: typing.Dict[str, typing.Set[int]] = {}
+        self._sorted_words: typing.List[str] = []
+        for document in documents:
+            self.add(document)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        documents = (
+            SearchDocument(device.id, device.name, device.series_name, device.manufacturer_name)
+            for device in snapshot.devices.values()
+        )
+        return cls(documents, version=snapshot.version)
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, device_id):
+        return device_id in self._documents
+
+    def add(self, document: SearchDocument) -> None:
+        """ Add or replace a single document """
+        if document.id in self._documents:
+            self.remove(document.id)
+
+        grams = trigrams(document.name or "")
+        self._documents[document.id] = document
+        self._trigrams[document.id] = grams
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(document.id)
+        for word in self._document_words(document):
+            ids = self._words.get(word)
+            if ids is None:
+                ids = self._words[word] = set()
+                bisect.insort(self._sorted_words, word)
+            ids.add(document.id)
+
+    def remove(self, device_id: int) -> None:
+        """ Remove a document. Unknown ids are ignored. """
+        document = self._documents.pop(device_id, None)
+        if document is None:
+            return
+        for gram in self._trigrams.pop(device_id):
+            ids = self._postings[gram]
+            ids.discard(device_id)
+            if not ids:
+                del self._postings[gram]
+        for word in self._document_words(document):
+            ids = self._words[word]
+            ids.discard(device_id)
+            if not ids:
+                del self._words[word]
+                del self._sorted_words[bisect.bisect_left(self._sorted_words, word)]
+
+    def search(self, q: str, limit: int = 15, offset: int = 0, prefix: bool = True,
+               popularity: typing.Mapping[int, float] = None) -> typing.Tuple[int, typing.List[SearchDocument]]:
+        """
+        Return the total number of hits and the requested page.
+        Trigram hits are ranked like Device.search_order_by_similarity.
+        Prefix hits (e.g. 'sams gal') are appended afterwards.
+        Hits with the same score are ordered by their popularity (by device id), if given.
+        """
+        popularity = popularity or {}
+        grams = trigrams(q)
+        candidates = set()
+        for gram in grams:
+            candidates |= self._postings.get(gram, set())
+
+        scored = []
+        for device_id in candidates:
+            score = similarity(self._trigrams[device_id], grams)
+            if score >= SIMILARITY_THRESHOLD:
+                scored.append((-score, -popularity.get(device_id, 0), self._documents[device_id].name, device_id))
+        scored.sort()
+        hits = [device_id for *_, device_id in scored]
+
+        if prefix:
+            seen = set(hits)
+            prefixed = [
+                (-similarity(self._trigrams[device_id], grams), -popularity.get(device_id, 0), self._documents[device_id].name, device_id)
+                for device_id in self._prefix_matches(q) if device_id not in seen
+            ]
+            prefixed.sort()
+            hits.extend(device_id for *_, device_id in prefixed)
+
+        return len(hits), [self._documents[device_id] for device_id in hits[offset:offset + limit]]
+
+    def _prefix_matches(self, q: str) -> typing.Set[int]:
+        """ Every word of the query has to be the prefix of a word of the document """
+        result = None
+        for query_word in words(q):
+            ids = set()
+            start = bisect.bisect_left(self._sorted_words, query_word)
+            for word in self._sorted_words[start:]:
+                if not word.startswith(query_word):
+                    break
+                ids |= self._words[word]
+            result = ids if result is None else result & ids
+            if not result:
+                return set()
+        return result or set()
+
+    @staticmethod
+    def _document_words(document: SearchDocument) -> typing.Set[str]:
+        return set(words(f"{document.manufacturer_name or ''} {document.series_name or ''} {document.name or ''}"))
@@ -1,10 +1,17 @@
+import json
+import os
+import socket
+import time
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
 from typing import Optional, Iterable, Any
 
 import requests as r
+from redis.exceptions import RedisError
+from requests.adapters import HTTPAdapter
 
+from project.server.common.circuit_breaker import CircuitBreaker
 from project.server.common.escape import cleanify_dict
 
 CUSTOMER_KEY_MAPPING = [
@@ -44,6 +51,11 @@ CUSTOMER_TRICOMA_GROUP = ("110", "Price-Picker")
 
 TRICOMA_DATE_FMT = "%Y-%m-%d - %H:%M:%S"
 
+# the metrics of every process that talks to Tricoma, e.g. tricoma:metrics:worker-1:42
+METRICS_KEY = "tricoma:metrics:{}"
+# processes that did not call Tricoma for this long disappear from the metrics
+METRICS_TIMEOUT = 60 * 60
+
 
 @dataclass
 class TricomaCustomer(object):
@@ -90,17 +102,47 @@ def extract_customer_data(html_text) -> list:
 
 
 class TricomaAPI(object):
+    """
+    All requests share a pooled session, so that connections to Tricoma are kept alive.
+    Reading requests are retried with an exponential backoff. Requests that write to Tricoma are never retried,
+    because a request that timed out may have been processed anyway. A circuit breaker fails fast while Tricoma is down.
+    The breaker and the pool live in the process that makes the requests, usually a Celery worker.
+    So every process publishes its metrics to Redis after each request.
+    """
 
-    def __init__(self, base_url: Optional[str] = None):
+    def __init__(self, base_url: Optional[str] = None, connect_timeout: float = 3.05, read_timeout: float = 30, retries: int = 2,
+                 backoff: float = 0.5, pool_size: int = 10, failure_threshold: int = 5, reset_timeout: float = 60, redis_client=None):
+        self.redis_client = redis_client
         self.base_url = None
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.session = None
+        self.adapter = None
+        self.breaker = CircuitBreaker("Tricoma", failure_threshold, reset_timeout)
         if base_url:
             self.init(base_url)
 
     def init_app(self, app):
-        self.init(app.config.get('TRICOMA_API_URL'))
+        conf = app.config
+        self.timeout = (conf.get('TRICOMA_CONNECT_TIMEOUT', self.timeout[0]), conf.get('TRICOMA_READ_TIMEOUT', self.timeout[1]))
+        self.retries = conf.get('TRICOMA_RETRIES', self.retries)
+        self.backoff = conf.get('TRICOMA_BACKOFF', self.backoff)
+        self.pool_size = conf.get('TRICOMA_POOL_SIZE', self.pool_size)
+        self.breaker = CircuitBreaker(
+            "Tricoma", conf.get('TRICOMA_BREAKER_THRESHOLD', self.breaker.failure_threshold), conf.get('TRICOMA_BREAKER_RESET', self.breaker.reset_timeout)
+        )
+        self.init(conf.get('TRICOMA_API_URL'))
 
     def init(self, base_url):
         self.base_url = base_url
+        if self.session is not None:
+            self.session.close()
+        self.session = r.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
 
     @property
     def is_connected(self) -> bool:
@@ -113,13 +155,78 @@ class TricomaAPI(object):
         if not self.is_connected:
             raise ValueError("This API is not properly set up. Please set the TRICOMA_API_URL in you environment!")
 
-    def _get_request(self, params, cleanup_string=True) -> Optional[int]:
+    def _request(self, params=None, idempotent: bool = True) -> r.Response:
+        """
+        GET the API through the circuit breaker. Connection errors, timeouts and server errors count as failures.
+        Idempotent requests are retried on failure.
+        """
+        attempts = 1 + (self.retries if idempotent else 0)
+        try:
+            for attempt in range(attempts):
+                trial = self.breaker.before_call()
+                try:
+                    resp = self.session.get(self.base_url, params=params, timeout=self.timeout)
+                    if resp.status_code >= 500:
+                        raise r.HTTPError(f"Tricoma answered with {resp.status_code}", response=resp)
+                except r.RequestException:
+                    self.breaker.failed()
+                    if attempt == attempts - 1:
+                        raise
+                    time.sleep(self.backoff * 2 ** attempt)
+                else:
+                    self.breaker.succeeded()
+                    return resp
+                finally:
+                    if trial:
+                        self.breaker.end_trial()
+        finally:
+            self.publish_metrics()
+
+    def metrics(self) -> dict:
+        """ State of the circuit breaker and of the connection pool """
+        pools = self.adapter.poolmanager.pools if self.adapter else {}
+        pools = [pools[key] for key in pools.keys()]
+        return {
+            'breaker': self.breaker.metrics(),
+            'pool': {
+                'size': self.pool_size,
+                'hosts': len(pools),
+                'opened': sum(pool.num_connections for pool in pools),
+                'requests': sum(pool.num_requests for pool in pools),
+                'idle': sum(pool.pool.qsize() for pool in pools if pool.pool is not None),
+            },
+        }
+
+    def publish_metrics(self) -> None:
+        """ Store the metrics of this process in Redis. Metrics are never worth a failed request. """
+        if self.redis_client is None:
+            return
+        key = METRICS_KEY.format(f"{socket.gethostname()}:{os.getpid()}")
+        try:
+            self.redis_client.redis.setex(key, METRICS_TIMEOUT, json.dumps({**self.metrics(), 'updated': time.time()}))
+        except RedisError:
+            pass
+
+    def published_metrics(self) -> dict:
+        """ The metrics of all processes that recently called Tricoma, by host and pid """
+        redis = self.redis_client.redis
+        prefix = METRICS_KEY.format('')
+        metrics = {}
+        for key in redis.scan_iter(match=METRICS_KEY.format('*')):
+            key = key.decode('utf-8') if isinstance(key, bytes) else key
+            value = redis.get(key)
+            # the key may have expired in between
+            if value is not None:
+                metrics[key[len(prefix):]] = json.loads(value)
+        return metrics
+
+    def _get_request(self, params, cleanup_string=True, idempotent=False) -> Optional[int]:
         """ Make a GET request and return customer id on success"""
         self._assert_connected()
         if cleanup_string:
             cleanify_dict(params)
         try:
-            resp = r.get(self.base_url, params=params)
+            resp = self._request(params=params, idempotent=idempotent)
             customer_id = int(resp.text)
             return customer_id
         except ValueError:
@@ -130,7 +237,7 @@ class TricomaAPI(object):
         Test the connection to Tricoma.
         """
         try:
-            resp = r.get(self.base_url)
+            resp = self._request()
             return resp.status_code == 200 and len(resp.text) > 0
         except Exception:
             return False
@@ -151,7 +258,7 @@ class TricomaAPI(object):
         self._assert_connected()
         params = {'modul': 'kunden', 'modulkat': 'allekunden'}
         try:
-            resp = r.get(self.base_url, params=params)
+            resp = self._request(params=params)
             # ID|Anlagedatum|gesperrt|Benutzername
             return extract_customer_data(resp.text)
         except ValueError:
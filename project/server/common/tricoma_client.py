@@ -1,31 +1,67 @@
+import contextlib
 import functools
+import itertools
 import sys
-from typing import Iterable, Optional
+from typing import Iterable, Iterator, List, NamedTuple, Optional
 
 import requests as r
 
 from project.server.common.tricoma_api import TricomaCustomer
 
+# number of columns of the standard customer export:
+# ID|Anrede|Nachname|Vorname|Firma|Strasse|PLZ|Ort|Land|Email|Telefon|Fax|Kategorie|
+EXPORT_COLUMNS = 11
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+class ExportedCustomer(NamedTuple):
+    """ A single row of the customer export. Tuples are small enough to handle a whole export. """
+    id: str
+    name: str
+    vorname: str
+    strasse: str
+    plz: str
+    ort: str
+    mail: str
+    telefon: str
+
+    def to_tricoma_customer(self) -> TricomaCustomer:
+        return TricomaCustomer(**self._asdict())
+
+
+def parse_customers(lines: Iterable[str]) -> Iterator[ExportedCustomer]:
+    """ Lazily parse the lines of a customer export. The header is skipped, incomplete rows are reported and skipped. """
+    for number, line in enumerate(itertools.islice(lines, 1, None), start=2):
+        if not line.strip():
+            continue
+        customer = line.split('|')
+        if len(customer) < EXPORT_COLUMNS:
+            print(f"Skipping incomplete customer in line {number}: {line!r}", file=sys.stderr)
+            continue
+        yield ExportedCustomer(
+            id=customer[0],
+            name=customer[2],
+            vorname=customer[3],
+            strasse=customer[5],
+            plz=customer[6],
+            ort=customer[7],
+            mail=customer[9],
+            telefon=customer[10]
+        )
+
+
+def batched(customers: Iterable[ExportedCustomer], size: int) -> Iterator[List[ExportedCustomer]]:
+    """ Group a stream of customers into lists of at most size customers """
+    customers = iter(customers)
+    while True:
+        batch = list(itertools.islice(customers, size))
+        if not batch:
+            return
+        yield batch
+
 
 def extract_customers(raw_data: str) -> Optional[Iterable[TricomaCustomer]]:
-    customers = []
-    try:
-        for customer in raw_data.splitlines()[1:]:
-            customer = customer.split('|')
-            customers.append(
-                TricomaCustomer(
-                    id=customer[0],
-                    name=customer[2],
-                    vorname=customer[3],
-                    strasse=customer[5],
-                    plz=customer[6],
-                    ort=customer[7],
-                    mail=customer[9],
-                    telefon=customer[10]
-                ))
-    except IndexError as e:
-        print(str(e), file=sys.stderr)
-    return customers
+    return [customer.to_tricoma_customer() for customer in parse_customers(raw_data.splitlines())]
 
 
 def prepare_request(func):
@@ -74,8 +110,8 @@ class TricomaClient(object):
             self.login(self.username, self.password)
 
     @prepare_request
-    def post(self, url, data, allow_redirects=True, headers=None) -> Optional[r.Response]:
-        return self.session.post(url, data=data, allow_redirects=allow_redirects, headers=headers, timeout=None)
+    def post(self, url, data, allow_redirects=True, headers=None, stream=False) -> Optional[r.Response]:
+        return self.session.post(url, data=data, allow_redirects=allow_redirects, headers=headers, timeout=None, stream=stream)
 
     def login(self, username, password) -> Optional[r.Response]:
         if not username or not password:
@@ -96,7 +132,7 @@ class TricomaClient(object):
         self.authorised = response.status_code == 200
         return response
 
-    def export_customers(self, kn=0) -> Optional[r.Response]:
+    def export_customers(self, kn=0, stream=False) -> Optional[r.Response]:
         url = self.base_url + '/cmssystem/kunden/export_laden.php'
         headers = {
             'Sec-Fetch-Dest': 'iframe',
@@ -112,5 +148,16 @@ class TricomaClient(object):
             'modul': 'kunden',
             'submit_csv': ''
         }
-        response = self.post(url, data=params, headers=headers)
+        response = self.post(url, data=params, headers=headers, stream=stream)
         return response
+
+    def stream_customers(self, kn=0) -> Iterator[ExportedCustomer]:
+        """
+        Parse the customer export while it is downloaded. Only a chunk of the export is held in memory at any time.
+        The connection is released when the generator is exhausted or closed.
+        """
+        response = self.export_customers(kn, stream=True)
+        with contextlib.closing(response):
+            # without an encoding iter_lines would yield bytes
+            response.encoding = response.encoding or 'utf-8'
+            yield from parse_customers(response.iter_lines(EXPORT_CHUNK_SIZE, decode_unicode=True))
@@ -30,7 +30,21 @@ class BaseConfig(object):
     TRICOMA_USERNAME = os.getenv("TRICOMA_USERNAME")
     TRICOMA_PASSWORD = os.getenv("TRICOMA_PASSWORD")
     TRICOMA_API_URL = os.getenv("TRICOMA_API_URL")
+    # seconds; reading requests are retried with a backoff of 0.5, 1, ... seconds
+    TRICOMA_CONNECT_TIMEOUT = float(os.getenv("TRICOMA_CONNECT_TIMEOUT", 3.05))
+    TRICOMA_READ_TIMEOUT = float(os.getenv("TRICOMA_READ_TIMEOUT", 30))
+    TRICOMA_RETRIES = int(os.getenv("TRICOMA_RETRIES", 2))
+    TRICOMA_BACKOFF = float(os.getenv("TRICOMA_BACKOFF", 0.5))
+    TRICOMA_POOL_SIZE = int(os.getenv("TRICOMA_POOL_SIZE", 10))
+    # fail fast for a minute after five failed requests in a row
+    TRICOMA_BREAKER_THRESHOLD = int(os.getenv("TRICOMA_BREAKER_THRESHOLD", 5))
+    TRICOMA_BREAKER_RESET = float(os.getenv("TRICOMA_BREAKER_RESET", 60))
     REGISTER_CUSTOMER_IN_TRICOMA = os.getenv("REGISTER_CUSTOMER_IN_TRICOMA", False)
+    # new customers are collected for some seconds and registered in batches
+    TRICOMA_REGISTER_DELAY = float(os.getenv("TRICOMA_REGISTER_DELAY", 10))
+    TRICOMA_REGISTER_BATCH_SIZE = int(os.getenv("TRICOMA_REGISTER_BATCH_SIZE", 100))
+    # seconds between two syncs of new Tricoma customers, 0 disables the sync
+    TRICOMA_SYNC_INTERVAL = int(os.getenv("TRICOMA_SYNC_INTERVAL", 15 * 60))
 
     # Mail
     MAIL_USERNAME = os.getenv("MAIL_USERNAME")
@@ -63,6 +77,21 @@ class BaseConfig(object):
     CACHE_TYPE = os.getenv("CACHE_TYPE", "simple")
     CACHE_DEFAULT_TIMEOUT = 300
     CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", REDIS_URL)
+    # Fragments are keyed by the catalog version, the timeout only removes unreachable ones
+    FRAGMENT_CACHE_TIMEOUT = int(os.getenv("FRAGMENT_CACHE_TIMEOUT", 24 * 60 * 60))
+    # Part of the ETag of the catalog pages. Set it on every deploy to invalidate browser caches.
+    RELEASE = os.getenv("RELEASE")
+
+    # Repair import
+    IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 500))
+    IMPORT_UPLOAD_TIMEOUT = 24 * 60 * 60
+    IMPORT_RESULT_TIMEOUT = 7 * 24 * 60 * 60
+    SEARCH_CACHE_TIMEOUT = int(os.getenv("SEARCH_CACHE_TIMEOUT", 60 * 60))
+    # Bestsellers of the last 30, 90 or 365 days
+    BESTSELLER_WINDOW = int(os.getenv("BESTSELLER_WINDOW", 30))
+    # Popularity of devices and repairs halves every 30 days. Page views of devices are counted as well if enabled.
+    POPULARITY_HALF_LIFE_DAYS = int(os.getenv("POPULARITY_HALF_LIFE_DAYS", 30))
+    POPULARITY_VIEWS = os.getenv("POPULARITY_VIEWS", "false").lower() == "true"
 
 
 class DevelopmentConfig(BaseConfig):
@@ -12,7 +12,11 @@ from raider_reporter.reporter import RaiderReporter
 from sentry_sdk.integrations.flask import FlaskIntegration
 from vigil_reporter.reporter import VigilReporter, RequestFailedError
 
+from project.server.common.bestsellers import Bestsellers
+from project.server.common.catalog import Catalog
+from project.server.common.popularity import Popularity
 from project.server.common.redis import FlaskRedis
+from project.server.common.search_cache import SearchCache
 from project.server.common.tricoma_api import TricomaAPI
 from project.server.common.tricoma_client import TricomaClient
 # instantiate the extensions
@@ -29,8 +33,12 @@ migrate = Migrate()
 flask_admin = Admin(name='admin', base_template='admin/admin_master.html', template_mode='bootstrap3')
 
 redis_client = FlaskRedis()
+catalog = Catalog(redis_client)
+search_cache = SearchCache(redis_client, catalog)
+bestsellers = Bestsellers(redis_client)
+popularity = Popularity(redis_client)
 
-tricoma_api = TricomaAPI()
+tricoma_api = TricomaAPI(redis_client=redis_client)
 tricoma_client = TricomaClient()
 
 raider = RaiderReporter.from_config(RAIDER_CONFIG)
@@ -130,6 +138,10 @@ def init_extensions(app):
     init_celery(app)
     alchemydumps.init_app(app, db)
     redis_client.init_app(app)
+    catalog.init_app(app)
+    search_cache.init_app(app)
+    bestsellers.init_app(app)
+    popularity.init_app(app)
     start_vigil_reporter(app)
 
     # finally set up sentry
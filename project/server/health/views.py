@@ -1,8 +1,13 @@
-from flask import Blueprint, current_app
+import time
+
+from flask import Blueprint, current_app, jsonify
+from redis.exceptions import RedisError
 from sqlalchemy.exc import OperationalError
 
 from project.server import db
+from project.server.common.circuit_breaker import OPEN, CLOSED
 from project.server.common.stats import celery_status, redis_status
+from project.server.extensions import tricoma_api
 
 health_bp = Blueprint("health", __name__, url_prefix='/status')
 
@@ -36,3 +41,19 @@ def redis():
     if not status:
         return "DOWN", 400
     return "OK", 200
+
+
+@health_bp.route('/tricoma')
+def tricoma():
+    """
+    Metrics of the connection pools and the circuit breakers of all processes that called the Tricoma API.
+    DOWN, if the circuit of any of them is still open.
+    """
+    try:
+        workers = tricoma_api.published_metrics()
+    except RedisError as e:
+        current_app.logger.error(e)
+        return "DOWN", 400
+    now = time.time()
+    is_open = any(m['breaker']['state'] == OPEN and m['updated'] + m['breaker']['retry_in'] > now for m in workers.values())
+    return jsonify({'state': OPEN if is_open else CLOSED, 'workers': workers}), 400 if is_open else 200
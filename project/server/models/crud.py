@@ -5,6 +5,9 @@ from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+# depth of nested batches, stored per session
+BATCH_KEY = 'crud_batch'
+
 
 class SessionMixin:
     _session = None
@@ -13,10 +16,40 @@ class SessionMixin:
     def set_session(cls, session):
         cls._session = session
 
+    @classmethod
+    def in_batch(cls) -> bool:
+        return bool(cls._session.info.get(BATCH_KEY))
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """
+        Unit of work: inside the block save, create, update, delete and clone only stage their changes.
+        Everything is flushed and committed once at the end or rolled back together if anything fails.
+        Ids of new objects are assigned at the end or by the next autoflush. Batches can be nested.
+        """
+        session = cls._session
+        depth = session.info.get(BATCH_KEY, 0)
+        session.info[BATCH_KEY] = depth + 1
+        try:
+            yield session
+            if not depth:
+                session.commit()
+        except Exception:
+            if not depth:
+                session.rollback()
+            raise
+        finally:
+            session.info[BATCH_KEY] = depth
+
     @classmethod
     @contextmanager
     def get_session(cls):
         session = cls._session
+        if cls.in_batch():
+            # the batch commits or rolls back
+            yield session
+            return
         try:
             yield session
         except Exception as e:
@@ -70,7 +103,7 @@ class CRUDMixin(Base, SessionMixin):
         """
         Delete the records with the given ids.
         """
-        with cls.session():
+        with cls.batch():
             for pk in ids:
                 cls.get(pk).delete()
 
@@ -1,10 +1,15 @@
 import typing
+from dataclasses import dataclass, field
 
-from sqlalchemy import Index, desc, func, any_, bindparam, asc
+from sqlalchemy import Index, desc, func, any_, bindparam, asc, case, or_, and_, select, exists
+from sqlalchemy.orm import joinedload, selectinload
 
 from project.server import db
+from project.server.common.search_cache import normalize_query
+from project.server.extensions import search_cache, catalog
 from project.server.models.crud import CRUDMixin
-from project.server.models.image import ImageMixin
+from project.server.models.image import ImageMixin, default_images
+from project.server.models.loading import LoadingProfileMixin
 from project.server.models.orderable import OrderableMixin
 
 color_device_table = db.Table('color_device',
@@ -32,7 +37,21 @@ class Color(db.Model, CRUDMixin):
         return self.internal_name
 
 
-class Device(db.Model, CRUDMixin, ImageMixin, OrderableMixin):
+@dataclass
+class SearchPage:
+    """ A single page of ranked search results """
+    query: str
+    limit: int
+    offset: int
+    total: int = 0
+    devices: typing.List = field(default_factory=list)
+
+    @property
+    def has_more(self) -> bool:
+        return self.offset + len(self.devices) < self.total
+
+
+class Device(db.Model, CRUDMixin, ImageMixin, OrderableMixin, LoadingProfileMixin):
     __tablename__ = "device"
 
     id = db.Column(db.Integer, primary_key=True)
@@ -58,6 +77,23 @@ class Device(db.Model, CRUDMixin, ImageMixin, OrderableMixin):
             postgresql_using='gin'),
     )
 
+    LOADING_PROFILES = {
+        # device grids: image and whether the device has any repairs
+        'grid': lambda: (joinedload(Device.image), selectinload(Device.repairs)),
+        # model page: everything that is needed to select repairs and colors
+        'detail': lambda: (
+            joinedload(Device.image),
+            joinedload(Device.series).joinedload('manufacturer'),
+            selectinload(Device.colors),
+            selectinload(Device.repairs).joinedload('image'),
+        ),
+        # search results: everything that is needed to link to the model page
+        'link': lambda: (
+            joinedload(Device.image),
+            joinedload(Device.series).joinedload('manufacturer'),
+        ),
+    }
+
     @classmethod
     def search(cls, q: str):
         """
@@ -96,23 +132,104 @@ class Device(db.Model, CRUDMixin, ImageMixin, OrderableMixin):
         query = cls.query.order_by(asc(func.levenshtein(Device.name, q))).limit(limit)
         return query
 
+    @classmethod
+    def search_ranked(cls, q: str, limit: int = 15, offset: int = 0) -> SearchPage:
+        """
+        Combine all of the above into a single query that can use the GIN index (name_idx).
+        ----------
+        SELECT *, SIMILARITY(name, 'X') + WORD_SIMILARITY('X', name) + ('X' % ANY(STRING_TO_ARRAY(name, ' ')))::int AS score,
+               COUNT(*) OVER () AS total
+        FROM devices WHERE name % 'X' OR 'X' <% name
+        ORDER BY score DESC, LEVENSHTEIN(LOWER(name), LOWER('X')) ASC, name LIMIT 15 OFFSET 0;
+        ----------
+        The query is normalized first. The ids of the hits are cached in Redis per normalized query and catalog version.
+        """
+        page = SearchPage(query=q, limit=limit, offset=offset)
+        key = search_cache.key('ranked', q, limit, offset)
+        cached = search_cache.get(key)
+        if cached is None:
+            page.total, page.devices = cls._search_ranked(normalize_query(q), limit, offset)
+            search_cache.set(key, {'total': page.total, 'ids': [device.id for device in page.devices]})
+        else:
+            page.total, page.devices = cached['total'], cls._get_in_order(cached['ids'])
+        return page
+
+    @classmethod
+    def _search_ranked(cls, q: str, limit: int, offset: int) -> typing.Tuple[int, typing.List['Device']]:
+        term = bindparam('term', q)
+        token_match = case([(term.op('%%')(any_(func.string_to_array(cls.name, ' '))), 1.0)], else_=0.0)
+        score = (func.similarity(cls.name, term) + func.word_similarity(term, cls.name) + token_match).label('score')
+        distance = func.levenshtein(func.lower(cls.name), func.lower(term))
+        total = func.count().over().label('total')
+
+        rows = db.session.query(cls, score, total).options(
+            *cls.loading_profile('link')
+        ).filter(
+            # both operators are supported by gin_trgm_ops
+            or_(cls.name.op('%%')(term), term.op('<%%')(cls.name))
+        ).order_by(
+            desc('score'), asc(distance), cls.name
+        ).limit(limit).offset(offset).all()
+
+        if not rows:
+            return 0, []
+        return rows[0].total, [row.Device for row in rows]
+
+    @classmethod
+    def _get_in_order(cls, ids: typing.List[int]) -> typing.List['Device']:
+        """ Load devices by primary key and keep the order of the ids """
+        if not ids:
+            return []
+        devices = {device.id: device for device in cls.query_profile('link').filter(cls.id.in_(ids))}
+        return [devices[device_id] for device_id in ids if device_id in devices]
+
     @classmethod
     def merge(cls, ids: typing.List[int]):
         """ Merge a list of devices (id's) into a one. Heavily opinionated method."""
-        query = cls.query.filter(cls.id.in_(ids))
-        with cls.session():
-            # Copy basic data from the first device
-            merger = _create_from_first_device(query[0])
-            # Get the first non none image
-            merger.image = next(filter(lambda i: i is not None, map(lambda d: d.image, query.all())), None)
-            for device in query:
-                # merge relations
-                _merge_colors(merger, device.colors)
-                _merge_repairs(merger, device.repairs)
-                # dont forget to delete
-                device.delete()
-            merger.name = merger.name[:-1]
-            return merger
+        return cls.merge_groups([ids])[0]
+
+    @classmethod
+    def merge_groups(cls, groups: typing.Iterable[typing.Iterable[int]]) -> typing.List['Device']:
+        """
+        Merge every group of devices (id's) into a new device. All groups are merged in a single transaction.
+        The new device copies name, series and type of the first device of its group and gets the first image of the group.
+        Colors are united. Repairs are moved to the new device and deduplicated by name.
+        Raises IndexError if a group contains no existing device.
+        """
+        groups = [[int(device_id) for device_id in group] for group in groups]
+        with cls.batch() as session:
+            query = cls.query.options(joinedload(cls.image)).filter(cls.id.in_([i for group in groups for i in group]))
+            devices = {device.id: device for device in query}
+            merged = []
+            for group in groups:
+                members = list({device_id: devices[device_id] for device_id in group if device_id in devices}.values())
+                first = members[0]
+                # the name is unique, so the new device gets the name of the first device after all others are deleted
+                merger = cls(
+                    name=first.name + "#", is_tablet=first.is_tablet, series_id=first.series_id,
+                    image_id=next((device.image_id for device in members if device.image_id), None)
+                )
+                session.add(merger)
+                merged.append((merger, first.name, members))
+            session.flush()
+
+            merger_of = {}
+            for merger, _, members in merged:
+                for device in members:
+                    if merger_of.setdefault(device.id, merger.id) != merger.id:
+                        raise ValueError(f"{device} is part of more than one group")
+
+            _merge_colors(session, merger_of)
+            _merge_repairs(session, merger_of)
+            session.execute(cls.__table__.delete().where(cls.id.in_(merger_of)))
+            # the merged devices are gone, keep them around detached like the ORM does with deleted objects
+            for device_id in merger_of:
+                session.expunge(devices[device_id])
+            for merger, name, _ in merged:
+                merger.name = name
+            # Core statements do not trigger the ORM events
+            catalog.mark_dirty(session)
+        return [merger for merger, _, _ in merged]
 
     @property
     def manufacturer(self):
@@ -122,28 +239,49 @@ class Device(db.Model, CRUDMixin, ImageMixin, OrderableMixin):
         return self.name or "n.a"
 
     def _get_image_name_for_class(self):
-        from project.server.models.image import Image, Default
+        defaults = default_images()
         if self.is_tablet:
-            return Image.query.filter(Image.tablet_default == Default.true).first()  # noqa
-        return Image.query.filter(Image.device_default == Default.true).first()  # noqa
+            return defaults.tablet
+        return defaults.device
+
 
+def _merge_colors(session, merger_of: typing.Dict[int, int]) -> None:
+    """ Link the colors of all merged devices to their new device """
+    links = color_device_table
+    target = case(merger_of, value=links.c.device_id)
+    session.execute(links.insert().from_select(
+        ['device_id', 'color_id'],
+        select([target, links.c.color_id]).where(links.c.device_id.in_(merger_of)).distinct()
+    ))
+    session.execute(links.delete().where(links.c.device_id.in_(merger_of)))
 
-def _create_from_first_device(first: Device) -> Device:
-    name, is_tablet, series = first.name, first.is_tablet, first.series
-    merger = Device.create(name=name + "#", is_tablet=is_tablet, series=series)
-    return merger
 
+def _merge_repairs(session, merger_of: typing.Dict[int, int]) -> None:
+    """
+    Move the repairs of all merged devices to their new device. Of repairs with the same name only the oldest is kept.
+    Orders of the other ones are moved to the kept repair.
+    """
+    from project.server.models import OrderRepairAssociation, Repair
 
-def _merge_colors(merger: Device, colors: typing.List) -> None:
-    for color in colors:
-        if color not in merger.colors:
-            merger.colors.append(color)
+    repairs = Repair.__table__
+    target = case(merger_of, value=repairs.c.device_id)
+    ranked = select([
+        repairs.c.id,
+        func.first_value(repairs.c.id).over(partition_by=(target, repairs.c.name), order_by=repairs.c.id).label('keep')
+    ]).where(repairs.c.device_id.in_(merger_of)).alias()
+    # duplicate -> repair that is kept
+    duplicates = dict(session.execute(select([ranked.c.id, ranked.c.keep]).where(ranked.c.id != ranked.c.keep)).fetchall())
 
+    if duplicates:
+        ora, other = OrderRepairAssociation.__table__, OrderRepairAssociation.__table__.alias()
+        keep, other_keep = case(duplicates, value=ora.c.repair_id), case(duplicates, value=other.c.repair_id)
+        # an order must not contain the same repair twice: only move the first of its duplicates, if it lacks the kept one
+        conflict = exists().where(and_(
+            other.c.order_id == ora.c.order_id,
+            or_(other.c.repair_id == keep, and_(other.c.repair_id.in_(duplicates), other_keep == keep, other.c.repair_id < ora.c.repair_id))
+        ))
+        session.execute(ora.update().where(and_(ora.c.repair_id.in_(duplicates), ~conflict)).values(repair_id=keep))
+        session.execute(ora.delete().where(ora.c.repair_id.in_(duplicates)))
+        session.execute(repairs.delete().where(repairs.c.id.in_(duplicates)))
 
-def _merge_repairs(merger: Device, repairs: typing.List) -> None:
-    for repair in repairs:
-        if repair.name not in map(lambda d: d.name, merger.repairs):
-            rep = repair.clone()
-            rep.device = merger
-            rep.save()
-            repair.delete()
+    session.execute(repairs.update().where(repairs.c.device_id.in_(merger_of)).values(device_id=target))
@@ -1,10 +1,14 @@
 import enum
+import functools
 import typing
 
-from flask import url_for
+from flask import current_app, g, has_app_context, has_request_context, request, url_for
+from sqlalchemy import event, inspect, or_
 from sqlalchemy.ext.declarative.base import declared_attr
+from sqlalchemy.orm import make_transient_to_detached
 
 from project.server import db
+from project.server.extensions import catalog
 from project.server.models.crud import CRUDMixin
 
 
@@ -32,7 +36,111 @@ class Image(db.Model, CRUDMixin):
         return self.name
 
     def get_path(self) -> str:
-        return url_for('static', filename=f"images/{self.path}")
+        script_root = request.script_root if has_request_context() else None
+        return _static_url(script_root, self.path)
+
+
+@functools.lru_cache(maxsize=4096)
+def _static_url(script_root: typing.Optional[str], path: str) -> str:
+    """ Building urls is surprisingly expensive. The result only depends on the script root and the path. """
+    return url_for('static', filename=f"images/{path}")
+
+
+def _detached_copy(image: Image) -> Image:
+    """ Create a detached copy of the image that can be shared between sessions """
+    copy = Image(**{column: getattr(image, column) for column in Image.__table__.columns.keys()})
+    make_transient_to_detached(copy)
+    return copy
+
+
+def _attach(session, image: Image) -> Image:
+    """ Attach a detached copy to the session without emitting SQL """
+    return session.identity_map.get(inspect(image).key) or session.merge(image, load=False)
+
+
+class DefaultImages(object):
+    """ All default images and named fallbacks, loaded with a single query """
+    FALLBACK_NAMES = ("default_phone_other.svg", "default_tablet_other.svg")
+
+    def __init__(self, images: typing.Iterable[Image]):
+        self.images = list(images)
+        self.device = None
+        self.tablet = None
+        self.repair = None
+        self.manufacturer = None
+        self._by_name = {}
+        for image in self.images:
+            if image.device_default:
+                self.device = image
+            if image.tablet_default:
+                self.tablet = image
+            if image.repair_default:
+                self.repair = image
+            if image.manufacturer_default:
+                self.manufacturer = image
+            if image.name in self.FALLBACK_NAMES:
+                self._by_name.setdefault(image.name, image)
+
+    @classmethod
+    def load(cls):
+        images = Image.query.filter(or_(
+            Image.device_default == Default.true,  # noqa
+            Image.tablet_default == Default.true,  # noqa
+            Image.repair_default == Default.true,  # noqa
+            Image.manufacturer_default == Default.true,  # noqa
+            Image.name.in_(cls.FALLBACK_NAMES)
+        )).all()
+        return cls(images)
+
+    def named(self, name: str) -> typing.Optional[Image]:
+        return self._by_name.get(name)
+
+    def detached(self):
+        """ Copy all images so that they can outlive the current session """
+        return self.__class__(_detached_copy(image) for image in self.images)
+
+    def merge(self, session):
+        """ Attach all images to the given session """
+        return self.__class__(_attach(session, image) for image in self.images)
+
+
+class DefaultImageRegistry(object):
+    """
+    Process wide cache of the default images.
+    It is reloaded as soon as the catalog version changes or an image is written by this process.
+    """
+
+    def __init__(self):
+        self._images: typing.Optional[DefaultImages] = None
+        self._version = None
+
+    def get(self, version) -> DefaultImages:
+        if self._images is None or self._version != version:
+            self._images = DefaultImages.load().detached()
+            self._version = version
+        return self._images
+
+    def invalidate(self) -> None:
+        self._images = None
+
+
+def default_images() -> DefaultImages:
+    """ Resolve the default images at most once per request """
+    if 'default_images' not in g:
+        registry = current_app.extensions.setdefault('default_images', DefaultImageRegistry())
+        g.default_images = registry.get(catalog.version).merge(db.session)
+    return g.default_images
+
+
+@event.listens_for(Image, 'after_insert')
+@event.listens_for(Image, 'after_update')
+@event.listens_for(Image, 'after_delete')
+def _forget_default_images(mapper, connection, target):
+    if has_app_context():
+        g.pop('default_images', None)
+        registry = current_app.extensions.get('default_images')
+        if registry:
+            registry.invalidate()
 
 
 class ImageMixin(object):
@@ -0,0 +1,23 @@
+import typing
+
+
+class LoadingProfileMixin(object):
+    """
+    Mixin for named eager loading strategies.
+    A profile is a callable that returns a sequence of loader options, e.g. selectinload or joinedload.
+    Use them to avoid lazy loads (N+1 queries) when rendering lists of objects.
+    """
+    LOADING_PROFILES: typing.Dict[str, typing.Callable[[], typing.Sequence]] = {}
+
+    @classmethod
+    def loading_profile(cls, name: str) -> typing.Sequence:
+        """ Get the loader options of a named profile """
+        try:
+            return cls.LOADING_PROFILES[name]()
+        except KeyError as error:
+            raise ValueError(f"{cls.__name__} has no loading profile named '{name}'") from error
+
+    @classmethod
+    def query_profile(cls, name: str):
+        """ Start a new query with the loader options of a named profile """
+        return cls.query.options(*cls.loading_profile(name))
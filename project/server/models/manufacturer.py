@@ -1,6 +1,6 @@
 from project.server import db
 from project.server.models.base import BaseModel
-from project.server.models.image import ImageMixin
+from project.server.models.image import ImageMixin, default_images
 
 
 class Manufacturer(BaseModel, ImageMixin):
@@ -21,5 +21,4 @@ class Manufacturer(BaseModel, ImageMixin):
         return [devices for devices in self.series.devices]
 
     def _get_image_name_for_class(self):
-        from project.server.models.image import Image, Default
-        return Image.query.filter(Image.manufacturer_default == Default.true).first()  # noqa
+        return default_images().manufacturer
@@ -1,10 +1,17 @@
+import collections
 import datetime
+import decimal
 import typing
-from functools import reduce
+
+from sqlalchemy import event
 
 from project.server import db
+from project.server.common.pricing import PriceBreakdown
+from project.server.extensions import bestsellers, popularity
 from project.server.models.base import BaseModel
 from project.server.models.crud import CRUDMixin
+from project.server.models.device import Color, color_device_table
+from project.server.models.repair import Repair
 from project.server.models.session_mixin import SessionStoreMixin
 from project.tasks.email import notify_shop, send_confirmation
 
@@ -43,6 +50,15 @@ class Order(BaseModel, SessionStoreMixin):
     # Repairs
     _repairs = db.relationship("OrderRepairAssociation", back_populates="order", cascade="all, delete-orphan")
 
+    # Price, stored when the order is completed
+    price_subtotal = db.Column(db.DECIMAL(9, 2), nullable=True)
+    price_discount = db.Column(db.DECIMAL(9, 2), nullable=True)
+    price_total = db.Column(db.DECIMAL(9, 2), nullable=True)
+    price_tax = db.Column(db.DECIMAL(9, 2), nullable=True)
+
+    # Memoized price breakdown of an order that is not completed yet
+    _price_breakdown = None
+
     def __repr__(self):
         return f"<Order: {self.device.name}>"
 
@@ -60,6 +76,26 @@ class Order(BaseModel, SessionStoreMixin):
         oras = [self.append_repair(repair) for repair in repairs]
         return oras
 
+    @classmethod
+    def create_for_device(cls, device_id: int, color_id: int, repair_ids: typing.Collection[int], **kwargs) -> 'Order':
+        """
+        Create an order for a device with a single query for the color and the repairs and a single commit.
+        Raises ValueError if the color or one of the repairs does not belong to the device.
+        """
+        repair_ids = set(repair_ids)
+        rows = db.session.query(Repair, Color).join(
+            color_device_table, color_device_table.c.device_id == Repair.device_id
+        ).join(
+            Color, Color.id == color_device_table.c.color_id
+        ).filter(
+            Repair.device_id == device_id, Repair.id.in_(repair_ids), Color.id == color_id
+        ).order_by(Repair.id).all()
+        if not repair_ids or len(rows) != len(repair_ids):
+            raise ValueError(f"Color {color_id} or repairs {sorted(repair_ids)} do not belong to device {device_id}")
+
+        order = cls(color=rows[0][1], _repairs=[OrderRepairAssociation(repair=repair) for repair, _ in rows], **kwargs)
+        return order.save()
+
     @classmethod
     def deserialize(cls, obj):
         try:
@@ -75,31 +111,45 @@ class Order(BaseModel, SessionStoreMixin):
         )
 
     @property
-    def total_cost(self) -> float:
-        tot = reduce(lambda total, cost: total + cost, map(lambda repair: repair.price, self.repairs))
-        return round(tot, 2)
+    def price_breakdown(self) -> PriceBreakdown:
+        """
+        The price of this order. Completed orders use the stored price.
+        Otherwise it is computed once and forgotten as soon as a repair is added or removed.
+        """
+        if self.price_total is not None:
+            return PriceBreakdown(self.price_subtotal, self.price_discount, self.price_total, self.price_tax)
+        if self._price_breakdown is None:
+            self._price_breakdown = PriceBreakdown.from_prices(ora.repair.price for ora in self._repairs)
+        return self._price_breakdown
+
+    def store_price_breakdown(self) -> None:
+        """ Store the current price on the order row. Called when the order is completed. """
+        breakdown = PriceBreakdown.from_prices(ora.repair.price for ora in self._repairs)
+        self.price_subtotal, self.price_discount, self.price_total, self.price_tax = (
+            breakdown.subtotal, breakdown.discount, breakdown.total, breakdown.tax
+        )
 
     @property
-    def taxes(self) -> float:
-        return round((19.0 * float(self.total_cost_including_tax_and_discount)) / 100.0, 2)
+    def total_cost(self) -> decimal.Decimal:
+        return self.price_breakdown.subtotal
 
     @property
-    def discount(self) -> float:
+    def taxes(self) -> decimal.Decimal:
+        return self.price_breakdown.tax
+
+    @property
+    def discount(self) -> decimal.Decimal:
         """ Discount is 20 percentage on the cheapest repair"""
-        if len(self.repairs) > 1:
-            cheapest = min(self.repairs, key=lambda repair: repair.price)
-            discount = round((20.0 * float(cheapest.price)) / 100.0, 2)
-            return discount
-        return 0
+        return self.price_breakdown.discount
 
     @property
-    def total_cost_including_tax_and_discount(self) -> float:
-        return round(float(self.total_cost) - float(self.discount), 2)
+    def total_cost_including_tax_and_discount(self) -> decimal.Decimal:
+        return self.price_breakdown.total
 
     @property
     def device(self) -> typing.Optional:
-        if self.repairs and len(self.repairs) > 0:
-            return self.repairs[0].device
+        if self._repairs:
+            return self._repairs[0].repair.device
         return None
 
     @property
@@ -118,7 +168,11 @@ class Order(BaseModel, SessionStoreMixin):
 
     def set_complete(self) -> None:
         self.complete = True
+        self.store_price_breakdown()
         self.save()
+        repairs = [(ora.repair.device_id, ora.repair_id) for ora in self._repairs]
+        bestsellers.add(collections.Counter(device_id for device_id, _ in repairs))
+        popularity.add_order(repairs)
 
     def notify(self) -> None:
         """
@@ -127,3 +181,10 @@ class Order(BaseModel, SessionStoreMixin):
         """
         notify_shop(self)
         send_confirmation(self)
+
+
+@event.listens_for(Order._repairs, 'append')
+@event.listens_for(Order._repairs, 'remove')
+@event.listens_for(Order._repairs, 'bulk_replace')
+def _forget_price_breakdown(target, *args, **kwargs):
+    target._price_breakdown = None
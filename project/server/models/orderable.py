@@ -1,60 +1,91 @@
-from sqlalchemy import func
+import typing
 
-from project.server.extensions import db
+from sqlalchemy import func, select
+from sqlalchemy.ext.declarative import declared_attr
 
+from project.server.extensions import db, catalog
 
-def default_order_index(context) -> int:
+
+class OrderableMixin(object):
     """
-    Get the current highest index
+    Mixin to make database models comparable.
+    New rows get their index from a sequence, so that concurrent inserts never share an index.
+    Moving a row swaps its index with the index of its neighbour. No other row is renumbered.
+    Requires the CRUDMixin for batches.
     """
-    if context:
-        try:
-            return db.session.query(func.max(context.current_column.table.c.order_index)).first()[0] + 1
-        except (TypeError, IndexError):
-            return 0
-    else:
-        return 0
 
-
-class OrderableMixin(object):
-    """ Mixin to make database models comparable """
-    order_index = db.Column(db.Integer,
-                            default=default_order_index,
-                            index=True)
+    @declared_attr
+    def order_index(cls):
+        return db.Column(db.Integer,
+                         db.Sequence(f"{cls.__tablename__}_order_index_seq", start=0, minvalue=0),
+                         index=True)
 
     @classmethod
-    def normalize(cls):
-        """ Normalize all order indexes """
-        for idx, item in enumerate(cls.query.order_by(cls.order_index).all()):
-            item.order_index = idx
-        db.session.commit()
+    def normalize(cls, ids: typing.Iterable[int] = None, order_by=None, per=None):
+        """
+        Renumber the order indexes from 0 with a single UPDATE ... FROM (SELECT id, row_number() OVER (...)).
+        :param ids: only renumber these rows instead of the whole table
+        :param order_by: the new order, defaults to the current one
+        :param per: number every group of this column on its own, e.g. the series of a device
+        """
+        order_by = cls.order_index if order_by is None else order_by
+        index = func.row_number().over(order_by=(order_by, cls.id), partition_by=per) - 1
+        numbered = select([cls.id, index.label('order_index')])
+        if ids is not None:
+            numbered = numbered.where(cls.id.in_(list(ids)))
+        numbered = numbered.alias()
+
+        table = cls.__table__
+        with cls.batch() as session:
+            session.execute(table.update().where(table.c.id == numbered.c.id).values(order_index=numbered.c.order_index))
+            for obj in list(session.identity_map.values()):
+                if isinstance(obj, cls):
+                    session.expire(obj, ['order_index'])
+            catalog.mark_dirty(session)
 
     def move_up(self):
         """ Move the database object one up"""
-        if self.order_index == 0:
-            return
-
-        # get all items ordered by their index
-        items = self.query.order_by(self.__class__.order_index).all()
-        idx = items.index(self)
-
-        # swap with item above
-        above = items[idx - 1]
-        above.order_index, self.order_index = idx, above.order_index
-        db.session.commit()
+        self._move(up=True)
 
     def move_down(self):
         """ Move the database object one down"""
+        self._move(up=False)
+
+    @classmethod
+    def move_many(cls, ids: typing.Iterable[int], up: bool = True):
+        """
+        Move the selected objects one up or down in a single transaction.
+        Selected objects that already reached the top (or bottom) block the ones behind them,
+        so the order of the selection itself never changes.
+        """
+        column = cls.order_index
+        selected = cls.query.filter(cls.id.in_(list(ids))).order_by(column if up else column.desc())
+        blocked = set()
+        with cls.batch():
+            for item in selected.all():
+                neighbour = item._neighbour(up)
+                if neighbour is None or neighbour.id in blocked:
+                    blocked.add(item.id)
+                else:
+                    item._swap(neighbour)
 
-        # get all items ordered by their index
-        items = self.query.order_by(self.__class__.order_index).all()
-        idx = items.index(self)
+    def _move(self, up: bool):
+        with self.batch():
+            neighbour = self._neighbour(up)
+            if neighbour is not None:
+                self._swap(neighbour)
 
-        # if item is last do nothing
-        if idx == len(items) - 1:
-            return
+    def _neighbour(self, up: bool):
+        """ The next row above or below. Both rows are locked until the end of the transaction. """
+        cls = self.__class__
+        column = cls.order_index
+        index = db.session.query(column).filter(cls.id == self.id).with_for_update().scalar()
+        if index is None:
+            return None
+        # the index in the identity map may be stale
+        self.order_index = index
+        query = cls.query.filter(column < index).order_by(column.desc()) if up else cls.query.filter(column > index).order_by(column)
+        return query.with_for_update().first()
 
-        # swap with item below
-        below = items[idx + 1]
-        below.order_index, self.order_index = idx, below.order_index
-        db.session.commit()
+    def _swap(self, other):
+        self.order_index, other.order_index = other.order_index, self.order_index
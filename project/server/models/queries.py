@@ -1,12 +1,18 @@
 """
 This is the place for complex queries
 """
+import datetime
 import typing
 
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, cast
 
 from project.server import db
-from project.server.models import OrderRepairAssociation, Repair, Device
+from project.server.common.bestsellers import WINDOWS
+from project.server.common.catalog import CatalogDevice
+from project.server.common.popularity import DEVICE, REPAIR
+from project.server.common.pricing import PriceBreakdown
+from project.server.extensions import bestsellers, catalog, popularity
+from project.server.models import OrderRepairAssociation, Repair, Order
 
 
 def most_selling_repairs(limit: int = 5) -> typing.List[Repair]:
@@ -16,11 +22,83 @@ def most_selling_repairs(limit: int = 5) -> typing.List[Repair]:
         .order_by(desc('qty')) \
         .limit(limit) \
         .all()
-    return [Repair.query.get(rep_id) for (rep_id, _) in repair_qty_tuples]
+    ids = [rep_id for (rep_id, _) in repair_qty_tuples]
+    repairs = {rep.id: rep for rep in Repair.query_profile('with_device').filter(Repair.id.in_(ids))}
+    return [repairs[rep_id] for rep_id in ids]
 
 
-def get_bestsellers(limit: int = 5) -> typing.List[Device]:
-    repairs = most_selling_repairs(limit=limit)
-    seen = set()
-    seen_add = seen.add
-    return [rep.device for rep in repairs if not (rep.device in seen or seen_add(rep.device))]
+def get_bestsellers(limit: int = 5, days: int = None) -> typing.List[CatalogDevice]:
+    """
+    The most popular devices, or the most ordered devices of the last days.
+    A single lookup of a sorted set in Redis, no query.
+    """
+    if days is None:
+        ids = [device_id for device_id, _ in popularity.top(DEVICE, limit)]
+    else:
+        ids = bestsellers.top(limit, days)
+    devices = catalog.get().devices_by_id
+    return [devices[device_id] for device_id in ids if device_id in devices]
+
+
+def ordered_repairs(since: datetime.date) -> typing.List[typing.Tuple[datetime.date, int, int, int]]:
+    """ How often each repair was ordered per day by completed orders since the given day: (day, device id, repair id, count) """
+    day = cast(Order.timestamp, db.Date)
+    return db.session.query(day, Repair.device_id, Repair.id, func.count()) \
+        .select_from(Order).join(Order._repairs).join(OrderRepairAssociation.repair) \
+        .filter(Order.complete.is_(True), Order.timestamp >= since) \
+        .group_by(day, Repair.device_id, Repair.id) \
+        .all()
+
+
+def rebuild_bestsellers() -> None:
+    """ Recount the bestseller ranking and the popularity from the orders, e.g. after a deploy or if Redis lost its data """
+    since = datetime.date.today() - datetime.timedelta(days=max(WINDOWS) - 1)
+    rows = ordered_repairs(since)
+
+    counts_per_day = {}
+    for day, device_id, _, quantity in rows:
+        counts = counts_per_day.setdefault(day, {})
+        counts[device_id] = counts.get(device_id, 0) + quantity
+    bestsellers.replace(counts_per_day)
+
+    # older orders hardly count after a year
+    noon = datetime.time(12)
+    popularity.replace(DEVICE, ((datetime.datetime.combine(day, noon), device_id, quantity) for day, device_id, _, quantity in rows))
+    popularity.replace(REPAIR, ((datetime.datetime.combine(day, noon), repair_id, quantity) for day, _, repair_id, quantity in rows))
+
+
+def order_price_breakdowns(orders: typing.Iterable[typing.Union[Order, int]]) -> typing.Dict[int, PriceBreakdown]:
+    """
+    The price breakdowns of many orders (or order ids) with a single query.
+    The prices of the repairs are aggregated by the database. The result is identical to Order.price_breakdown.
+    """
+    ids = {order if isinstance(order, int) else order.id for order in orders}
+    if not ids:
+        return {}
+    price = func.coalesce(Repair.price, 0)
+    rows = db.session.query(
+        Order.id, Order.price_subtotal, Order.price_discount, Order.price_total, Order.price_tax,
+        func.count(Repair.id), func.sum(price), func.min(price)
+    ).outerjoin(Order._repairs).outerjoin(OrderRepairAssociation.repair).filter(
+        Order.id.in_(ids)
+    ).group_by(Order.id)
+
+    breakdowns = {}
+    for order_id, subtotal, discount, total, tax, count, price_sum, cheapest in rows:
+        if total is not None:
+            # completed orders keep their stored price
+            breakdowns[order_id] = PriceBreakdown(subtotal, discount, total, tax)
+        else:
+            breakdowns[order_id] = PriceBreakdown.from_aggregates(count, price_sum, cheapest)
+    return breakdowns
+
+
+def repair_price_breakdowns(repair_id_sets: typing.Iterable[typing.Iterable[int]]) -> typing.List[PriceBreakdown]:
+    """ Quote many sets of repairs at once. The prices of all repairs are loaded with a single query. Unknown ids are ignored. """
+    repair_id_sets = [list(repair_ids) for repair_ids in repair_id_sets]
+    ids = {repair_id for repair_ids in repair_id_sets for repair_id in repair_ids}
+    prices = dict(db.session.query(Repair.id, Repair.price).filter(Repair.id.in_(ids))) if ids else {}
+    return [
+        PriceBreakdown.from_prices(prices[repair_id] for repair_id in repair_ids if repair_id in prices)
+        for repair_ids in repair_id_sets
+    ]
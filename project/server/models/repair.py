@@ -1,9 +1,12 @@
 from project.server import db
 from project.server.models.base import BaseModel
-from project.server.models.image import ImageMixin
+from sqlalchemy.orm import joinedload
 
+from project.server.models.image import ImageMixin, default_images
+from project.server.models.loading import LoadingProfileMixin
 
-class Repair(BaseModel, ImageMixin):
+
+class Repair(BaseModel, ImageMixin, LoadingProfileMixin):
     """ Repair """
 
     __tablename__ = 'repair'
@@ -17,13 +20,23 @@ class Repair(BaseModel, ImageMixin):
 
     orders = db.relationship("OrderRepairAssociation", back_populates="repair", cascade="all, delete-orphan")
 
+    LOADING_PROFILES = {
+        # repair grids: the image and the device (needed for the name and the default image)
+        'grid': lambda: (joinedload(Repair.image), joinedload(Repair.device)),
+        # bestsellers etc.: everything that is needed to link to the model page
+        'with_device': lambda: (
+            joinedload(Repair.device).joinedload('image'),
+            joinedload(Repair.device).joinedload('series').joinedload('manufacturer'),
+        ),
+    }
+
     def __repr__(self):
         return f"{self.device.name} {self.name}"
 
     def _get_image_name_for_class(self):
-        from project.server.models.image import Image, Default
+        defaults = default_images()
         if self.device.is_tablet:
-            img = Image.query.filter(Image.name == "default_tablet_other.svg").first()
+            img = defaults.named("default_tablet_other.svg")
         else:
-            img = Image.query.filter(Image.name == "default_phone_other.svg").first()
-        return img or Image.query.filter(Image.repair_default == Default.true).first()
+            img = defaults.named("default_phone_other.svg")
+        return img or defaults.repair
@@ -1,8 +1,11 @@
+from sqlalchemy.orm import joinedload, selectinload
+
 from project.server import db
 from project.server.models.base import BaseModel
+from project.server.models.loading import LoadingProfileMixin
 
 
-class DeviceSeries(BaseModel):
+class DeviceSeries(BaseModel, LoadingProfileMixin):
     """ Association table between Device and Manufacturer """
     __tablename__ = "device_series"
 
@@ -15,5 +18,14 @@ class DeviceSeries(BaseModel):
 
     devices = db.relationship("Device", back_populates="series")
 
+    LOADING_PROFILES = {
+        # series overview: the manufacturer and all devices including their images and repairs
+        'devices': lambda: (
+            joinedload(DeviceSeries.manufacturer),
+            selectinload(DeviceSeries.devices).joinedload('image'),
+            selectinload(DeviceSeries.devices).selectinload('repairs'),
+        ),
+    }
+
     def __repr__(self):
         return self.name
@@ -0,0 +1,46 @@
+"""
+HTTP caching of the catalog pages.
+
+The catalog pages only change when the catalog changes. Their ETag and Last-Modified headers are
+derived from the catalog version, so browsers and proxies can revalidate them with a conditional request.
+Expensive parts of the pages (device and repair grids) are cached as template fragments
+under a key that contains the catalog version. There is no need to delete anything on change.
+"""
+import functools
+
+from flask import request, session, current_app, make_response
+
+from project.server.extensions import catalog
+
+
+def catalog_etag(version: int) -> str:
+    release = current_app.config.get('RELEASE')
+    return f"catalog-{version}-{release}" if release else f"catalog-{version}"
+
+
+def conditional(view):
+    """
+    Answer conditional GET requests with 304 Not Modified, if the catalog did not change.
+    Responses are not conditional as long as there are flashed messages, because these are personal.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        version, last_modified = catalog.stamp()
+        etag = catalog_etag(version)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = bool(request.if_modified_since and request.if_modified_since >= last_modified)
+
+        response = current_app.response_class(status=304) if not_modified else make_response(view(*args, **kwargs))
+        if response.status_code in (200, 304):
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+        return response
+
+    return wrapper
@@ -1,12 +1,10 @@
-import typing
-
 from flask_wtf import FlaskForm
 from wtforms import SelectField, TextAreaField, SelectMultipleField, StringField, BooleanField, SubmitField
 from wtforms.ext.sqlalchemy.fields import QuerySelectField
 from wtforms.fields.html5 import EmailField
 from wtforms.validators import DataRequired, Length, Email
 
-from project.server.models import Color, Repair, Shop, Order, Customer
+from project.server.models import Shop, Order, Customer
 from project.server.models.misc import MiscInquiry
 
 
@@ -30,12 +28,6 @@ class SelectRepairForm(FlaskForm):
         self.color.choices = [(color.id, color) for color in device.colors]
         self.repairs.choices = [(repair.id, repair) for repair in device.repairs]
 
-    def get_color(self) -> typing.Optional[Color]:
-        return Color.query.get_or_404(self.color.data)
-
-    def get_repairs(self) -> typing.List[Repair]:
-        return [Repair.query.get_or_404(repair_id) for repair_id in self.repairs.data]
-
 
 class RegisterCustomerForm(FlaskForm):
     first_name = StringField(
@@ -126,7 +118,6 @@ class FinalSubmitForm(SelectShopForm):
 
     def populate_order(self, order: Order):
         order.kva = self.kva_button.data
-        order.complete = True
         order.shop = self.shop.data
         order.customer_wishes_shipping_label = self.shipping_label.data
 
@@ -4,90 +4,99 @@ import typing
 
 from flask import render_template, Blueprint, jsonify, abort, redirect, url_for, flash, session, request
 
-from project.server.extensions import cache
-from project.server.models import Manufacturer, DeviceSeries, Device, Customer, Order
+from project.server.common.popularity import DEVICE
+from project.server.extensions import catalog, popularity
+from project.server.models import Device, Customer, Order
 from project.server.models.queries import get_bestsellers
 from project.server.shop.actions import perform_post_complete_actions
+from project.server.shop.caching import conditional
 from project.server.shop.forms import SelectRepairForm, RegisterCustomerForm, FinalSubmitForm, MiscForm
 from project.tasks.email import notify_shop_about_inquiry
 from project.tasks.tricoma import register_tricoma_if_enabled
 
 main_blueprint = Blueprint("shop_blueprint", __name__)
 
+# popularity is only read for the top devices, all others count as equally unpopular
+POPULAR_DEVICES = 200
+
 
 @main_blueprint.route("/")
 @main_blueprint.route("/home")
-@cache.cached()
 def home():
     """
     Render Homepage
     --------------------------------------------------------------
-    This site should be cached, because it is the main entry point for many users.
+    The bestsellers depend on orders and not only on the catalog, so this page is not conditional.
+    Its grids are cached as fragments instead. The bestsellers are read from their materialized ranking.
     """
-    bestseller: typing.List[Device] = get_bestsellers()
-    specialist_manufacturers = Manufacturer.query.filter(
-        (Manufacturer.name == "Apple") | (Manufacturer.name == "Samsung") | (Manufacturer.name == "Huawei")
-    ).all()
-    return render_template("shop/home.html", bestseller=bestseller, specialist_manufacturers=specialist_manufacturers)
+    snapshot = catalog.get()
+    specialist_manufacturers = [
+        snapshot.manufacturers[name] for name in ("Apple", "Samsung", "Huawei") if name in snapshot.manufacturers
+    ]
+    return render_template("shop/home.html", bestseller=get_bestsellers, specialist_manufacturers=specialist_manufacturers, version=snapshot.version)
 
 
 @main_blueprint.route("/manufacturer")
-@cache.cached()
+@conditional
 def manufacturer():
-    """
-    Render a list of all manufacturers as a starting point
-    --------------------------------------------------------------
-    This site should be cached, because it is the main entry point for many users.
-    """
-    all_manufacturers: typing.List[Manufacturer] = Manufacturer.query.filter(Manufacturer.activated == True).all()  # noqa
-    all_manufacturers_with_repairs = filter(lambda manu: len(manu.series) > 0, all_manufacturers)
-    return render_template("shop/manufacturer.html", manufacturers=list(all_manufacturers_with_repairs), manufacturer_names=[manu.name for manu in all_manufacturers_with_repairs])
+    """ Render a list of all manufacturers as a starting point """
+    snapshot = catalog.get()
+    all_manufacturers_with_repairs = [manu for manu in snapshot.manufacturers.values() if manu.activated and manu.series]
+    return render_template("shop/manufacturer.html", manufacturers=all_manufacturers_with_repairs, manufacturer_names=[manu.name for manu in all_manufacturers_with_repairs], version=snapshot.version)
 
 
 @main_blueprint.route("/<string:manufacturer_name>")
 @main_blueprint.route("/<string:manufacturer_name>/series")
+@conditional
 def series(manufacturer_name):
     """ Return all series of the manufacturer, e.g. iPhone, iPad, etc """
-    _manufacturer = Manufacturer.query.filter(Manufacturer.name == manufacturer_name).first()
+    _manufacturer = catalog.get().manufacturers.get(manufacturer_name)
     if not _manufacturer:
         abort(404)
     return render_template("shop/series.html", series=_manufacturer.series, manufacturer=manufacturer_name, series_names=[s.name for s in _manufacturer.series])
 
 
 @main_blueprint.route("/<string:manufacturer_name>/<string:series_name>")
+@conditional
 def all_devices_of_series(manufacturer_name, series_name):
     """ Return all devices of a series, e.g. all iPhones """
-    _manufacturer = Manufacturer.query.filter(Manufacturer.name == manufacturer_name).first()
-    _series = DeviceSeries.query.filter(DeviceSeries.name == series_name).first()
+    snapshot = catalog.get()
+    _manufacturer = snapshot.manufacturers.get(manufacturer_name)
+    _series = snapshot.series.get(series_name)
     if not _manufacturer or not _series:
         abort(404)
-    # order devices by order_index with name as a fallback
-    _devices = Device.query.filter(Device.series_id == _series.id).order_by(Device.order_index.asc(), Device.name.desc())
-    _devices = [device for device in _devices if len(device.repairs)]  # display only devices that have at least one repair
-    return render_template("shop/devices.html", devices=_devices, manufacturer=manufacturer_name, series=series_name, device_names=[d.name for d in _devices])
+    # devices are ordered by order_index with name as a fallback
+    _devices = _series.devices_with_repairs  # display only devices that have at least one repair
+    return render_template("shop/devices.html", devices=_devices, manufacturer=manufacturer_name, series=series_name, device_names=[d.name for d in _devices], version=snapshot.version)
 
 
 @main_blueprint.route("/<string:manufacturer_name>/<string:series_name>/<string:device_name>/", methods=['GET', 'POST'])
 def model(manufacturer_name, series_name, device_name):
-    """ Returns the chosen device """
-    _manufacturer: Manufacturer = Manufacturer.query.filter(Manufacturer.name == manufacturer_name).first()
-    _series: DeviceSeries = DeviceSeries.query.filter(DeviceSeries.name == series_name).first()
-    _device: Device = Device.query.filter(Device.name == device_name).first()
+    """ Returns the chosen device. Not conditional, because the form contains a personal CSRF token. """
+    snapshot = catalog.get()
+    _manufacturer = snapshot.manufacturers.get(manufacturer_name)
+    _series = snapshot.series.get(series_name)
+    _device = snapshot.devices.get(device_name)
     if not _manufacturer or not _series or not _device:
         abort(404)
 
     repair_form = SelectRepairForm(_device)
     if repair_form.validate_on_submit():
-        order = Order.create(
-            color=repair_form.get_color(),
-            repairs=repair_form.get_repairs(),
-            problem_description=repair_form.problem_description.data,
-        )
-        order.save()
+        try:
+            order = Order.create_for_device(
+                _device.id,
+                repair_form.color.data,
+                repair_form.repairs.data,
+                problem_description=repair_form.problem_description.data,
+            )
+        except ValueError:
+            abort(404)
         order.save_to_session()
         return redirect(url_for('.register_customer'))
 
-    return render_template("shop/modell.html", device=_device, repair_form=repair_form, manufacturer=manufacturer_name, series=series_name, repair_names=[f"{rep.device.name} {rep.name}" for rep in _device.repairs])
+    if request.method == 'GET':
+        popularity.add_view(_device.id)
+    return render_template("shop/modell.html", device=_device, repair_form=repair_form, manufacturer=manufacturer_name, series=series_name, repair_names=[str(rep) for rep in _device.repairs], version=snapshot.version)
 
 
 @main_blueprint.route("/register", methods=['GET', 'POST'])
@@ -124,7 +133,7 @@ def order_overview():
     if form.validate_on_submit():
         # ORDER SUBMITTED
         form.populate_order(order)
-        order.save()
+        order.set_complete()
         perform_post_complete_actions(order)
         return redirect(url_for('.success'))
 
@@ -170,8 +179,9 @@ def impressum():
 @main_blueprint.route("/search/<string:device_name>/")
 def search(device_name):
     """ Render Search Results """
-    found_devices = Device.query.all()
-    return render_template('shop/search.html', devices=found_devices)
+    limit, offset = _pagination()
+    page = Device.search_ranked(device_name, limit=limit, offset=offset)
+    return render_template('shop/search.html', search=device_name, page=page, devices=page.devices)
 
 
 @main_blueprint.route("/success")
@@ -202,18 +212,31 @@ def other():
 @main_blueprint.route("/api/search/<string:device_name>/")
 def search_api(device_name):
     """
-    Test endpoint for development
+    Type-ahead device search that is answered from the in-process search index. Supports ?limit= and ?offset=
+    Equally good hits are ordered by the popularity of the devices.
     """
-    found_devices_normal = Device.search(device_name).all()
-    found_devices_similar = Device.search_order_by_similarity(device_name).all()
-    found_devices_array = Device.search_by_array(device_name).all()
-    found_devices_levenshtein = Device.search_levenshtein(device_name).all()
-    return jsonify(results={
-        'normal': [device.name for device in found_devices_normal],
-        'similar': [device.name for device in found_devices_similar],
-        'array': [device.name for device in found_devices_array],
-        'levenshtein': [device.name for device in found_devices_levenshtein],
-    })
+    limit, offset = _pagination()
+    popular = dict(popularity.top(DEVICE, limit=POPULAR_DEVICES))
+    total, documents = catalog.search_index().search(device_name, limit=limit, offset=offset, popularity=popular)
+    return jsonify(
+        query=device_name,
+        limit=limit,
+        offset=offset,
+        total=total,
+        results=[
+            {
+                'name': document.name,
+                'url': url_for('.model', manufacturer_name=document.manufacturer_name, series_name=document.series_name, device_name=document.name),
+            } for document in documents
+        ]
+    )
+
+
+def _pagination(default_limit: int = 15, max_limit: int = 50) -> typing.Tuple[int, int]:
+    """ Read limit and offset from the query string """
+    limit = request.args.get('limit', default_limit, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    return max(1, min(limit, max_limit)), max(0, offset)
 
 
 @main_blueprint.before_request
@@ -0,0 +1,138 @@
+import functools
+import itertools
+import json
+import typing
+import uuid
+from datetime import datetime
+
+from flask import current_app
+
+from project.server.common.import_repair import import_repairs, preview_repairs, ImportFileError
+from project.server.extensions import celery, redis_client
+
+# uploads are stored as a list of blocks, so that they never have to be read at once
+UPLOAD_KEY = "import:upload:{}"
+UPLOAD_BLOCK_SIZE = 64 * 1024
+RESULT_KEY = "import:result:{}"
+JOBS_KEY = "import:jobs"
+MAX_JOBS = 10
+
+
+def iter_blocks(stream: typing.BinaryIO) -> typing.Iterator[bytes]:
+    return iter(functools.partial(stream.read, UPLOAD_BLOCK_SIZE), b'')
+
+
+def store_upload(job_id: str, blocks: typing.Iterable[bytes]) -> None:
+    """ Append the blocks of an uploaded file one by one to a Redis list """
+    key = UPLOAD_KEY.format(job_id)
+    redis = redis_client.redis
+    for block in blocks:
+        redis.rpush(key, block)
+    redis.expire(key, current_app.config['IMPORT_UPLOAD_TIMEOUT'])
+
+
+def read_upload(job_id: str) -> typing.Iterator[bytes]:
+    """ Read a stored upload block by block """
+    key = UPLOAD_KEY.format(job_id)
+    redis = redis_client.redis
+    for index in itertools.count():
+        blocks = redis.lrange(key, index, index)
+        if not blocks:
+            return
+        yield blocks[0]
+
+
+def start_import(stream: typing.BinaryIO, filename: str = None, preview: bool = False) -> str:
+    """
+    Copy the uploaded price list to Redis and import it in the background.
+    A preview only computes the changes. The upload is kept, so that the preview can be confirmed.
+    Returns the id of the job, which is also the id of the celery task.
+    """
+    job_id = uuid.uuid4().hex
+    store_upload(job_id, iter_blocks(stream))
+    return _start(job_id, filename, preview=preview)
+
+
+def confirm_preview(preview_id: str) -> typing.Optional[str]:
+    """
+    Import the upload of a finished preview job in the background. The import is rolled back, if the changes differ from the preview.
+    Returns the id of the job or None if the preview or its upload is gone.
+    """
+    preview = import_result(preview_id)
+    if not preview or not preview.get('preview') or not redis_client.redis.exists(UPLOAD_KEY.format(preview_id)):
+        return None
+    return _start(uuid.uuid4().hex, preview['filename'], upload_id=preview_id, digest=preview['digest'])
+
+
+def _start(job_id: str, filename: typing.Optional[str], preview: bool = False, upload_id: str = None, digest: str = None) -> str:
+    redis = redis_client.redis
+    job = {'id': job_id, 'filename': filename, 'preview': preview, 'created': datetime.now().isoformat(timespec='seconds')}
+    redis.lpush(JOBS_KEY, json.dumps(job))
+    redis.ltrim(JOBS_KEY, 0, MAX_JOBS - 1)
+    kwargs = {'filename': filename, 'preview': preview, 'upload_id': upload_id, 'digest': digest}
+    import_repairs_task.apply_async(args=(job_id,), kwargs=kwargs, task_id=job_id)
+    return job_id
+
+
+def recent_imports() -> typing.List[dict]:
+    """ The last few import jobs, newest first """
+    return [json.loads(job) for job in redis_client.redis.lrange(JOBS_KEY, 0, MAX_JOBS - 1)]
+
+
+def import_result(job_id: str) -> typing.Optional[dict]:
+    """ The full report of a finished job """
+    raw = redis_client.redis.get(RESULT_KEY.format(job_id))
+    return json.loads(raw) if raw else None
+
+
+def import_status(job_id: str) -> dict:
+    """ Lightweight status of a job: state, processed and total rows and the counts of the report """
+    result = import_result(job_id)
+    if result is not None:
+        status = {key: result[key] for key in ('preview', 'processed', 'total', 'created', 'updated', 'unchanged', 'rejected') if key in result}
+        if 'error' in result:
+            return {'state': 'FAILURE', 'error': result['error'], **status}
+        return {'state': 'SUCCESS', **status}
+
+    task = import_repairs_task.AsyncResult(job_id)
+    status = {'state': task.state}
+    if isinstance(task.info, dict):
+        status.update(task.info)
+    elif task.state == 'FAILURE':
+        status['error'] = str(task.info)
+    return status
+
+
+@celery.task(name='import_repairs', bind=True)
+def import_repairs_task(task, job_id: str, filename: str = None, preview: bool = False, upload_id: str = None, digest: str = None):
+    """
+    Import an upload or only compute its changes (preview).
+    With the digest of a preview (of upload_id) the import only succeeds, if nothing changed since.
+    """
+    conf = current_app.config
+    redis = redis_client.redis
+
+    counts = {'preview': preview, 'processed': 0, 'total': None}
+
+    def progress(processed, total, report):
+        counts.update(processed=processed, total=total)
+        task.update_state(state='PROGRESS', meta={**counts, **report.summary()})
+
+    upload_id = upload_id or job_id
+    try:
+        if not redis.exists(UPLOAD_KEY.format(upload_id)):
+            raise ImportFileError("Die hochgeladene Datei ist nicht mehr vorhanden. Bitte lade sie erneut hoch.")
+        if preview:
+            report = preview_repairs(read_upload(upload_id), chunk_size=conf['IMPORT_CHUNK_SIZE'], progress=progress)
+        else:
+            report = import_repairs(read_upload(upload_id), chunk_size=conf['IMPORT_CHUNK_SIZE'], progress=progress, digest=digest)
+    except Exception as e:
+        redis.setex(RESULT_KEY.format(job_id), conf['IMPORT_RESULT_TIMEOUT'], json.dumps({'error': str(e)}))
+        raise
+
+    result = {'filename': filename, **counts, **report.to_dict()}
+    redis.setex(RESULT_KEY.format(job_id), conf['IMPORT_RESULT_TIMEOUT'], json.dumps(result))
+    # the upload of a preview is imported once the preview is confirmed
+    if not preview:
+        redis.delete(UPLOAD_KEY.format(upload_id))
+    return report.summary()
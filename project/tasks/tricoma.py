@@ -1,34 +1,211 @@
+import typing
+from datetime import datetime
+
 from flask import current_app
+from requests import RequestException
+from sqlalchemy import func, or_
 
 from project.server.common.tricoma_api import TricomaCustomer
-from project.server.common.tricoma_client import extract_customers
-from project.server.extensions import celery
+from project.server.common.tricoma_client import batched
+from project.server.extensions import celery, redis_client
 from project.server.extensions import tricoma_client, tricoma_api
 from project.server.models import Customer
 
+# registration date of the newest Tricoma customer that was synced
+SYNC_MARK_KEY = "tricoma:sync:registered_on"
+# ids of the customers that wait for their registration. A set, so that every customer is queued only once.
+REGISTER_QUEUE_KEY = "tricoma:register:queue"
+# exists while a drain of the queue is scheduled
+REGISTER_SCHEDULED_KEY = "tricoma:register:scheduled"
+
+# customers of the export that are compared with the database at once
+EXPORT_BATCH_SIZE = 500
+# columns of the customer that are kept in sync with the export
+EXPORT_FIELDS = {
+    'last_name': 'name',
+    'first_name': 'vorname',
+    'street': 'strasse',
+    'zip_code': 'plz',
+    'city': 'ort',
+    'tel': 'telefon',
+}
+
 
 def register_tricoma_if_enabled(customer):
-    """ Register the customer on tricoma if TRICOMA_API_URL and is set """
+    """ Queue the customer for the registration on tricoma if TRICOMA_API_URL and REGISTER_CUSTOMER_IN_TRICOMA are set """
     conf = current_app.config
     if conf.get("TRICOMA_API_URL") and conf.get("REGISTER_CUSTOMER_IN_TRICOMA"):
         try:
-            register_customer.apply_async(args=(customer.serialize(),))
+            redis_client.redis.sadd(REGISTER_QUEUE_KEY, customer.id)
+            schedule_registrations(conf['TRICOMA_REGISTER_DELAY'])
         except Exception as e:
             current_app.logger.error(e)
 
 
+def schedule_registrations(countdown: float) -> None:
+    """ Drain the queue after the countdown, unless that is scheduled already. Customers that arrive meanwhile join the batch. """
+    if redis_client.redis.set(REGISTER_SCHEDULED_KEY, 1, nx=True, ex=max(int(countdown), 1) + 60):
+        register_customers.apply_async(countdown=countdown)
+
+
+def _coalesce(customers: typing.Iterable[Customer]) -> typing.Dict[str, typing.List[Customer]]:
+    """ Customers with the same email are registered once, as the newest of them """
+    by_email = {}
+    for customer in sorted(customers, key=lambda c: c.id, reverse=True):
+        by_email.setdefault(customer.email.lower(), []).append(customer)
+    return by_email
+
+
 @celery.task(bind=True, max_retries=3)
-def fetch_customers(task):
-    tricoma = tricoma_client
-    raw_csv = tricoma.export_customers().text
-    customers = extract_customers(raw_csv)
-    return customers
+def fetch_customers(task, batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    """
+    Update the contact data of all customers that are linked to Tricoma with the customer export.
+    The export is processed in batches while it is downloaded: one query and one bulk update per batch.
+    Returns the number of updated customers.
+    """
+    updated = 0
+    for batch in batched(tricoma_client.stream_customers(), batch_size):
+        exported = {customer.id: customer for customer in batch}
+        changes = []
+        with Customer.batch() as session:
+            for customer in Customer.query.filter(Customer.tricoma_id.in_(exported)):
+                values = {column: getattr(exported[customer.tricoma_id], field) for column, field in EXPORT_FIELDS.items()}
+                if any(getattr(customer, column) != value for column, value in values.items()):
+                    changes.append({'id': customer.id, **values})
+            session.bulk_update_mappings(Customer, changes)
+        updated += len(changes)
+    return updated
 
 
 @celery.task(name='register_customer', bind=True, max_retries=3)
 def register_customer(task, customer: dict):
+    """ Register a single customer. Superseded by register_customers, kept for tasks that are still queued. """
     api = tricoma_api
     c = Customer.deserialize(customer)
     tri_c = TricomaCustomer.from_db_model(c)
     c_id = api.register_customer(tri_c)
     return c_id
+
+
+def changed_customers(remote: typing.Iterable[TricomaCustomer]) -> typing.List[dict]:
+    """
+    Link local customers to Tricoma customers and return the changes as mappings for a bulk update.
+    Customers are matched by their Tricoma id first. Customers without one are matched by their email,
+    which Tricoma uses as username. Both lookups use dicts built from a single query.
+    """
+    remote = list(remote)
+    ids = {customer.id for customer in remote}
+    usernames = {customer.username.lower() for customer in remote if customer.username}
+    local = Customer.query.filter(or_(Customer.tricoma_id.in_(ids), func.lower(Customer.email).in_(usernames))).all()
+
+    by_id = {customer.tricoma_id: customer for customer in local if customer.tricoma_id}
+    by_email = {}
+    for customer in local:
+        if not customer.tricoma_id:
+            by_email.setdefault(customer.email.lower(), []).append(customer)
+
+    changes = {}
+    for tricoma_customer in remote:
+        matches = [by_id[tricoma_customer.id]] if tricoma_customer.id in by_id else by_email.get(tricoma_customer.username.lower(), [])
+        for customer in matches:
+            if (customer.tricoma_id, customer.tricoma_username) != (tricoma_customer.id, tricoma_customer.username):
+                changes[customer.id] = {'id': customer.id, 'tricoma_id': tricoma_customer.id, 'tricoma_username': tricoma_customer.username}
+    return list(changes.values())
+
+
+@celery.task(name='sync_tricoma_customers', bind=True, max_retries=3)
+def sync_customers(task) -> int:
+    """
+    Periodically link new Tricoma customers to local customers. Returns the number of updated customers.
+    Only customers that registered since the newest one of the last run are compared (the high-water mark).
+    Customers of that very second are compared again, so that none is missed. Comparing them twice changes nothing.
+    """
+    redis = redis_client.redis
+    raw = redis.get(SYNC_MARK_KEY)
+    mark = datetime.fromisoformat(raw.decode('utf-8')) if raw else None
+
+    remote = [
+        customer for customer in tricoma_api.fetch_customers() or ()
+        if mark is None or (customer.registered_on and customer.registered_on >= mark)
+    ]
+    changes = changed_customers(remote)
+    with Customer.batch() as session:
+        session.bulk_update_mappings(Customer, changes)
+
+    registered = [customer.registered_on for customer in remote if customer.registered_on]
+    if registered:
+        redis.set(SYNC_MARK_KEY, max(registered).isoformat())
+    return len(changes)
+
+
+@celery.task(name='register_customers', bind=True)
+def register_customers(task, batch_size: int = None) -> int:
+    """
+    Register a batch of queued customers on Tricoma over the pooled connection of the API.
+    Customers are loaded with one query and coalesced by email. Customers that already have a Tricoma id are skipped.
+    The Tricoma ids are written back with one bulk update. Returns the number of registered customers.
+    If Tricoma fails, the rest of the batch is queued again and retried later.
+    Customers that Tricoma did not return an id for are queued again as well.
+    On any other error every customer of the batch without a stored Tricoma id is queued again.
+    """
+    conf = current_app.config
+    redis = redis_client.redis
+    redis.delete(REGISTER_SCHEDULED_KEY)
+    ids = [int(customer_id) for customer_id in redis.spop(REGISTER_QUEUE_KEY, batch_size or conf['TRICOMA_REGISTER_BATCH_SIZE'])]
+    if not ids:
+        return 0
+
+    changes = []
+    try:
+        failed = _register_batch(ids, changes)
+        _write_tricoma_ids(changes)
+    except Exception:
+        # keep the Tricoma ids that were already assigned, if the database still works
+        written = set()
+        try:
+            _write_tricoma_ids(changes)
+            written = {change['id'] for change in changes}
+        except Exception:
+            current_app.logger.exception("Could not store the Tricoma ids")
+        lost = set(ids) - written
+        current_app.logger.exception(f"Could not register the customers {sorted(lost)} on Tricoma. They are queued again.")
+        redis.sadd(REGISTER_QUEUE_KEY, *lost)
+        schedule_registrations(conf['TRICOMA_BREAKER_RESET'])
+        raise
+
+    if failed:
+        redis.sadd(REGISTER_QUEUE_KEY, *(customer.id for customer in failed))
+        schedule_registrations(conf['TRICOMA_BREAKER_RESET'])
+    elif redis.scard(REGISTER_QUEUE_KEY):
+        schedule_registrations(0)
+    return len(changes)
+
+
+def _register_batch(ids: typing.List[int], changes: typing.List[dict]) -> typing.List[Customer]:
+    """
+    Register the customers with these ids and append their Tricoma ids to changes as soon as they are known.
+    Returns the customers that have to be queued again.
+    """
+    customers = Customer.query.filter(Customer.id.in_(ids), Customer.tricoma_id.is_(None)).all()
+    failed, unregistered = [], []
+    for duplicates in _coalesce(customers).values():
+        if failed:
+            failed.extend(duplicates)
+            continue
+        try:
+            tricoma_id = tricoma_api.register_customer(TricomaCustomer.from_db_model(duplicates[0]))
+        except (RequestException, ConnectionError) as e:
+            current_app.logger.warning(f"Could not register customers on Tricoma: {e}")
+            failed.extend(duplicates)
+            continue
+        if tricoma_id is None:
+            current_app.logger.warning(f"Tricoma did not return an id for customer {duplicates[0].id} ({duplicates[0].email})")
+            unregistered.extend(duplicates)
+        else:
+            changes.extend({'id': customer.id, 'tricoma_id': str(tricoma_id)} for customer in duplicates)
+    return failed + unregistered
+
+
+def _write_tricoma_ids(changes: typing.List[dict]) -> None:
+    with Customer.batch() as session:
+        session.bulk_update_mappings(Customer, changes)
@@ -69,6 +69,8 @@ def db(app):
     # Explicitly close DB connection
     _db.session.close()
     _db.drop_all()
+    # Every test creates a new app and therefore a new engine. Release its pooled connections.
+    _db.engine.dispose()
 
 
 @pytest.fixture
@@ -1,10 +1,24 @@
 import os
+from datetime import datetime
 
 import pytest
+import requests
+from sqlalchemy.exc import OperationalError
 
+from project.server.common.circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
 from project.server.common.tricoma_api import TricomaAPI, TricomaCustomer, extract_customer_data, TRICOMA_DATE_FMT, TricomaFields
-from project.server.common.tricoma_client import TricomaClient, extract_customers
+from project.server.common.tricoma_client import TricomaClient, extract_customers, parse_customers, batched, ExportedCustomer
+from project.server.extensions import tricoma_client, tricoma_api, redis_client
 from project.server.models import Customer
+from project.tasks import tricoma as tricoma_tasks
+from project.tasks.tricoma import fetch_customers, sync_customers, register_customers, register_tricoma_if_enabled, REGISTER_QUEUE_KEY
+from project.tests.utils import DictRedis
+
+EXPORT_HEADER = "ID|Anrede|Nachname|Vorname|Firma|Strasse|PLZ|Ort|Land|Email|Telefon|Fax|Kategorie|"
+
+
+def export_line(i: int) -> str:
+    return f"{i}|Frau|Name {i}|Vorname {i}||Straße {i}|{10000 + i}|Kiel||{i}@domain.com|{i}|||"
 
 
 class TestTricomaAPI:
@@ -213,3 +227,321 @@ class TestTricomaClient:
             assert False
         except ValueError:
             pass
+
+
+class TestCustomerExport:
+
+    def test_parse_lazily(self):
+        consumed = []
+
+        def lines():
+            for line in [EXPORT_HEADER] + [export_line(i) for i in range(10)]:
+                consumed.append(line)
+                yield line
+
+        customers = parse_customers(lines())
+        first = next(customers)
+        assert isinstance(first, ExportedCustomer)
+        assert first.id == "0" and first.strasse == "Straße 0" and first.mail == "0@domain.com"
+        # only the header and the first customer were read so far
+        assert len(consumed) == 2
+        assert [len(batch) for batch in batched(customers, 4)] == [4, 4, 1]
+
+    def test_skip_incomplete_rows(self):
+        lines = [EXPORT_HEADER, export_line(1), "2|Herr|Kaputt", "", export_line(3)]
+        assert [customer.id for customer in parse_customers(lines)] == ["1", "3"]
+        assert extract_customers("\n".join(lines))[1] == TricomaCustomer(
+            id="3", name="Name 3", vorname="Vorname 3", strasse="Straße 3", plz="10003", ort="Kiel", mail="3@domain.com", telefon="3"
+        )
+
+    def test_stream(self, monkeypatch):
+        class Response:
+            encoding = None
+            closed = False
+
+            def iter_lines(self, chunk_size, decode_unicode):
+                assert decode_unicode and self.encoding == 'utf-8'
+                yield from [EXPORT_HEADER, export_line(1), export_line(2)]
+
+            def close(self):
+                self.closed = True
+
+        response = Response()
+        client = TricomaClient()
+        monkeypatch.setattr(client, 'export_customers', lambda kn, stream: response)
+        assert [customer.id for customer in client.stream_customers()] == ["1", "2"]
+        assert response.closed
+
+    def test_fetch_customers(self, monkeypatch, sample_customer):
+        sample_customer.update(tricoma_id="2")
+        other = Customer.create(first_name="Vorname 3", last_name="Name 3", street="Straße 3", zip_code="10003", city="Kiel",
+                                tel="3", email="3@domain.com", tricoma_id="3")
+        exported = [EXPORT_HEADER] + [export_line(i) for i in range(5)]
+        monkeypatch.setattr(tricoma_client, 'stream_customers', lambda: parse_customers(exported))
+
+        assert fetch_customers(batch_size=2) == 1
+        assert Customer.query.get(sample_customer.id).street == "Straße 2"
+        assert Customer.query.get(sample_customer.id).email == "leon.morten@gmail.com"
+        assert Customer.query.get(other.id).street == "Straße 3"
+
+
+class TestCustomerSync:
+
+    @pytest.fixture
+    def remote(self, app, monkeypatch):
+        customers = []
+        monkeypatch.setattr(tricoma_api, 'fetch_customers', lambda: list(customers))
+        monkeypatch.setattr(redis_client, 'redis', DictRedis())
+        return customers
+
+    def test_sync(self, remote, sample_customer):
+        Customer.create(first_name="A", last_name="B", email="a@b.de", tricoma_id="7", tricoma_username="old")
+        Customer.create(first_name="Test", last_name="Kunde", email="Leon.Morten@gmail.com")
+        remote.extend([
+            TricomaCustomer(id="7", registered_on=datetime(2020, 1, 1), username="a@b.de"),
+            TricomaCustomer(id="8", registered_on=datetime(2020, 1, 2), username="leon.morten@gmail.com"),
+            TricomaCustomer(id="9", registered_on=datetime(2020, 1, 3), username=""),
+        ])
+
+        assert sync_customers() == 3
+        assert [(c.tricoma_id, c.tricoma_username) for c in Customer.query.order_by(Customer.id)] == [
+            ("8", "leon.morten@gmail.com"), ("7", "a@b.de"), ("8", "leon.morten@gmail.com")
+        ]
+        # nothing changed since then
+        assert sync_customers() == 0
+
+    def test_high_water_mark(self, remote, sample_customer):
+        remote.append(TricomaCustomer(id="1", registered_on=datetime(2020, 1, 1), username="someone@else.de"))
+        assert sync_customers() == 0
+
+        # older customers are not compared again, even if they would match now
+        remote.append(TricomaCustomer(id="2", registered_on=datetime(2019, 1, 1), username="leon.morten@gmail.com"))
+        assert sync_customers() == 0
+        assert Customer.query.get(sample_customer.id).tricoma_id is None
+
+        remote.append(TricomaCustomer(id="3", registered_on=datetime(2020, 1, 1), username="leon.morten@gmail.com"))
+        assert sync_customers() == 1
+        assert Customer.query.get(sample_customer.id).tricoma_id == "3"
+
+
+class FakeResponse:
+    def __init__(self, text="", status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+
+class TestTricomaTransport:
+
+    @pytest.fixture
+    def calls(self, monkeypatch):
+        """ Answers of the fake Tricoma, either a response or an exception. Every request pops the first one. """
+        answers = []
+        api = TricomaAPI(base_url="https://tricoma.test", retries=2, backoff=0, failure_threshold=3)
+
+        def get(url, params=None, timeout=None):
+            assert timeout == api.timeout
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        monkeypatch.setattr(api.session, 'get', get)
+        return api, answers
+
+    def test_retry_reading_requests(self, calls):
+        api, answers = calls
+        answers.extend([requests.ConnectionError(), FakeResponse(status_code=503), FakeResponse("1|2019-05-13 - 19:15:01|0|Hello")])
+        assert [customer.id for customer in api.fetch_customers()] == ["1"]
+        assert api.breaker.failures == 0
+
+    def test_never_retry_writes(self, calls):
+        api, answers = calls
+        answers.extend([requests.Timeout(), FakeResponse("42")])
+        with pytest.raises(requests.Timeout):
+            api.register_customer(TricomaCustomer())
+        assert api.register_customer(TricomaCustomer()) == 42
+
+    def test_fail_fast(self, calls):
+        api, answers = calls
+        answers.extend([requests.ConnectionError()] * 3)
+        with pytest.raises(requests.ConnectionError):
+            api.fetch_customers()
+        assert api.breaker.state == OPEN
+        # no request is made while the circuit is open
+        with pytest.raises(CircuitOpenError):
+            api.register_customer(TricomaCustomer())
+        assert not api.test_connection()
+        assert api.metrics()['breaker']['rejected'] == 2
+
+    def test_breaker(self):
+        now = [0.0]
+        breaker = CircuitBreaker("Test", failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+        breaker.failed()
+        breaker.succeeded()
+        breaker.failed()
+        assert breaker.state == CLOSED
+        breaker.failed()
+        assert breaker.state == OPEN
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+        now[0] = 10
+        assert breaker.state == HALF_OPEN
+        breaker.before_call()
+        # only a single trial
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+        breaker.failed()
+        assert breaker.state == OPEN
+
+        now[0] = 20
+        breaker.before_call()
+        breaker.succeeded()
+        assert breaker.state == CLOSED
+        breaker.before_call()
+
+    def test_trial_ends_on_any_error(self, calls):
+        api, answers = calls
+        now = [0.0]
+        api.breaker = CircuitBreaker("Tricoma", failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+        api.breaker.failed()
+        now[0] = 10
+        answers.extend([RuntimeError("bug"), FakeResponse("42")])
+        with pytest.raises(RuntimeError):
+            api.register_customer(TricomaCustomer())
+        assert api.breaker.state == HALF_OPEN
+        # the next call is a trial again instead of being rejected forever
+        assert api.register_customer(TricomaCustomer()) == 42
+        assert api.breaker.state == CLOSED
+
+    def test_metrics(self, testapp, monkeypatch):
+        monkeypatch.setattr(redis_client, 'redis', DictRedis())
+        assert testapp.get("/status/tricoma").json == {'state': CLOSED, 'workers': {}}
+
+        # the worker publishes its metrics after every request
+        monkeypatch.setattr(tricoma_api, 'breaker', CircuitBreaker("Tricoma"))
+        tricoma_api.publish_metrics()
+        workers = testapp.get("/status/tricoma").json['workers']
+        assert [metrics['pool']['size'] for metrics in workers.values()] == [10]
+
+        for _ in range(5):
+            tricoma_api.breaker.failed()
+        tricoma_api.publish_metrics()
+        response = testapp.get("/status/tricoma", status=400)
+        assert response.json['state'] == OPEN
+        assert [metrics['breaker']['state'] for metrics in response.json['workers'].values()] == [OPEN]
+
+        # a circuit that was published as open is half open after the reset timeout
+        monkeypatch.setattr(tricoma_api, 'breaker', CircuitBreaker("Tricoma", failure_threshold=1, reset_timeout=0))
+        tricoma_api.breaker.failed()
+        tricoma_api.publish_metrics()
+        assert testapp.get("/status/tricoma").json['state'] == CLOSED
+
+
+class TestBatchedRegistration:
+
+    @pytest.fixture
+    def queue(self, app, monkeypatch):
+        app.config.update(TRICOMA_API_URL="https://tricoma.test", REGISTER_CUSTOMER_IN_TRICOMA=True)
+        redis = DictRedis()
+        monkeypatch.setattr(redis_client, 'redis', redis)
+        scheduled = []
+        monkeypatch.setattr(tricoma_tasks.register_customers, 'apply_async', lambda countdown: scheduled.append(countdown))
+        return redis, scheduled
+
+    @pytest.fixture
+    def registered(self, monkeypatch):
+        customers = []
+
+        def register(customer):
+            customers.append(customer)
+            return 100 + len(customers)
+
+        monkeypatch.setattr(tricoma_api, 'register_customer', register)
+        return customers
+
+    def test_queue_once(self, queue, sample_customer):
+        redis, scheduled = queue
+        other = Customer.create(first_name="A", last_name="B", email="a@b.de")
+        for customer in (sample_customer, sample_customer, other):
+            register_tricoma_if_enabled(customer)
+        assert redis.scard(REGISTER_QUEUE_KEY) == 2
+        # a single drain for all of them
+        assert scheduled == [10]
+
+    def test_drain(self, queue, registered, sample_customer):
+        redis, scheduled = queue
+        again = Customer.create(first_name="Test", last_name="Kunde", email="Leon.Morten@gmail.com")
+        known = Customer.create(first_name="A", last_name="B", email="a@b.de", tricoma_id="7")
+        other = Customer.create(first_name="C", last_name="D", email="c@d.de")
+        redis.sadd(REGISTER_QUEUE_KEY, sample_customer.id, again.id, known.id, other.id)
+
+        assert register_customers() == 3
+        # one registration per email, none for customers that are known already
+        assert sorted(customer.mail for customer in registered) == ["Leon.Morten@gmail.com", "c@d.de"]
+        ids = {c.id: c.tricoma_id for c in Customer.query}
+        assert ids[sample_customer.id] == ids[again.id] != ids[other.id]
+        assert ids[known.id] == "7"
+        assert redis.scard(REGISTER_QUEUE_KEY) == 0 and scheduled == []
+
+    def test_batches(self, db, queue, registered):
+        redis, scheduled = queue
+        customers = [Customer.create(first_name="A", last_name="B", email=f"{i}@b.de") for i in range(3)]
+        redis.sadd(REGISTER_QUEUE_KEY, *(customer.id for customer in customers))
+        assert register_customers(batch_size=2) == 2
+        # the rest is drained right away
+        assert scheduled == [0]
+        assert register_customers(batch_size=2) == 1
+
+    def test_requeue_on_failure(self, app, queue, monkeypatch, sample_customer):
+        redis, scheduled = queue
+
+        def unavailable(customer):
+            raise CircuitOpenError("down")
+
+        monkeypatch.setattr(tricoma_api, 'register_customer', unavailable)
+        redis.sadd(REGISTER_QUEUE_KEY, sample_customer.id)
+        assert register_customers() == 0
+        assert redis.scard(REGISTER_QUEUE_KEY) == 1
+        assert scheduled == [app.config['TRICOMA_BREAKER_RESET']]
+
+    def test_requeue_without_id(self, app, queue, monkeypatch, sample_customer):
+        redis, scheduled = queue
+        other = Customer.create(first_name="C", last_name="D", email="c@d.de")
+        monkeypatch.setattr(tricoma_api, 'register_customer', lambda customer: None if customer.mail == sample_customer.email else 42)
+        redis.sadd(REGISTER_QUEUE_KEY, sample_customer.id, other.id)
+        assert register_customers() == 1
+        assert Customer.query.get(other.id).tricoma_id == "42"
+        assert redis.spop(REGISTER_QUEUE_KEY, 10) == [str(sample_customer.id).encode()]
+        assert scheduled == [app.config['TRICOMA_BREAKER_RESET']]
+
+    def test_requeue_on_any_error(self, app, queue, monkeypatch, sample_customer):
+        redis, scheduled = queue
+        other = Customer.create(first_name="C", last_name="D", email="c@d.de")
+
+        # the newest customer is registered first
+        def register(customer):
+            if customer.mail == other.email:
+                return 42
+            raise ValueError("This API is not properly set up.")
+
+        monkeypatch.setattr(tricoma_api, 'register_customer', register)
+        redis.sadd(REGISTER_QUEUE_KEY, sample_customer.id, other.id)
+        with pytest.raises(ValueError):
+            register_customers()
+        # the id that Tricoma already assigned is kept, the other customer is queued again
+        assert Customer.query.get(other.id).tricoma_id == "42"
+        assert redis.spop(REGISTER_QUEUE_KEY, 10) == [str(sample_customer.id).encode()]
+        assert scheduled == [app.config['TRICOMA_BREAKER_RESET']]
+
+    def test_requeue_on_database_error(self, queue, registered, monkeypatch, sample_customer):
+        redis, scheduled = queue
+
+        def broken(changes):
+            raise OperationalError("UPDATE customer", {}, Exception("connection lost"))
+
+        monkeypatch.setattr(tricoma_tasks, '_write_tricoma_ids', broken)
+        redis.sadd(REGISTER_QUEUE_KEY, sample_customer.id)
+        with pytest.raises(OperationalError):
+            register_customers()
+        assert redis.scard(REGISTER_QUEUE_KEY) == 1
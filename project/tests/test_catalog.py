@@ -0,0 +1,108 @@
+from project.server.extensions import catalog
+from project.server.models import Repair, Device, Order
+from project.tests.utils import QueryCounter
+
+
+class TestCatalog:
+
+    def test_snapshot_tree(self, sample_repair, sample_device, sample_series, sample_manufacturer, sample_color):
+        snapshot = catalog.get()
+        manufacturer = snapshot.manufacturers[sample_manufacturer.name]
+        assert manufacturer.series[0].name == sample_series.name
+        assert snapshot.series[sample_series.name].devices[0].name == sample_device.name
+
+        device = snapshot.devices[sample_device.name]
+        assert device.series_name == sample_series.name
+        assert device.manufacturer_name == sample_manufacturer.name
+        assert [c.id for c in device.colors] == [sample_color.id]
+        assert [r.id for r in device.repairs] == [sample_repair.id]
+        assert device.repairs[0].price == sample_repair.price
+
+    def test_snapshot_is_reused(self, sample_repair):
+        assert catalog.get() is catalog.get()
+
+    def test_commit_invalidates_snapshot(self, sample_repair, sample_device):
+        snapshot = catalog.get()
+        Repair.create(name="Akku", price=49, device=sample_device)
+
+        new_snapshot = catalog.get()
+        assert new_snapshot is not snapshot
+        assert new_snapshot.version != snapshot.version
+        assert len(new_snapshot.devices[sample_device.name].repairs) == 2
+
+    def test_rename(self, sample_repair, sample_device):
+        catalog.get()
+        sample_device.update(name="iPhone 12")
+        snapshot = catalog.get()
+        assert "iPhone 12" in snapshot.devices
+        assert "iPhone 6S" not in snapshot.devices
+
+    def test_devices_without_repairs_are_hidden(self, sample_repair, sample_series, sample_color):
+        Device.create(name="iPhone 5", colors=[sample_color], series=sample_series)
+        series = catalog.get().series[sample_series.name]
+        assert len(series.devices) == 2
+        assert [d.name for d in series.devices_with_repairs] == [sample_repair.device.name]
+
+    def test_pages_render(self, sample_repair, testapp):
+        device = sample_repair.device
+        assert testapp.get(f"/{device.manufacturer.name}").status_code == 200
+        assert testapp.get(f"/{device.manufacturer.name}/{device.series.name}").status_code == 200
+        response = testapp.get(f"/{device.manufacturer.name}/{device.series.name}/{device.name}/")
+        assert response.status_code == 200
+        assert sample_repair.name in response
+
+    def test_select_repair(self, db, sample_repair, sample_color, testapp):
+        device = sample_repair.device
+        form = testapp.get(f"/{device.manufacturer.name}/{device.series.name}/{device.name}/").forms[0]
+        form['color'] = str(sample_color.id)
+        form.get('repairs', index=0).checked = True
+        with QueryCounter(db.engine) as counter:
+            response = form.submit()
+        assert response.status_code == 302
+        assert Order.query.one().repairs == [sample_repair]
+        # one query for color and repairs, the inserts and the refresh of the order after the commit
+        assert counter.count <= 4
+
+    def test_unknown_names(self, sample_repair, testapp):
+        testapp.get("/Nokia", status=404)
+        testapp.get("/Apple/Lumia", status=404)
+        testapp.get("/Apple/iPhone/iPhone 99/", status=404)
+
+
+class TestHttpCache:
+
+    def test_etag(self, sample_repair, testapp):
+        url = f"/{sample_repair.device.manufacturer.name}"
+        response = testapp.get(url)
+        assert response.etag
+        assert response.last_modified
+        assert 'no-cache' in response.headers['Cache-Control']
+
+        testapp.get(url, headers={'If-None-Match': response.headers['ETag']}, status=304)
+        testapp.get(url, headers={'If-Modified-Since': response.headers['Last-Modified']}, status=304)
+
+    def test_change_invalidates_etag(self, sample_repair, testapp):
+        device = sample_repair.device
+        url = f"/{device.manufacturer.name}/{device.series.name}"
+        etag = testapp.get(url).headers['ETag']
+
+        Device.create(name="iPhone 5", series=device.series, repairs=[Repair(name="Akku", price=29)])
+        response = testapp.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert "iPhone 5" in response
+
+    def test_fragments(self, sample_repair, testapp):
+        device = sample_repair.device
+        url = f"/{device.manufacturer.name}/{device.series.name}/{device.name}/"
+        response = testapp.get(url)
+        assert 'ETag' not in response.headers
+        assert str(sample_repair.price) in response
+
+        sample_repair.update(price=123)
+        assert "123" in testapp.get(url)
+
+    def test_home(self, sample_repair, sample_manufacturer, testapp):
+        response = testapp.get("/")
+        assert response.status_code == 200
+        assert f"/{sample_manufacturer.name}" in response
@@ -0,0 +1,59 @@
+import pytest
+from sqlalchemy import event
+
+from project.server.models import Repair, Manufacturer
+
+
+@pytest.fixture
+def commits(db):
+    calls = []
+    session = db.session()
+
+    def listener(session):
+        calls.append(session)
+
+    event.listen(session, 'after_commit', listener)
+    yield calls
+    event.remove(session, 'after_commit', listener)
+
+
+class TestBatch:
+
+    def test_single_commit(self, db, sample_device, commits):
+        with Repair.batch():
+            first = Repair.create(name="Display", price=10, device=sample_device)
+            second = Repair.create(name="Akku", price=20, device=sample_device)
+            second.update(price=30)
+            assert Repair.in_batch()
+            assert not commits
+        assert len(commits) == 1
+        assert not Repair.in_batch()
+        assert first.id and second.id
+        assert Repair.query.get(second.id).price == 30
+
+    def test_rollback(self, db, sample_device, commits):
+        with pytest.raises(RuntimeError):
+            with Repair.batch():
+                Repair.create(name="Display", price=10, device=sample_device)
+                raise RuntimeError()
+        assert not commits
+        assert Repair.query.count() == 0
+
+        # the session is usable again and commits per call outside of a batch
+        Repair.create(name="Display", price=10, device=sample_device)
+        assert len(commits) == 1
+
+    def test_nested(self, db, commits):
+        with Manufacturer.batch():
+            with Manufacturer.batch():
+                Manufacturer.create(name="Apple")
+            assert not commits
+            Manufacturer.create(name="Samsung")
+        assert len(commits) == 1
+        assert Manufacturer.query.count() == 2
+
+    def test_destroy_is_atomic(self, db, sample_repair, commits):
+        with pytest.raises(AttributeError):
+            Repair.destroy(sample_repair.id, -1)
+        assert not commits
+        assert Repair.query.count() == 1
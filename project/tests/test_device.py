@@ -1,7 +1,8 @@
 import random
 import string
 
-from project.server.models import Device
+from project.server.models import Device, DeviceSeries
+from project.tests.utils import QueryCounter
 
 
 class TestDevice:
@@ -61,3 +62,51 @@ class TestDevice:
         for i in range(100):
             first.move_down()
         assert first.order_index == 9
+
+    def test_move_many(self, sample_series, sample_color):
+        devices = [Device.create(name=f"Device {i}", colors=[sample_color], series=sample_series) for i in range(5)]
+        ids = [device.id for device in devices]
+
+        Device.move_many([ids[0], ids[1], ids[3]], up=True)
+        assert [d.id for d in Device.query.order_by(Device.order_index)] == [ids[0], ids[1], ids[3], ids[2], ids[4]]
+
+        Device.move_many([ids[2], ids[4]], up=False)
+        assert [d.id for d in Device.query.order_by(Device.order_index)] == [ids[0], ids[1], ids[3], ids[2], ids[4]]
+
+        Device.move_many([ids[0], ids[3]], up=False)
+        assert [d.id for d in Device.query.order_by(Device.order_index)] == [ids[1], ids[0], ids[2], ids[3], ids[4]]
+
+    def test_concurrent_inserts(self, db, sample_series):
+        # two transactions that insert at the same time must not share an index
+        table = Device.__table__
+        with db.engine.connect() as first, db.engine.connect() as second:
+            with first.begin(), second.begin():
+                first.execute(table.insert().values(name="A", series_id=sample_series.id))
+                second.execute(table.insert().values(name="B", series_id=sample_series.id))
+        indexes = [d.order_index for d in Device.query.order_by(Device.name)]
+        assert len(set(indexes)) == 2
+
+    def test_normalize_is_one_statement(self, db, sample_series):
+        devices = [Device.create(name=f"Device {i}", series=sample_series, order_index=100 - i) for i in range(5)]
+        ids = [device.id for device in devices]
+
+        with QueryCounter(db.engine) as counter:
+            Device.normalize()
+        # the update and the commit
+        assert counter.count <= 2
+        assert [(d.id, d.order_index) for d in Device.query.order_by(Device.order_index)] == list(zip(reversed(ids), range(5)))
+
+    def test_normalize_selection(self, sample_series):
+        devices = [Device.create(name=name, series=sample_series, order_index=10 + i) for i, name in enumerate("ABCD")]
+
+        Device.normalize([devices[1].id, devices[3].id], order_by=Device.name.desc())
+        assert [d.order_index for d in devices] == [10, 1, 12, 0]
+
+    def test_normalize_per_series(self, sample_series):
+        ipad = DeviceSeries.create(name="iPad", manufacturer=sample_series.manufacturer)
+        phones = [Device.create(name=f"iPhone {i}", series=sample_series, order_index=2 * i) for i in range(3)]
+        tablets = [Device.create(name=f"iPad {i}", series=ipad, order_index=2 * i + 1) for i in range(3)]
+
+        Device.normalize(per=Device.series_id)
+        assert [d.order_index for d in phones] == [0, 1, 2]
+        assert [d.order_index for d in tablets] == [0, 1, 2]
@@ -1,7 +1,9 @@
+from flask import g
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 
 from project.server.models import Manufacturer, Repair, Device
-from project.server.models.image import Default, Image
+from project.server.models.image import Default, Image, default_images
 
 
 class TestImage:
@@ -61,3 +63,34 @@ class TestImage:
             assert False
         except IntegrityError:
             return True
+
+    def test_defaults_are_cached_per_process(self, app, db, sample_device, sample_image):
+        sample_image.device_default = Default.true
+        sample_image.save()
+        assert default_images().device == sample_image
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        # simulate a new request with a fresh session
+        g.pop('default_images')
+        db.session.remove()
+        images = default_images()
+        assert images.device.id == sample_image.id
+        assert images.device.get_path() == sample_image.get_path()
+        assert not any('FROM image' in statement for statement in statements)
+
+    def test_defaults_are_invalidated(self, db, sample_device, sample_image):
+        assert default_images().device is None
+        sample_image.device_default = Default.true
+        sample_image.save()
+        assert default_images().device is sample_image
+
+        sample_image.device_default = None
+        sample_image.save()
+        assert default_images().device is None
+
+    def test_named_fallbacks(self, db, sample_repair):
+        other = Image.create(name="default_phone_other.svg", path="other.svg")
+        assert sample_repair.get_image() is other
+        assert default_images().named("default_phone_other.svg") is other
+        assert default_images().named("default_tablet_other.svg") is None
@@ -0,0 +1,379 @@
+from decimal import Decimal
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from flask import url_for
+
+from project.server.common.import_repair import import_repairs, parse_csv, preview_repairs, ImportFileError, \
+    StalePreviewError, decode, str_to_dec, read_csv, RepairImporter
+from project.server.extensions import catalog, celery
+from project.server.models import Device, Repair, Manufacturer, DeviceSeries
+from project.tasks import imports
+from project.tests.utils import QueryCounter, DictRedis, login
+
+HEADER = "Hersteller,Serie,Gerät,Farbe,Reparatur,Preis (in €)\n"
+
+
+def price_list(*lines):
+    return HEADER + "\n".join(lines) + "\n"
+
+
+class TestParse:
+
+    def test_header(self):
+        with pytest.raises(ImportFileError):
+            parse_csv("Hersteller,Serie,Gerät\nApple,iPhone,iPhone X\n")
+        with pytest.raises(ImportFileError):
+            parse_csv("")
+
+    def test_rows(self):
+        rows, rejected = parse_csv(price_list(
+            'Apple,iPhone,iPhone X,"black, white",Display,"199.90"',
+            'Apple,iPhone,iPhone X,,Akku,abc',
+            'Apple,iPhone,iPhone X,Akku,49',
+            ',iPhone,iPhone X,,Akku,49',
+            '',
+        ))
+        assert len(rows) == 1
+        assert rows[0].line == 2
+        assert rows[0].colors == ('black', 'white')
+        assert rows[0].price == Decimal('199.90')
+        assert [r.line for r in rejected] == [3, 4, 5]
+
+    def test_decode(self):
+        text = "Gerät,Größe €\n"
+        utf8 = text.encode('utf-8')
+        # multi byte characters that are split between two blocks
+        assert "".join(decode([utf8[:4], utf8[4:9], utf8[9:]])) == text
+        assert "".join(decode([b'\xef\xbb\xbf' + utf8])) == text
+        # not UTF-8, but everything before was ASCII
+        cp1252 = text.encode('cp1252')
+        assert "".join(decode([cp1252[:3], cp1252[3:]])) == text
+        with pytest.raises(ImportFileError):
+            list(decode([utf8, cp1252]))
+
+    def test_blocks(self):
+        content = price_list(
+            'Apple,iPhone,iPhone X,"black, white",Display,"199.90"',
+            'Apple,iPhone,iPhone X,,Akku,abc',
+        ).encode('cp1252')
+        rows, rejected = parse_csv(content[i:i + 7] for i in range(0, len(content), 7))
+        assert rows[0].colors == ('black', 'white')
+        assert rows[0].price == Decimal('199.90')
+        assert [r.line for r in rejected] == [3]
+
+    def test_semicolon(self):
+        rows, rejected = parse_csv(
+            "Hersteller;Serie;Gerät;Farbe;Reparatur;Preis (in €)\n"
+            "Apple;iPhone;iPhone X;black,white;Display;1.199,90\n"
+            'Apple;iPhone;iPhone X;;"Akku\nund Kleber";49\n'
+        )
+        assert not rejected
+        assert rows[0].colors == ('black', 'white')
+        assert rows[0].price == Decimal('1199.90')
+        assert rows[1].repair == 'Akku\nund Kleber'
+
+    def test_semicolon_with_decimal_points(self):
+        rows, rejected = parse_csv(
+            "Hersteller;Serie;Gerät;Farbe;Reparatur;Preis (in €)\n"
+            "Apple;iPhone;iPhone X;;Display;69.90\n"
+            "Apple;iPhone;iPhone X;;Akku;1,299.90\n"
+            "Apple;iPhone;iPhone X;;Kamera;19,9\n"
+            "Apple;iPhone;iPhone X;;Backcover;1.299\n"
+        )
+        assert [row.price for row in rows] == [Decimal('69.90'), Decimal('1299.90'), Decimal('19.9')]
+        # 1299 or 1.299? Better reject than guess
+        assert [r.line for r in rejected] == [5]
+
+    def test_prices(self):
+        assert str_to_dec("1.234.567,00") == Decimal('1234567.00')
+        assert str_to_dec("1.234.567") == Decimal('1234567')
+        for price in ("1,299", "1.299.90", "12.34.56", "1,2,3", "abc", ""):
+            assert str_to_dec(price) is None
+
+
+class TestImport:
+
+    def test_create(self, db, sample_color):
+        report = import_repairs(price_list(
+            f'Apple,iPhone,iPhone X,{sample_color.internal_name},Display,199',
+            f'Apple,iPhone,iPhone X,{sample_color.internal_name},Akku,49',
+            'Apple,iPad,iPad Pro,,Display,299',
+        ))
+        assert len(report.created) == 3
+        assert report.new_manufacturers == ['Apple']
+        assert report.new_series == ['iPhone', 'iPad']
+        assert report.new_devices == ['iPhone X', 'iPad Pro']
+
+        device = Device.query.filter(Device.name == 'iPhone X').one()
+        assert device.series.manufacturer.name == 'Apple'
+        assert device.colors == [sample_color]
+        assert sorted(r.name for r in device.repairs) == ['Akku', 'Display']
+        assert Manufacturer.query.one().activated
+        assert DeviceSeries.query.count() == 2
+        assert Device.query.filter(Device.name == 'iPad Pro').one().order_index > device.order_index
+
+    def test_series_and_device_with_the_same_name(self, db):
+        import_repairs(price_list(
+            'Samsung,Galaxy,iPhone SE,,Display,10',
+            'Apple,iPhone SE,iPhone SE 2020,,Display,10',
+        ))
+        assert DeviceSeries.query.filter(DeviceSeries.name == 'iPhone SE').one().manufacturer.name == 'Apple'
+        assert Device.query.filter(Device.name == 'iPhone SE').one().series.name == 'Galaxy'
+
+    def test_diff(self, db, sample_repair, sample_color):
+        device = sample_repair.device
+        old_price = sample_repair.price
+        line = f'{device.manufacturer.name},{device.series.name},{device.name},{sample_color.internal_name}'
+        report = import_repairs(price_list(
+            f'{line},{sample_repair.name},{sample_repair.price}',
+            f'{line},Akku,49',
+            f'{line},Akku,59',
+            f'{line},Backcover,39',
+            f'{device.manufacturer.name},{device.series.name},{device.name},unknown_color,Kamera,39',
+        ))
+        # unchanged rows are only counted
+        assert report.summary()['unchanged'] == 1 and not report.unchanged
+        assert len(report.created) == 2
+        assert [r.line for r in report.rejected] == [4, 6]
+        assert not report.new_devices
+        assert Repair.query.count() == 3
+
+        report = import_repairs(price_list(f'{line},{sample_repair.name},1.50'))
+        assert report.updated[0].old_price == old_price
+        db.session.refresh(sample_repair)
+        assert sample_repair.price == Decimal('1.50')
+
+    def test_constant_number_of_queries(self, db, sample_color):
+        def lines(count, price):
+            return price_list(*(f'Apple,iPhone,iPhone {i},{sample_color.internal_name},Display,{price}' for i in range(count)))
+
+        with QueryCounter(db.engine) as small:
+            import_repairs(lines(2, 10))
+        with QueryCounter(db.engine) as large:
+            report = import_repairs(lines(200, 20))
+        assert len(report.created) == 198
+        assert len(report.updated) == 2
+        assert large.count <= small.count + 1
+
+    def test_bumps_catalog(self, db, sample_repair):
+        snapshot = catalog.get()
+        device = sample_repair.device
+        import_repairs(price_list(f'{device.manufacturer.name},{device.series.name},{device.name},,Akku,49'))
+        assert len(catalog.get().devices[device.name].repairs) == 2
+        assert catalog.get() is not snapshot
+
+    def test_chunks(self, db, sample_color):
+        calls, lines = [], []
+
+        def blocks():
+            yield HEADER.encode('utf-8')
+            for i in range(5):
+                lines.append(i)
+                yield f'Apple,iPhone,iPhone {i},,Display,10\n'.encode('utf-8')
+            yield b'Apple,iPhone,iPhone 0,,Akku,x\n'
+
+        report = import_repairs(
+            blocks(),
+            chunk_size=2,
+            progress=lambda processed, total, report: calls.append((processed, total, len(report.created), len(lines)))
+        )
+        # the file is consumed chunk by chunk
+        assert calls == [(2, None, 2, 2), (4, None, 4, 4), (5, None, 5, 5)]
+        assert len(report.created) == 5
+        assert [r.line for r in report.rejected] == [7]
+        assert report.new_devices == [f'iPhone {i}' for i in range(5)]
+
+    def test_sample(self, db, sample_color):
+        rows, rejected = read_csv(price_list(
+            *(f'Apple,iPhone,iPhone {i},,Display,10' for i in range(10)),
+            *(f'Apple,iPhone,iPhone {i},,Akku,x' for i in range(5)),
+            'Apple,iPhone,iPhone 0,,Display,10',
+        ))
+        report = RepairImporter(sample_size=2).run(rows, rejected, chunk_size=3)
+        assert report.summary() == {'created': 10, 'updated': 0, 'unchanged': 0, 'rejected': 6}
+        assert [change.row.device for change in report.created] == ['iPhone 0', 'iPhone 1']
+        assert [r.line for r in report.rejected] == [12, 13]
+        # the parser's list is emptied chunk by chunk
+        assert rejected == []
+        assert report.count == 10
+        assert report.to_dict()['created'] == 10
+        # duplicates of rows that were written in an earlier chunk
+        report = RepairImporter(sample_size=2).run(*read_csv(price_list('Apple,iPhone,iPhone 0,,Display,10', 'Apple,iPhone,iPhone 0,,Display,12')), chunk_size=1)
+        assert report.summary()['unchanged'] == 1
+        assert [r.reason for r in report.rejected] == ["iPhone 0 Display kommt mehrfach vor."]
+
+
+class TestPreview:
+
+    def price_list(self, repair, color):
+        device = repair.device
+        line = f'{device.manufacturer.name},{device.series.name},{device.name}'
+        return price_list(
+            f'{line},{color.internal_name},{repair.name},1.50',
+            f'{line},,Akku,49',
+            f'{line},unknown_color,Kamera,39',
+            f'{device.manufacturer.name},{device.series.name},iPhone 99,,Display,199',
+        )
+
+    def test_preview_writes_nothing(self, db, sample_repair, sample_color):
+        old_price = sample_repair.price
+        report = preview_repairs(self.price_list(sample_repair, sample_color))
+        assert [str(change.row) for change in report.created] == [f'{sample_repair.device.name} Akku', 'iPhone 99 Display']
+        assert report.updated[0].old_price == old_price
+        assert report.to_dict()['updated_rows'][0]['delta'] == f"{Decimal('1.50') - old_price:+}"
+        assert report.unknown_colors == ['unknown_color']
+        assert report.new_devices == ['iPhone 99']
+
+        db.session.rollback()
+        assert Repair.query.count() == 1
+        assert Device.query.count() == 1
+        assert Repair.query.get(sample_repair.id).price == old_price
+
+    def test_constant_number_of_queries(self, db, sample_color):
+        small_list, large_list = (
+            price_list(*(f'Apple,iPhone,iPhone {i},{sample_color.internal_name},Display,10' for i in range(count))) for count in (2, 200)
+        )
+        with QueryCounter(db.engine) as small:
+            preview_repairs(small_list)
+        with QueryCounter(db.engine) as large:
+            preview_repairs(large_list)
+        assert large.count == small.count
+
+    def test_digest(self, db, sample_repair, sample_color):
+        report = preview_repairs(self.price_list(sample_repair, sample_color))
+        assert report.digest
+        assert preview_repairs(self.price_list(sample_repair, sample_color), chunk_size=1).digest == report.digest
+        assert preview_repairs(self.price_list(sample_repair, sample_color).replace('1.50', '1.60')).digest != report.digest
+        assert report.to_dict()['digest'] == report.digest
+
+    def test_import_preview(self, db, sample_repair, sample_color):
+        preview = preview_repairs(self.price_list(sample_repair, sample_color))
+        report = import_repairs(self.price_list(sample_repair, sample_color), chunk_size=1, digest=preview.digest)
+        assert report.digest == preview.digest
+        assert report.unknown_colors == ['unknown_color']
+        assert [r.line for r in report.rejected] == [4]
+        assert Repair.query.count() == 3
+        assert Repair.query.get(sample_repair.id).price == Decimal('1.50')
+
+    def test_stale(self, db, sample_repair, sample_color):
+        preview = preview_repairs(self.price_list(sample_repair, sample_color))
+        sample_repair.price = Decimal('2.50')
+        db.session.commit()
+        with pytest.raises(StalePreviewError):
+            import_repairs(self.price_list(sample_repair, sample_color), digest=preview.digest)
+        assert Repair.query.count() == 1
+        assert Repair.query.get(sample_repair.id).price == Decimal('2.50')
+
+
+@pytest.fixture
+def job_env(monkeypatch):
+    """ Run import jobs eagerly and keep uploads, results and progress in memory """
+    redis = DictRedis()
+    progress = []
+    monkeypatch.setattr(imports, 'redis_client', SimpleNamespace(redis=redis))
+    monkeypatch.setitem(celery.conf, 'task_always_eager', True)
+    monkeypatch.setattr(imports.import_repairs_task, 'update_state', lambda state, meta: progress.append((state, meta)))
+    return SimpleNamespace(redis=redis, progress=progress)
+
+
+class TestImportJob:
+
+    def test_job(self, app, db, sample_color, job_env):
+        app.config['IMPORT_CHUNK_SIZE'] = 1
+        content = price_list('Apple,iPhone,iPhone X,,Display,199', 'Apple,iPhone,iPhone X,,Akku,x').encode('utf-8')
+        job_id = imports.start_import(BytesIO(content), 'prices.csv')
+        assert [meta['processed'] for _, meta in job_env.progress] == [1]
+        assert job_env.progress[0][0] == 'PROGRESS'
+
+        status = imports.import_status(job_id)
+        assert status['state'] == 'SUCCESS'
+        assert status['created'] == 1
+        assert status['rejected'] == 1
+        assert imports.import_result(job_id)['rejected_rows'][0]['line'] == 3
+        assert imports.recent_imports()[0]['id'] == job_id
+        # the upload is not needed anymore
+        assert imports.UPLOAD_KEY.format(job_id) not in job_env.redis.data
+
+    def test_missing_upload(self, db, job_env):
+        imports.import_repairs_task.apply(args=('unknown',), task_id='unknown')
+        status = imports.import_status('unknown')
+        assert status['state'] == 'FAILURE'
+        assert status['error']
+
+    def test_admin_upload(self, user, db, sample_color, testapp, job_env):
+        login(testapp, user.email, "admin")
+        form = testapp.get(url_for("importview.index")).forms[0]
+        content = price_list(f'Apple,iPhone,iPhone X,{sample_color.internal_name},Display,199', 'Apple,iPhone,iPhone X,,Akku,x')
+        form['repair_file'] = ('prices.csv', content.encode('cp1252'))
+        form['preview'] = False
+        response = form.submit().follow()
+        assert "Der Import ist abgeschlossen" in response
+        assert "Akku" in response
+        assert Repair.query.count() == 1
+
+        job_id = imports.recent_imports()[0]['id']
+        status = testapp.get(url_for("importview.status", job_id=job_id)).json
+        assert status['state'] == 'SUCCESS'
+        assert status['created'] == 1
+        assert "prices.csv" in testapp.get(url_for("importview.index"))
+
+    def test_preview(self, db, sample_repair, job_env):
+        device, repair_id = sample_repair.device, sample_repair.id
+        content = price_list(f'{device.manufacturer.name},{device.series.name},{device.name},,{sample_repair.name},1.50').encode('utf-8')
+        preview_id = imports.start_import(BytesIO(content), 'prices.csv', preview=True)
+        status = imports.import_status(preview_id)
+        assert status['state'] == 'SUCCESS'
+        assert status['preview'] is True
+        assert status['updated'] == 1
+        assert imports.recent_imports()[0]['preview'] is True
+        assert Repair.query.get(repair_id).price != Decimal('1.50')
+
+        job_id = imports.confirm_preview(preview_id)
+        assert imports.import_status(job_id)['state'] == 'SUCCESS'
+        assert imports.import_result(job_id)['digest'] == imports.import_result(preview_id)['digest']
+        assert imports.import_result(job_id)['filename'] == 'prices.csv'
+        assert Repair.query.get(repair_id).price == Decimal('1.50')
+        # the upload of the preview is gone
+        assert imports.confirm_preview(preview_id) is None
+        assert imports.confirm_preview(job_id) is None
+        assert imports.confirm_preview('unknown') is None
+
+    def test_stale_preview(self, db, sample_repair, job_env):
+        device = sample_repair.device
+        content = price_list(f'{device.manufacturer.name},{device.series.name},{device.name},,{sample_repair.name},1.50').encode('utf-8')
+        repair_id = sample_repair.id
+        preview_id = imports.start_import(BytesIO(content), preview=True)
+        Repair.query.get(repair_id).price = Decimal('1.50')
+        db.session.commit()
+
+        status = imports.import_status(imports.confirm_preview(preview_id))
+        assert status['state'] == 'FAILURE'
+        assert "seit der Vorschau" in status['error']
+
+    def test_admin_preview(self, user, db, sample_color, testapp, job_env):
+        login(testapp, user.email, "admin")
+        form = testapp.get(url_for("importview.index")).forms[0]
+        content = price_list(f'Apple,iPhone,iPhone X,{sample_color.internal_name},Display,199', 'Apple,iPhone,iPhone X,unknown_color,Akku,49')
+        form['repair_file'] = ('prices.csv', content.encode('utf-8'))
+        response = form.submit().follow()
+        assert "Vorschau" in response
+        assert "Unbekannte Farben: unknown_color" in response
+        assert Repair.query.count() == 0
+
+        response = response.forms[0].submit().follow()
+        assert "Der Import ist abgeschlossen" in response
+        assert Repair.query.count() == 1
+        assert imports.recent_imports()[0]['filename'] == 'prices.csv'
+        assert "(Vorschau)" in testapp.get(url_for("importview.index"))
+
+    def test_admin_expired_preview(self, user, db, testapp, job_env):
+        login(testapp, user.email, "admin")
+        form = testapp.get(url_for("importview.index")).forms[0]
+        form['repair_file'] = ('prices.csv', price_list('Apple,iPhone,iPhone X,,Display,199').encode('utf-8'))
+        response = form.submit().follow()
+        job_env.redis.data.clear()
+        response = response.forms[0].submit().follow()
+        assert "Die Vorschau ist abgelaufen" in response
+        assert Repair.query.count() == 0
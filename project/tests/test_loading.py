@@ -0,0 +1,57 @@
+import pytest
+
+from project.server.models import Device, Repair, DeviceSeries
+from project.server.models.image import Default
+from project.tests.utils import QueryCounter
+
+
+class TestLoadingProfiles:
+
+    def test_unknown_profile(self, db):
+        with pytest.raises(ValueError):
+            Device.loading_profile('does not exist')
+
+    def test_all_models_have_profiles(self, db):
+        assert Device.loading_profile('grid')
+        assert Device.loading_profile('detail')
+        assert Repair.loading_profile('grid')
+        assert Repair.loading_profile('with_device')
+        assert DeviceSeries.loading_profile('devices')
+
+    def test_detail_has_constant_cost(self, db, sample_device, sample_image):
+        sample_image.repair_default = Default.true
+        sample_image.save()
+        for i in range(15):
+            Repair.create(name=f"Repair {i}", price=i, device=sample_device)
+        device_id = sample_device.id
+        db.session.expire_all()
+
+        with QueryCounter(db.engine) as counter:
+            device = Device.query_profile('detail').filter(Device.id == device_id).one()
+            for repair in device.repairs:
+                assert repair.get_image_path()
+            assert device.manufacturer.name
+            assert device.colors
+        # device + colors + repairs + default images
+        assert counter.count == 4
+
+
+class TestDefaultImages:
+
+    def test_resolved_once(self, db, sample_repair, sample_device, sample_image):
+        sample_image.device_default = Default.true
+        sample_image.save()
+        assert sample_device.get_image() is sample_image
+        assert sample_repair.get_image() is None
+
+        with QueryCounter(db.engine) as counter:
+            for _ in range(10):
+                assert sample_device.get_image() is sample_image
+                assert sample_repair.get_image() is None
+        assert counter.count == 0
+
+    def test_image_changes_are_visible(self, db, sample_device, sample_image):
+        assert sample_device.get_image() is None
+        sample_image.device_default = Default.true
+        sample_image.save()
+        assert sample_device.get_image() is sample_image
@@ -1,4 +1,7 @@
-from project.server.models import Device
+from flask import url_for
+
+from project.server.models import Device, Repair, Order
+from project.tests.utils import QueryCounter, login
 
 
 class TestMerge:
@@ -34,3 +37,46 @@ class TestMerge:
     def test_delete(self, sample_device, some_devices):
         Device.merge([sample_device.id, ] + list(map(lambda d: d.id, some_devices)))
         assert Device.query.count() == 1
+
+    def test_duplicate_repairs_keep_orders(self, db, sample_device, sample_repair, another_device, sample_color):
+        duplicate = Repair.create(name=sample_repair.name, price=10, device=another_device)
+        battery = Repair.create(name="Akku", price=10, device=another_device)
+        orders = [
+            Order.create(color=sample_color, repairs=[sample_repair]),
+            Order.create(color=sample_color, repairs=[duplicate, battery]),
+            Order.create(color=sample_color, repairs=[sample_repair, duplicate]),
+        ]
+        order_ids = [order.id for order in orders]
+        kept, battery_id = sample_repair.id, battery.id
+
+        merger = Device.merge([sample_device.id, another_device.id])
+        assert sorted(repair.id for repair in merger.repairs) == [kept, battery_id]
+        assert Repair.query.count() == 2
+        assert [sorted(r.id for r in Order.query.get(order_id).repairs) for order_id in order_ids] == [[kept], [kept, battery_id], [kept]]
+
+    def test_groups(self, db, sample_device, some_devices, sample_color):
+        first, second = some_devices[:2], some_devices[2:5]
+        first_name, second_name = first[0].name, second[0].name
+        groups = [[device.id for device in first], [device.id for device in second]]
+        with QueryCounter(db.engine) as counter:
+            mergers = Device.merge_groups(groups)
+        assert [merger.name for merger in mergers] == [first_name, second_name]
+        assert all(merger.colors == [sample_color] for merger in mergers)
+        assert Device.query.count() == len(some_devices) + 1 - 5 + 2
+
+        groups = [[device.id for device in some_devices[5:7]], [device.id for device in some_devices[7:10]]]
+        with QueryCounter(db.engine) as other:
+            Device.merge_groups(groups)
+        assert other.count == counter.count
+
+    def test_admin_merge_by_name(self, db, user, testapp, sample_series, sample_color):
+        devices = [
+            Device.create(name=name, colors=[sample_color], series=sample_series)
+            for name in ("iPhone 6S +", "iphone 6s+", "IPHONE 6S +", "iPhone 7", "iphone  7", "iPhone 8")
+        ]
+        login(testapp, user.email, "admin")
+        form = testapp.get(url_for("device.index_view")).forms['action_form']
+        testapp.post(url_for("device.action_view"), {
+            'csrf_token': form['csrf_token'].value, 'action': 'merge_by_name', 'rowid': [device.id for device in devices]
+        }).follow()
+        assert sorted(device.name for device in Device.query) == ["iPhone 6S +", "iPhone 7", "iPhone 8"]
@@ -1,8 +1,13 @@
+from decimal import Decimal
+
+import pytest
 from flask import session
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import FlushError
 
+from project.server.common.pricing import PriceBreakdown
 from project.server.models import Repair, Order
+from project.tests.utils import QueryCounter
 
 
 class TestOrder:
@@ -64,6 +69,34 @@ class TestOrder:
         except FlushError:
             return True
 
+    def test_create_for_device(self, db, sample_color, sample_repair):
+        device = sample_repair.device
+        device.colors = [sample_color]
+        another = Repair.create(name="Akku", price=49, device=device)
+        ids = (device.id, sample_color.id, [another.id, sample_repair.id])
+
+        with QueryCounter(db.engine) as counter:
+            order = Order.create_for_device(*ids, problem_description="Text")
+        # one select, the order, the associations and the commit
+        assert counter.count <= 4
+        db.session.expire_all()
+        order = Order.query.get(order.id)
+        assert order.color == sample_color
+        assert sorted(order.repairs, key=lambda r: r.id) == [sample_repair, another]
+        assert order.problem_description == "Text"
+
+    def test_create_for_device_validates(self, db, sample_color, sample_repair, another_repair):
+        device = sample_repair.device
+        device.colors = [sample_color]
+        db.session.commit()
+        with pytest.raises(ValueError):
+            Order.create_for_device(device.id, sample_color.id, [sample_repair.id, another_repair.id])
+        with pytest.raises(ValueError):
+            Order.create_for_device(device.id, -1, [sample_repair.id])
+        with pytest.raises(ValueError):
+            Order.create_for_device(device.id, sample_color.id, [])
+        assert Order.query.count() == 0
+
     def test_deserialize(self, sample_color, sample_repair, sample_shop):
         another_repair = Repair.create(name="dfgdfgdfgdfg", price=69, device=sample_repair.device)
         dto = Order.create(
@@ -94,10 +127,51 @@ class TestOrder:
             problem_description="Some Text"
         )
 
-        assert dto.total_cost_including_tax_and_discount == 108.2
+        assert dto.total_cost_including_tax_and_discount == Decimal('108.20')
         assert dto.total_cost == 118
-        assert dto.taxes == 20.56
-        assert dto.discount == 9.8
+        assert dto.taxes == Decimal('20.56')
+        assert dto.discount == Decimal('9.80')
+
+    def test_price_breakdown(self):
+        assert PriceBreakdown.from_prices([]) == PriceBreakdown()
+        assert PriceBreakdown.from_prices([Decimal('69.00')]) == PriceBreakdown(
+            Decimal('69.00'), Decimal('0.00'), Decimal('69.00'), Decimal('13.11')
+        )
+        # 20 % of 0.125 is exactly 0.025 and rounds half up
+        breakdown = PriceBreakdown.from_prices([Decimal('0.125'), Decimal('10')])
+        assert breakdown.subtotal == Decimal('10.13')
+        assert breakdown.discount == Decimal('0.03')
+        assert breakdown.total == Decimal('10.10')
+        assert breakdown.tax == Decimal('1.92')
+
+    def test_price_breakdown_is_memoized(self, db, sample_color, sample_repair, another_repair):
+        order = Order.create(color=sample_color, repairs=[sample_repair, another_repair])
+        breakdown = order.price_breakdown
+        with QueryCounter(db.engine) as counter:
+            for _ in range(3):
+                assert (order.total_cost, order.discount, order.taxes) == (breakdown.subtotal, breakdown.discount, breakdown.tax)
+                assert order.total_cost_including_tax_and_discount == breakdown.total
+        assert counter.count == 0
+        assert order.price_breakdown is breakdown
+
+        another = Repair.create(name="Akku", price=10, device=sample_repair.device)
+        order.append_repair(another)
+        assert order.total_cost == breakdown.subtotal + 10
+        assert order.discount == Decimal('2.00')
+
+    def test_price_is_stored_on_completion(self, db, sample_color, sample_repair, another_repair):
+        order = Order.create(color=sample_color, repairs=[sample_repair, another_repair])
+        assert order.price_total is None
+        breakdown = order.price_breakdown
+
+        order.set_complete()
+        assert order.price_total == breakdown.total
+        assert order.price_tax == breakdown.tax
+
+        # later changes of the repairs do not change completed orders
+        sample_repair.update(price=sample_repair.price + 100)
+        db.session.expire_all()
+        assert Order.query.get(order.id).price_breakdown == breakdown
 
     def test_session_save(self, sample_color, sample_repair):
         order = Order.create(
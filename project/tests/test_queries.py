@@ -1,5 +1,25 @@
-from project.server.models import Order
-from project.server.models.queries import most_selling_repairs, get_bestsellers
+import datetime
+import random
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+from project.server.common.pricing import PriceBreakdown
+from project.server.common.popularity import DEVICE, REPAIR, PERIOD, Popularity
+from project.server.extensions import bestsellers, popularity
+from project.server.models import Order, Repair
+from project.server.models.queries import most_selling_repairs, get_bestsellers, order_price_breakdowns, repair_price_breakdowns, rebuild_bestsellers
+from project.tests.utils import QueryCounter, DictRedis
+
+
+@pytest.fixture
+def bestseller_redis(monkeypatch):
+    redis = DictRedis()
+    monkeypatch.setattr(bestsellers, 'redis_client', SimpleNamespace(redis=redis))
+    monkeypatch.setattr(popularity, 'redis_client', SimpleNamespace(redis=redis))
+    monkeypatch.setattr(popularity, '_started', {})
+    return redis
 
 
 class TestQueries:
@@ -12,10 +32,143 @@ class TestQueries:
         Order.create(color=sample_color, repairs=[another_repair])
         assert most_selling_repairs() == [another_repair, sample_repair]
 
-    def test_get_bestsellers(self, sample_repair, another_repair, sample_color):
+    def test_get_bestsellers(self, bestseller_redis, sample_repair, another_repair, sample_color):
         assert get_bestsellers() == []
+        Order.create(color=sample_color, repairs=[sample_repair]).set_complete()
+        assert [device.id for device in get_bestsellers()] == [sample_repair.device.id]
+        Order.create(color=sample_color, repairs=[another_repair]).set_complete()
+        Order.create(color=sample_color, repairs=[another_repair]).set_complete()
+        # orders count once they are complete
         Order.create(color=sample_color, repairs=[sample_repair])
-        assert get_bestsellers() == [sample_repair.device]
-        Order.create(color=sample_color, repairs=[another_repair])
-        Order.create(color=sample_color, repairs=[another_repair])
-        assert get_bestsellers() == [another_repair.device, sample_repair.device]
+        Order.create(color=sample_color, repairs=[sample_repair])
+        assert [device.name for device in get_bestsellers()] == [another_repair.device.name, sample_repair.device.name]
+
+    def test_get_bestsellers_without_query(self, db, bestseller_redis, sample_repair, sample_color):
+        Order.create(color=sample_color, repairs=[sample_repair]).set_complete()
+        get_bestsellers()
+        with QueryCounter(db.engine) as counter:
+            assert len(get_bestsellers()) == 1
+        assert counter.count == 0
+
+    def test_bestseller_windows(self, bestseller_redis, sample_repair, another_repair):
+        today = datetime.date.today()
+        bestsellers.add({sample_repair.device_id: 1})
+        bestsellers.add({another_repair.device_id: 5}, day=today - datetime.timedelta(days=40))
+        assert [device.id for device in get_bestsellers(days=30)] == [sample_repair.device_id]
+        assert [device.id for device in get_bestsellers(days=90)] == [another_repair.device_id, sample_repair.device_id]
+
+    def test_rebuild_bestsellers(self, bestseller_redis, sample_repair, another_repair, sample_color):
+        Order.create(color=sample_color, repairs=[sample_repair]).set_complete()
+        for _ in range(2):
+            Order.create(color=sample_color, repairs=[another_repair], complete=True)
+        Order.create(color=sample_color, repairs=[another_repair], timestamp=datetime.datetime.now() - datetime.timedelta(days=400), complete=True)
+        Order.create(color=sample_color, repairs=[sample_repair])
+        assert [device.id for device in get_bestsellers()] == [sample_repair.device_id]
+
+        rebuild_bestsellers()
+        assert bestsellers.top(days=365) == [another_repair.device_id, sample_repair.device_id]
+        assert [repair_id for repair_id, _ in popularity.top(REPAIR)] == [another_repair.id, sample_repair.id]
+        assert bestseller_redis.data[bestsellers.day_key(datetime.date.today())] == {
+            str(another_repair.device_id).encode(): 2, str(sample_repair.device_id).encode(): 1
+        }
+
+    def test_checkout_feeds_rankings(self, testapp, bestseller_redis, sample_repair, sample_color, sample_shop):
+        device = sample_repair.device
+        form = testapp.get(f"/{device.manufacturer.name}/{device.series.name}/{device.name}/").forms[0]
+        form['color'] = str(sample_color.id)
+        form.get('repairs', index=0).checked = True
+        form.submit()
+
+        form = testapp.get("/register").forms[0]
+        for field, value in dict(first_name="Test", last_name="Kunde", street="Eine Straße 1", zip_code="11233", city="Kiel",
+                                 email="test@kunde.de", tel="+49 113455665 45").items():
+            form[field] = value
+        form.submit()
+        assert get_bestsellers() == []
+
+        form = testapp.get("/order").forms[0]
+        form['shop'] = str(sample_shop.id)
+        assert form.submit().status_code == 302
+        assert Order.query.one().complete
+        assert bestsellers.top() == [device.id]
+        assert [device.id for device in get_bestsellers()] == [device.id]
+        assert [repair_id for repair_id, _ in popularity.top(REPAIR)] == [sample_repair.id]
+
+    def test_popularity_decays(self, bestseller_redis, sample_repair, another_repair):
+        now = datetime.datetime.now()
+        # four orders two half-lives ago count as much as one order today
+        for _ in range(4):
+            popularity.add_order([(another_repair.device_id, another_repair.id)], now=now - 2 * popularity.half_life)
+        popularity.add_order([(sample_repair.device_id, sample_repair.id)], now=now)
+        popularity.add_order([(sample_repair.device_id, sample_repair.id)], now=now)
+
+        assert [device.id for device in get_bestsellers()] == [sample_repair.device_id, another_repair.device_id]
+        (_, first), (_, second) = popularity.top(DEVICE, now=now)
+        assert first == pytest.approx(2) and second == pytest.approx(1)
+        assert [repair_id for repair_id, _ in popularity.top(REPAIR, now=now)] == [sample_repair.id, another_repair.id]
+
+    def test_popularity_periods(self, monkeypatch, bestseller_redis, sample_repair, another_repair):
+        monkeypatch.setattr(popularity, 'half_life', datetime.timedelta(days=1))
+        period = popularity.period()
+        now = datetime.datetime.now()
+        popularity.add_order([(sample_repair.device_id, sample_repair.id)], now=now)
+        popularity.add_order([(another_repair.device_id, another_repair.id)], now=now - popularity.half_life)
+        assert max(bestseller_redis.data[popularity.key(DEVICE, period)].values()) <= 2 ** PERIOD
+        before = popularity.top(DEVICE, now=now)
+
+        # the next period carries the scores over, scaled down to its start
+        monkeypatch.setattr(popularity, 'period', lambda: period + 1)
+        after = popularity.top(DEVICE, now=now)
+        assert [device_id for device_id, _ in after] == [device_id for device_id, _ in before]
+        assert [score for _, score in after] == pytest.approx([score for _, score in before])
+        assert popularity.key(DEVICE, period) not in bestseller_redis.data
+        popularity.add_order([(another_repair.device_id, another_repair.id)], now=now)
+        assert [device_id for device_id, _ in popularity.top(DEVICE, now=now)] == [another_repair.device_id, sample_repair.device_id]
+
+    def test_popularity_half_life(self, app):
+        for days in (0, -1, 0.5, "30"):
+            app.config['POPULARITY_HALF_LIFE_DAYS'] = days
+            with pytest.raises(ValueError):
+                Popularity().init_app(app)
+        # the weights stay small, even for the shortest half-life
+        app.config['POPULARITY_HALF_LIFE_DAYS'] = 1
+        short = Popularity()
+        short.init_app(app)
+        assert 1 <= short.weight() <= 2 ** PERIOD
+
+    def test_popularity_views(self, testapp, monkeypatch, bestseller_redis, sample_repair):
+        device = sample_repair.device
+        url = f"/{device.manufacturer.name}/{device.series.name}/{device.name}/"
+        testapp.get(url)
+        assert popularity.top(DEVICE) == []
+
+        monkeypatch.setattr(popularity, 'count_views', True)
+        testapp.get(url)
+        assert [device_id for device_id, _ in popularity.top(DEVICE)] == [device.id]
+
+    def test_order_price_breakdowns(self, db, sample_device, sample_color):
+        rand = random.Random(42)
+        repairs = [
+            Repair.create(name=f"Repair {i}", price=Decimal(rand.randint(0, 50000)) / 100, device=sample_device) for i in range(20)
+        ]
+        orders = [Order.create(color=sample_color, repairs=rand.sample(repairs, rand.randint(0, 4))) for _ in range(30)]
+        orders[0].set_complete()
+        repairs[0].update(price=Decimal('1.00'))
+        ids = [order.id for order in orders]
+
+        with QueryCounter(db.engine) as counter:
+            breakdowns = order_price_breakdowns(ids + [-1])
+        assert counter.count == 1
+
+        db.session.expire_all()
+        assert breakdowns == {order.id: Order.query.get(order.id).price_breakdown for order in orders}
+
+    def test_repair_price_breakdowns(self, db, sample_repair, another_repair, sample_color):
+        sets = [[sample_repair.id, another_repair.id], [another_repair.id], [], [sample_repair.id, -1]]
+        with QueryCounter(db.engine) as counter:
+            breakdowns = repair_price_breakdowns(sets)
+        assert counter.count == 1
+        assert breakdowns[0] == Order.create(color=sample_color, repairs=[sample_repair, another_repair]).price_breakdown
+        assert breakdowns[1].total == another_repair.price
+        assert breakdowns[2].total == 0
+        assert breakdowns[3] == PriceBreakdown.from_prices([sample_repair.price])
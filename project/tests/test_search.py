@@ -1,4 +1,18 @@
+from types import SimpleNamespace
+
+import pytest
+
+from project.server.common.search_cache import normalize_query
+from project.server.extensions import search_cache
 from project.server.models import Device
+from project.tests.utils import DictRedis
+
+
+@pytest.fixture
+def cache_redis(monkeypatch):
+    redis = DictRedis()
+    monkeypatch.setattr(search_cache, 'redis_client', SimpleNamespace(redis=redis))
+    return redis
 
 
 class TestOrder:
@@ -21,3 +35,60 @@ class TestOrder:
         print(result, result.all())
         result = result.all()
         assert result[0].name == 'iPhone X'
+
+    def test_ranked(self, db, sample_device, some_devices):
+        page = Device.search_ranked('iPhone X')
+        assert page.devices[0].name == 'iPhone X'
+        assert page.total == len(page.devices)
+        assert not page.has_more
+
+        # tokens of the name are matched as well
+        page = Device.search_ranked('11')
+        assert page.devices[0].name == 'iPhone 11'
+
+    def test_ranked_pagination(self, db, sample_device, some_devices):
+        everything = Device.search_ranked('iPhone', limit=50)
+        first = Device.search_ranked('iPhone', limit=2)
+        second = Device.search_ranked('iPhone', limit=2, offset=2)
+        assert first.total == everything.total
+        assert first.has_more
+        assert first.devices + second.devices == everything.devices[:4]
+
+    def test_api(self, testapp, sample_device, some_devices):
+        response = testapp.get('/api/search/iPhone X/?limit=3')
+        assert response.json['limit'] == 3
+        assert response.json['results'][0]['name'] == 'iPhone X'
+        assert len(response.json['results']) == 3
+
+    def test_page(self, testapp, sample_device, some_devices):
+        response = testapp.get('/search/iPhone X/')
+        assert response.status_code == 200
+        assert 'iPhone X' in response
+
+
+class TestSearchCache:
+
+    def test_normalize(self):
+        assert normalize_query(' IPHONE   11 ') == 'iphone 11'
+        assert normalize_query('iPhone\t11') == 'iphone 11'
+        assert normalize_query('Größe Äpfel') == 'groesse aepfel'
+
+    def test_same_key(self):
+        assert search_cache.key('ranked', 'iphone 11', 15, 0) == search_cache.key('ranked', 'iPhone  11 ', 15, 0)
+        assert search_cache.key('ranked', 'iphone 11', 15, 0) != search_cache.key('ranked', 'iphone 11', 15, 15)
+
+    def test_hit(self, cache_redis, sample_device, some_devices):
+        page = Device.search_ranked('iPhone X', limit=3)
+        assert len(cache_redis.data) == 1
+
+        cached = Device.search_ranked('IPHONE   x', limit=3)
+        assert len(cache_redis.data) == 1
+        assert cached.total == page.total
+        assert cached.devices == page.devices
+
+    def test_catalog_change(self, cache_redis, sample_device, some_devices):
+        Device.search_ranked('iPhone 12')
+        Device.create(name="iPhone 12", series=sample_device.series)
+        page = Device.search_ranked('iPhone 12')
+        assert len(cache_redis.data) == 2
+        assert page.devices[0].name == 'iPhone 12'
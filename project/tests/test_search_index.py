@@ -0,0 +1,132 @@
+import time
+
+from project.server.common.search_index import SearchIndex, SearchDocument, trigrams, similarity
+from project.server.extensions import catalog
+from project.server.models import Device
+
+
+def _names(documents):
+    return [document.name for document in documents]
+
+
+class TestSearchIndex:
+
+    def test_trigrams(self):
+        # SELECT SHOW_TRGM('iPhone X');
+        assert trigrams('iPhone X') == {"  i", " ip", "iph", "pho", "hon", "one", "ne ", "  x", " x "}
+        assert trigrams('iPhone-X') == trigrams('iphone x')
+        assert trigrams('') == frozenset()
+
+    def test_similarity(self):
+        assert similarity(trigrams('iPhone X'), trigrams('iPhone X')) == 1
+        assert similarity(trigrams('iPhone X'), trigrams('Galaxy S10')) == 0
+        # SELECT SIMILARITY('word', 'two words'); -> 0.363636
+        assert round(similarity(trigrams('word'), trigrams('two words')), 6) == 0.363636
+
+    def test_search(self):
+        index = SearchIndex([
+            SearchDocument(1, 'iPhone X', 'iPhone', 'Apple'),
+            SearchDocument(2, 'iPhone XS', 'iPhone', 'Apple'),
+            SearchDocument(3, 'Galaxy S10', 'Galaxy S', 'Samsung'),
+        ])
+        total, documents = index.search('iPhone X')
+        assert total == 2
+        assert _names(documents) == ['iPhone X', 'iPhone XS']
+
+        # prefixes of device, series and manufacturer names
+        assert _names(index.search('sams')[1]) == ['Galaxy S10']
+        assert _names(index.search('apple xs')[1]) == ['iPhone XS']
+        assert _names(index.search('sams', prefix=False)[1]) == []
+
+    def test_popularity(self):
+        index = SearchIndex([
+            SearchDocument(1, 'iPhone X', 'iPhone', 'Apple'),
+            SearchDocument(2, 'iPhone XS', 'iPhone', 'Apple'),
+        ])
+        assert _names(index.search('apple')[1]) == ['iPhone X', 'iPhone XS']
+        assert _names(index.search('apple', popularity={2: 0.5})[1]) == ['iPhone XS', 'iPhone X']
+        # popularity only breaks ties
+        assert _names(index.search('iPhone X', popularity={2: 0.5})[1]) == ['iPhone X', 'iPhone XS']
+
+    def test_pagination(self):
+        index = SearchIndex(SearchDocument(i, f'iPhone {i}', 'iPhone', 'Apple') for i in range(10))
+        total, everything = index.search('iPhone', limit=50)
+        assert total == 10
+        assert index.search('iPhone', limit=3, offset=3)[1] == everything[3:6]
+
+    def test_add_and_remove(self):
+        index = SearchIndex()
+        index.add(SearchDocument(1, 'iPhone X', 'iPhone', 'Apple'))
+        index.add(SearchDocument(1, 'Galaxy S10', 'Galaxy S', 'Samsung'))
+        assert len(index) == 1
+        assert index.search('iPhone X') == (0, [])
+        assert _names(index.search('Galaxy')[1]) == ['Galaxy S10']
+
+        index.remove(1)
+        index.remove(1)
+        assert 1 not in index
+        assert index.search('gal') == (0, [])
+
+
+class TestCatalogSearchIndex:
+
+    def test_same_hits_as_postgres(self, sample_device, some_devices):
+        for q in ('iPhone X', 'iPhone 6S', 'iphone', 'XS Max'):
+            expected = Device.search_order_by_similarity(q).all()
+            total, documents = catalog.search_index().search(q, limit=50, prefix=False)
+            assert total == len(expected)
+            assert set(_names(documents)) == {device.name for device in expected}
+
+        for q in ('iPhone X', 'XS Max'):
+            expected = Device.search_order_by_similarity(q).first()
+            assert catalog.search_index().search(q, limit=1)[1][0].name == expected.name
+
+    def test_incremental_update(self, sample_device, some_devices):
+        index = catalog.search_index()
+
+        device = Device.create(name="iPhone 12", series=sample_device.series)
+        assert catalog.search_index() is index
+        assert _names(index.search('iPhone 12')[1])[0] == 'iPhone 12'
+
+        device.update(name="iPhone 13")
+        assert catalog.search_index() is index
+        assert 'iPhone 12' not in _names(index.search('iPhone 12')[1])
+
+        device.delete()
+        assert catalog.search_index() is index
+        assert device.id not in index
+
+    def test_series_rename_rebuilds(self, sample_device, sample_series):
+        index = catalog.search_index()
+        sample_series.update(name="Neues iPhone")
+        new_index = catalog.search_index()
+        assert new_index is not index
+        assert _names(new_index.search('neues')[1]) == [sample_device.name]
+
+    def test_other_worker_rebuilds(self, sample_device):
+        index = catalog.search_index()
+        catalog.bump()
+        assert catalog.search_index() is not index
+
+    def test_benchmark(self, db, sample_series, capsys):
+        db.session.add_all(Device(name=f"Gerät {i} Pro", series=sample_series) for i in range(500))
+        db.session.commit()
+        queries = ['Gerät 42', 'Gerät 4 Pro', 'pro', 'Geraet 499']
+        rounds = 5
+
+        index = catalog.search_index()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for q in queries:
+                index.search(q)
+        in_process = (time.perf_counter() - start) / (rounds * len(queries))
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for q in queries:
+                Device.search_order_by_similarity(q).limit(15).all()
+        postgres = (time.perf_counter() - start) / (rounds * len(queries))
+
+        with capsys.disabled():
+            print(f"\nsearch index: {in_process * 1000:.3f}ms, postgres: {postgres * 1000:.3f}ms per query")
+        assert in_process < postgres
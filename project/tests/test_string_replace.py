@@ -1,4 +1,17 @@
-from project.server.common.escape import cleanify
+import time
+
+from project.server.common.escape import SPECIAL_CHARS, cleanify, cleanify_dict, replace
+
+
+def _cleanify_per_char(string):
+    # the former implementation, a Python function call per character
+    def _replace(old):
+        replacement = SPECIAL_CHARS.get(old.lower(), None)
+        if replacement:
+            return replacement.title() if old.isupper() else replacement
+        return old
+
+    return "".join([_replace(char) for char in string])
 
 
 class TestReplacements:
@@ -21,3 +34,61 @@ class TestReplacements:
 
     def test_ss(self):
         assert cleanify("Scheiße") == "Scheisse"
+
+    def test_special_chars_unchanged(self):
+        text = "Äpfel, Öl, Übel, Straße, ẞ und äöü ÄÖÜ"
+        assert cleanify(text) == _cleanify_per_char(text)
+        for char in "äöüßÄÖÜẞ":
+            assert replace(char) == _cleanify_per_char(char)
+
+    def test_ascii(self):
+        text = "iPhone X (Display) - 99,00 EUR"
+        assert cleanify(text) is text
+
+    def test_accents(self):
+        assert cleanify("Crème brûlée") == "Creme brulee"
+        assert cleanify("Ñandú Ångström") == "Nandu Angstroem"
+        assert cleanify("Łódź") == "Lodz"
+        assert cleanify("Ærøskøbing") == "Aeroskobing"
+        assert cleanify("Şişli Čapek") == "Sisli Capek"
+
+    def test_non_latin(self):
+        assert cleanify("Москва") == "Moskva"
+        assert cleanify("Щука") == "Shchuka"
+        assert cleanify("Αθήνα") == "Athina"
+
+    def test_punctuation(self):
+        assert cleanify("„Display“ – 1\u00a0Stück…") == '"Display" - 1 Stueck...'
+        assert cleanify("ﬁx") == "fix"
+
+    def test_unknown_chars_are_kept(self):
+        assert cleanify("日本") == "日本"
+
+    def test_replace(self):
+        assert replace("é") == "e"
+        assert replace("x") == "x"
+
+    def test_cleanify_dict(self):
+        params = {'name': "Müller", 'city': "Kraków", 'kn': 42, 'email': None}
+        cleanify_dict(params)
+        assert params == {'name': "Mueller", 'city': "Krakow", 'kn': 42, 'email': None}
+
+    def test_benchmark(self, capsys):
+        # only reports the throughput, wall clock times are too noisy to assert on
+        texts = ["Max Mustermann", "Hauptstraße 12", "Jürgen Größe", "Crème brûlée", "iPhone 11 Pro"] * 2000
+        rounds = 5
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for text in texts:
+                _cleanify_per_char(text)
+        per_char = rounds * len(texts) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for text in texts:
+                cleanify(text)
+        translated = rounds * len(texts) / (time.perf_counter() - start)
+
+        with capsys.disabled():
+            print(f"\ncleanify: {translated:,.0f} strings/s, per char: {per_char:,.0f} strings/s")
@@ -1,3 +1,8 @@
+import fnmatch
+
+from sqlalchemy import event
+
+
 def login(client, email: str, password: str):
     res = client.get("/admin/login/")
     form = res.forms[0]
@@ -5,3 +10,127 @@ def login(client, email: str, password: str):
     form["password"] = password
     res = form.submit().follow()
     return res
+
+
+class QueryCounter:
+    """ Count all statements that are sent to the database """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.callback)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self.callback)
+
+    def callback(self, *args, **kwargs):
+        self.count += 1
+
+
+class DictRedis:
+    """ Just enough of redis.Redis for the tests that do not need a real server """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.setex(key, ex, value)
+        return True
+
+    def setex(self, key, timeout, value):
+        self.data[key] = value.encode('utf-8') if isinstance(value, str) else value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def lpush(self, key, value):
+        self.data.setdefault(key, []).insert(0, value)
+
+    def ltrim(self, key, start, end):
+        self.data[key] = self.data.get(key, [])[start:end + 1]
+
+    def lrange(self, key, start, end):
+        return self.data.get(key, [])[start:end + 1]
+
+    def rpush(self, key, value):
+        self.data.setdefault(key, []).append(value)
+
+    def expire(self, key, timeout):
+        pass
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def scan_iter(self, match='*'):
+        return [key.encode('utf-8') for key in list(self.data) if fnmatch.fnmatchcase(key, match)]
+
+    def zincrby(self, key, amount, value):
+        scores = self.data.setdefault(key, {})
+        member = str(value).encode('utf-8')
+        scores[member] = scores.get(member, 0) + amount
+        return scores[member]
+
+    def zadd(self, key, mapping):
+        scores = self.data.setdefault(key, {})
+        for member, score in mapping.items():
+            scores[str(member).encode('utf-8')] = score
+        return len(mapping)
+
+    def zrevrange(self, key, start, end, withscores=False):
+        ranked = sorted(self.data.get(key, {}).items(), key=lambda item: (item[1], item[0]), reverse=True)[start:end + 1]
+        return ranked if withscores else [member for member, _ in ranked]
+
+    def zunionstore(self, dest, keys):
+        # a list of keys or a mapping of keys to weights
+        weights = keys if isinstance(keys, dict) else dict.fromkeys(keys, 1)
+        union = {}
+        for key, weight in weights.items():
+            for member, score in self.data.get(key, {}).items():
+                union[member] = union.get(member, 0) + score * weight
+        self.data.pop(dest, None)
+        if union:
+            self.data[dest] = union
+        return len(union)
+
+    def sadd(self, key, *values):
+        members = self.data.setdefault(key, set())
+        added = {str(value).encode('utf-8') for value in values} - members
+        members.update(added)
+        return len(added)
+
+    def spop(self, key, count=None):
+        members = self.data.get(key, set())
+        popped = [members.pop() for _ in range(min(count or 1, len(members)))]
+        if not members:
+            self.data.pop(key, None)
+        return popped if count is not None else next(iter(popped), None)
+
+    def scard(self, key):
+        return len(self.data.get(key, ()))
+
+    def pipeline(self):
+        return DictPipeline(self)
+
+
+class DictPipeline:
+    """ Queues the commands like a pipeline and runs them on execute """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((getattr(self.redis, name), args, kwargs))
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]